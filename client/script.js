@@ -8,7 +8,29 @@ let allGenres = [];
 let allArtists = [];
 
 // API Helper Functions
+
+// GET-запросы, выполняющиеся в данный момент (одинаковые параллельные запросы объединяются)
+const inflightRequests = new Map();
+
 async function apiRequest(endpoint, options = {}) {
+    const method = (options.method || 'GET').toUpperCase();
+    if (method !== 'GET') {
+        return sendApiRequest(endpoint, options);
+    }
+    
+    if (inflightRequests.has(endpoint)) {
+        return inflightRequests.get(endpoint);
+    }
+    
+    const request = sendApiRequest(endpoint, options).finally(() => inflightRequests.delete(endpoint));
+    inflightRequests.set(endpoint, request);
+    return request;
+}
+
+// Повторы GET-запросов, отклоненных перегруженным сервером (503 с Retry-After)
+const OVERLOAD_MAX_RETRIES = 2;
+
+async function sendApiRequest(endpoint, options = {}, retriesLeft = OVERLOAD_MAX_RETRIES) {
     const token = localStorage.getItem('token');
     const headers = {
         'Content-Type': 'application/json',
@@ -32,6 +54,13 @@ async function apiRequest(endpoint, options = {}) {
             return null;
         }
         
+        const method = (options.method || 'GET').toUpperCase();
+        if (response.status === 503 && method === 'GET' && retriesLeft > 0) {
+            const retryAfter = parseInt(response.headers.get('Retry-After'), 10) || 1;
+            await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+            return sendApiRequest(endpoint, options, retriesLeft - 1);
+        }
+        
         const data = await response.json();
         
         if (!response.ok) {
@@ -46,6 +75,483 @@ async function apiRequest(endpoint, options = {}) {
     }
 }
 
+// Клиентский слой данных
+// Нормализованное хранилище треков, исполнителей, коллекций и жанров.
+// Обновляется дельта-синхронизацией (/sync) по событиям потока изменений
+// и сохраняется в IndexedDB для мгновенного повторного запуска
+const dataStore = {
+    tracks: new Map(),           // track_id -> трек
+    artists: new Map(),          // artist_id -> исполнитель
+    collections: new Map(),      // collection_id -> коллекция
+    collectionTracks: new Map(), // collection_id -> Map(track_id -> added_at)
+    genres: new Map(),           // genre_id -> жанр
+    cursor: null,                // курсор последней синхронизации
+    version: 0                   // номер примененного ответа /sync
+};
+
+const STORE_DB_NAME = 'music-library';
+const STORE_DB_OBJECTS = 'snapshots';
+
+let syncInProgress = null;
+let syncRequested = false;
+let persistTimer = null;
+let changeFeedConnected = false;
+
+// Состав коллекции (создается при первом обращении)
+function getCollectionMembership(collectionId) {
+    if (!dataStore.collectionTracks.has(collectionId)) {
+        dataStore.collectionTracks.set(collectionId, new Map());
+    }
+    return dataStore.collectionTracks.get(collectionId);
+}
+
+// Удалить трек из хранилища вместе с его вхождениями в коллекции
+function removeStoreTrack(trackId) {
+    dataStore.tracks.delete(trackId);
+    dataStore.collectionTracks.forEach(membership => membership.delete(trackId));
+}
+
+// Применить ответ /sync к хранилищу
+function applySyncChanges(changes) {
+    if (changes.full) {
+        dataStore.tracks.clear();
+        dataStore.artists.clear();
+        dataStore.collections.clear();
+        dataStore.collectionTracks.clear();
+    }
+    
+    changes.artists.upserted.forEach(artist => dataStore.artists.set(artist.artist_id, artist));
+    changes.artists.deleted.forEach(artistId => dataStore.artists.delete(artistId));
+    
+    changes.tracks.upserted.forEach(track => dataStore.tracks.set(track.track_id, track));
+    changes.tracks.deleted.forEach(removeStoreTrack);
+    
+    changes.collections.upserted.forEach(collection => dataStore.collections.set(collection.collection_id, collection));
+    changes.collections.deleted.forEach(collectionId => {
+        dataStore.collections.delete(collectionId);
+        dataStore.collectionTracks.delete(collectionId);
+    });
+    
+    changes.collection_tracks.upserted.forEach(item => {
+        getCollectionMembership(item.collection_id).set(item.track_id, item.added_at);
+    });
+    changes.collection_tracks.deleted.forEach(item => {
+        getCollectionMembership(item.collection_id).delete(item.track_id);
+    });
+    
+    dataStore.cursor = changes.cursor;
+    dataStore.version++;
+}
+
+// Дельта-синхронизация с сервером (одновременно выполняется не больше одной)
+function syncLibrary() {
+    if (syncInProgress) {
+        syncRequested = true;
+        return syncInProgress;
+    }
+    
+    syncInProgress = (async () => {
+        let synced = false;
+        do {
+            syncRequested = false;
+            const endpoint = dataStore.cursor ? `/sync?since=${dataStore.cursor}` : '/sync';
+            const changes = await apiRequest(endpoint);
+            if (!changes) break;
+            applySyncChanges(changes);
+            synced = true;
+        } while (syncRequested);
+        
+        if (synced) {
+            refreshDerivedLists();
+            schedulePersistStore();
+        }
+        return synced;
+    })().finally(() => {
+        syncInProgress = null;
+    });
+    
+    return syncInProgress;
+}
+
+// Снимок хранилища для отката оптимистичных изменений
+function captureStore() {
+    const saved = {
+        tracks: new Map(dataStore.tracks),
+        artists: new Map(dataStore.artists),
+        collections: new Map(dataStore.collections),
+        collectionTracks: new Map([...dataStore.collectionTracks].map(([id, membership]) => [id, new Map(membership)]))
+    };
+    const version = dataStore.version;
+    return () => {
+        if (dataStore.version === version) {
+            Object.assign(dataStore, saved);
+            return;
+        }
+        // Снимок устарел: синхронизация, завершившаяся после него, уже принесла данные
+        // сервера, поэтому неудавшееся изменение убирается полной синхронизацией
+        dataStore.cursor = null;
+        syncLibrary().then(synced => synced && renderActiveSection());
+    };
+}
+
+// Применить локальное изменение хранилища и обновить интерфейс
+function commitLocalChange() {
+    refreshDerivedLists();
+    renderActiveSection();
+    schedulePersistStore();
+}
+
+// Сверка с сервером, если поток изменений не подключен (иначе сверку запустит событие)
+function reconcileWithServer() {
+    if (!changeFeedConnected) {
+        syncLibrary().then(synced => synced && renderActiveSection());
+    }
+}
+
+// Оптимистичное изменение: сразу применить локально, при ошибке запроса откатить
+async function optimisticMutation(applyLocal, sendRequest) {
+    const rollback = captureStore();
+    applyLocal();
+    commitLocalChange();
+    
+    const result = await sendRequest();
+    if (result) {
+        reconcileWithServer();
+    } else {
+        rollback();
+        commitLocalChange();
+    }
+    return result;
+}
+
+// Обновить производные списки, используемые формами
+function refreshDerivedLists() {
+    allArtists = getStoreArtists();
+    allGenres = [...dataStore.genres.values()].sort((a, b) => a.name.localeCompare(b.name));
+}
+
+// Представления хранилища
+function getStoreArtists() {
+    return [...dataStore.artists.values()].sort((a, b) => a.name.localeCompare(b.name));
+}
+
+function withTrackNames(track) {
+    const artist = dataStore.artists.get(track.artist_id);
+    const genre = dataStore.genres.get(track.genre_id);
+    return {
+        ...track,
+        artist_name: artist ? artist.name : track.artist_name,
+        genre_name: genre ? genre.name : track.genre_name
+    };
+}
+
+function getStoreTracks() {
+    return [...dataStore.tracks.values()]
+        .map(withTrackNames)
+        .sort((a, b) => new Date(b.created_at) - new Date(a.created_at) || b.track_id - a.track_id);
+}
+
+function getStoreCollections() {
+    return [...dataStore.collections.values()]
+        .map(collection => ({
+            ...collection,
+            tracks_count: getCollectionMembership(collection.collection_id).size
+        }))
+        .sort((a, b) => (b.is_favorite - a.is_favorite) || a.name.localeCompare(b.name));
+}
+
+function getStoreCollectionTracks(collectionId) {
+    const tracks = [];
+    getCollectionMembership(collectionId).forEach((addedAt, trackId) => {
+        const track = dataStore.tracks.get(trackId);
+        if (track) {
+            tracks.push({ ...withTrackNames(track), added_at: addedAt });
+        }
+    });
+    return tracks.sort((a, b) => new Date(b.added_at) - new Date(a.added_at));
+}
+
+// Перерисовать активную секцию из хранилища
+function renderActiveSection() {
+    const activeSection = document.querySelector('.content-section.active')?.id;
+    switch (activeSection) {
+        case 'tracks-section':
+            if (isAdmin) {
+                loadUserTracks();
+            } else {
+                displayTracks(getStoreTracks());
+            }
+            break;
+        case 'collections-section':
+            displayCollections(getStoreCollections());
+            break;
+        case 'artists-section':
+            displayArtists(allArtists);
+            break;
+    }
+}
+
+// Сохранение хранилища в IndexedDB
+function openStoreDb() {
+    return new Promise(resolve => {
+        if (!window.indexedDB) {
+            resolve(null);
+            return;
+        }
+        const request = indexedDB.open(STORE_DB_NAME, 1);
+        request.onupgradeneeded = () => request.result.createObjectStore(STORE_DB_OBJECTS);
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => resolve(null);
+    });
+}
+
+function getStoreSnapshotKey() {
+    return `user-${currentUser.user_id}`;
+}
+
+async function loadPersistedStore() {
+    if (!currentUser) return false;
+    
+    const db = await openStoreDb();
+    if (!db) return false;
+    
+    const snapshot = await new Promise(resolve => {
+        const request = db.transaction(STORE_DB_OBJECTS).objectStore(STORE_DB_OBJECTS).get(getStoreSnapshotKey());
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => resolve(null);
+    });
+    db.close();
+    
+    if (!snapshot) return false;
+    
+    snapshot.tracks.forEach(track => dataStore.tracks.set(track.track_id, track));
+    snapshot.artists.forEach(artist => dataStore.artists.set(artist.artist_id, artist));
+    snapshot.collections.forEach(collection => dataStore.collections.set(collection.collection_id, collection));
+    snapshot.genres.forEach(genre => dataStore.genres.set(genre.genre_id, genre));
+    snapshot.collection_tracks.forEach(([collectionId, items]) => {
+        dataStore.collectionTracks.set(collectionId, new Map(items));
+    });
+    dataStore.cursor = snapshot.cursor;
+    refreshDerivedLists();
+    return true;
+}
+
+function schedulePersistStore() {
+    clearTimeout(persistTimer);
+    persistTimer = setTimeout(persistStore, 500);
+}
+
+async function persistStore() {
+    if (!currentUser) return;
+    
+    const db = await openStoreDb();
+    if (!db) return;
+    
+    const snapshot = {
+        cursor: dataStore.cursor,
+        tracks: [...dataStore.tracks.values()],
+        artists: [...dataStore.artists.values()],
+        collections: [...dataStore.collections.values()],
+        genres: [...dataStore.genres.values()],
+        collection_tracks: [...dataStore.collectionTracks].map(([id, membership]) => [id, [...membership]])
+    };
+    const transaction = db.transaction(STORE_DB_OBJECTS, 'readwrite');
+    transaction.objectStore(STORE_DB_OBJECTS).put(snapshot, getStoreSnapshotKey());
+    transaction.oncomplete = () => db.close();
+    transaction.onerror = () => db.close();
+}
+
+// Виртуализированная таблица
+// В DOM находятся только видимые строки (плюс небольшой запас), остальная высота
+// заполняется строками-распорками. При прокрутке к концу подгружается следующая
+// страница (loadPage), сортировка и фильтрация выполняются над загруженными строками
+const VIRTUAL_TABLE_PAGE_SIZE = 200;
+const VIRTUAL_TABLE_OVERSCAN = 10;
+
+class VirtualTable {
+    constructor(container, { columns, renderRow, emptyText, loadPage = null, filterKeys = [] }) {
+        this.columns = columns;
+        this.renderRow = renderRow;
+        this.emptyText = emptyText;
+        this.loadPage = loadPage;
+        this.filterKeys = filterKeys;
+        this.container = container;
+        
+        this.allRows = [];     // загруженные строки в порядке загрузки
+        this.rows = [];        // строки после фильтрации и сортировки
+        this.hasMore = false;
+        this.loading = false;
+        this.filterText = '';
+        this.sortKey = null;
+        this.sortDirection = 1;
+        this.rowHeight = 41;
+        this.renderedRange = null;
+        this.renderScheduled = false;
+        
+        container.innerHTML = `
+            ${filterKeys.length ? '<input type="text" class="virtual-table-filter" placeholder="Фильтр по загруженным строкам">' : ''}
+            <div class="virtual-table-scroll">
+                <table class="virtual-table">
+                    <thead><tr>${columns.map(c => `<th data-key="${c.key || ''}" class="${c.key ? 'sortable' : ''}">${c.label}</th>`).join('')}</tr></thead>
+                    <tbody></tbody>
+                </table>
+            </div>
+        `;
+        this.scrollContainer = container.querySelector('.virtual-table-scroll');
+        this.tbody = container.querySelector('tbody');
+        this.thead = container.querySelector('thead');
+        
+        this.scrollContainer.addEventListener('scroll', () => this.scheduleRender());
+        this.thead.addEventListener('click', (e) => {
+            const key = e.target.dataset.key;
+            if (key) this.sortBy(key);
+        });
+        const filterInput = container.querySelector('.virtual-table-filter');
+        if (filterInput) {
+            filterInput.addEventListener('input', () => {
+                this.filterText = filterInput.value.trim().toLowerCase();
+                this.applyView();
+            });
+        }
+    }
+    
+    // Заменить строки таблицы; при наличии loadPage остальные строки подгружаются при прокрутке
+    setRows(rows, hasMore = false) {
+        this.allRows = rows || [];
+        this.hasMore = hasMore;
+        this.scrollContainer.scrollTop = 0;
+        this.applyView();
+    }
+    
+    // Начать постраничную загрузку с первой страницы
+    async reload() {
+        this.setRows([], true);
+        await this.loadMore();
+    }
+    
+    async loadMore() {
+        if (!this.loadPage || !this.hasMore || this.loading) return;
+        
+        this.loading = true;
+        try {
+            const lastRow = this.allRows[this.allRows.length - 1] || null;
+            const page = await this.loadPage(lastRow);
+            if (!page) {
+                this.hasMore = false;
+                return;
+            }
+            this.allRows = this.allRows.concat(page);
+            this.hasMore = page.length === VIRTUAL_TABLE_PAGE_SIZE;
+        } finally {
+            this.loading = false;
+        }
+        this.applyView();
+    }
+    
+    sortBy(key) {
+        this.sortDirection = this.sortKey === key ? -this.sortDirection : 1;
+        this.sortKey = key;
+        this.thead.querySelectorAll('th').forEach(th => {
+            th.classList.toggle('sorted-asc', th.dataset.key === key && this.sortDirection === 1);
+            th.classList.toggle('sorted-desc', th.dataset.key === key && this.sortDirection === -1);
+        });
+        this.applyView();
+    }
+    
+    // Пересчитать фильтр и сортировку над загруженными строками и отрисовать видимое окно
+    applyView() {
+        let rows = this.allRows;
+        
+        if (this.filterText) {
+            rows = rows.filter(row => this.filterKeys.some(key =>
+                String(row[key] ?? '').toLowerCase().includes(this.filterText)
+            ));
+        }
+        
+        if (this.sortKey) {
+            const key = this.sortKey;
+            const direction = this.sortDirection;
+            rows = rows.slice().sort((a, b) => direction * compareValues(a[key], b[key]));
+        }
+        
+        this.rows = rows;
+        this.renderedRange = null;
+        this.render();
+    }
+    
+    scheduleRender() {
+        if (this.renderScheduled) return;
+        this.renderScheduled = true;
+        requestAnimationFrame(() => {
+            this.renderScheduled = false;
+            this.render();
+        });
+    }
+    
+    render() {
+        const columnsCount = this.columns.length;
+        
+        if (this.rows.length === 0) {
+            this.tbody.innerHTML = this.loading || this.hasMore
+                ? `<tr><td colspan="${columnsCount}">Загрузка...</td></tr>`
+                : `<tr><td colspan="${columnsCount}">${this.emptyText}</td></tr>`;
+            return;
+        }
+        
+        const headerHeight = this.thead.offsetHeight;
+        const scrollTop = Math.max(0, this.scrollContainer.scrollTop - headerHeight);
+        const viewportHeight = this.scrollContainer.clientHeight || 600;
+        const start = Math.max(0, Math.floor(scrollTop / this.rowHeight) - VIRTUAL_TABLE_OVERSCAN);
+        const end = Math.min(this.rows.length, Math.ceil((scrollTop + viewportHeight) / this.rowHeight) + VIRTUAL_TABLE_OVERSCAN);
+        
+        if (!this.renderedRange || this.renderedRange.start !== start || this.renderedRange.end !== end) {
+            const topHeight = start * this.rowHeight;
+            const bottomHeight = (this.rows.length - end) * this.rowHeight;
+            this.tbody.innerHTML =
+                `<tr class="virtual-spacer" style="height: ${topHeight}px"><td colspan="${columnsCount}"></td></tr>` +
+                this.rows.slice(start, end).map(this.renderRow).join('') +
+                `<tr class="virtual-spacer" style="height: ${bottomHeight}px"><td colspan="${columnsCount}"></td></tr>`;
+            this.renderedRange = { start, end };
+            
+            // Высота строки измеряется по первой отрисованной строке
+            const firstRow = this.tbody.rows[1];
+            if (firstRow && firstRow.offsetHeight && firstRow.offsetHeight !== this.rowHeight) {
+                this.rowHeight = firstRow.offsetHeight;
+                this.renderedRange = null;
+                this.scheduleRender();
+            }
+        }
+        
+        if (end >= this.rows.length - VIRTUAL_TABLE_OVERSCAN) {
+            this.loadMore();
+        }
+    }
+}
+
+// Сравнение значений для сортировки таблиц (числа, даты, строки)
+function compareValues(a, b) {
+    if (a === b) return 0;
+    if (a === null || a === undefined || a === '') return 1;
+    if (b === null || b === undefined || b === '') return -1;
+    if (typeof a === 'number' && typeof b === 'number') return a - b;
+    if (typeof a === 'boolean' && typeof b === 'boolean') return a - b;
+    
+    const dateA = Date.parse(a);
+    const dateB = Date.parse(b);
+    if (!isNaN(dateA) && !isNaN(dateB) && isNaN(Number(a))) return dateA - dateB;
+    
+    return String(a).localeCompare(String(b), 'ru');
+}
+
+// Загрузчик страниц для списков с постраничной выдачей по ключу (limit + before_id)
+function pagedLoader(endpoint, idKey) {
+    return (lastRow) => {
+        const params = new URLSearchParams({ limit: VIRTUAL_TABLE_PAGE_SIZE });
+        if (lastRow) params.append('before_id', lastRow[idKey]);
+        return apiRequest(`${endpoint}?${params.toString()}`);
+    };
+}
+
 // Инициализация при загрузке страницы
 document.addEventListener('DOMContentLoaded', function() {
     initializeApp();
@@ -59,8 +565,51 @@ async function initializeApp() {
     // Настройка обработчиков событий
     setupEventListeners();
     
-    // Загрузка начальных данных
+    // Мгновенный теплый старт из IndexedDB
+    if (await loadPersistedStore()) {
+        renderActiveSection();
+    }
+    
+    // Загрузка начальных данных (дельта-синхронизация от сохраненного курсора)
     await loadInitialData();
+    
+    // Подписка на изменения из других вкладок и устройств
+    subscribeToChanges();
+}
+
+// Поток изменений (server-sent events)
+let changeEventsSource = null;
+let changeRefreshTimer = null;
+
+function subscribeToChanges() {
+    const token = localStorage.getItem('token');
+    if (!token || !window.EventSource) return;
+    
+    changeEventsSource = new EventSource(`${API_BASE_URL}/events?token=${encodeURIComponent(token)}`);
+    
+    changeEventsSource.onopen = () => {
+        changeFeedConnected = true;
+        // События, пропущенные во время переподключения, восполняет дельта-синхронизация
+        scheduleChangeRefresh();
+    };
+    changeEventsSource.onerror = () => {
+        changeFeedConnected = false;
+    };
+    
+    // Изменение сущности или пропуск части событий на сервере:
+    // в обоих случаях достаточно дельта-синхронизации от текущего курсора
+    changeEventsSource.addEventListener('change', scheduleChangeRefresh);
+    changeEventsSource.addEventListener('resync', scheduleChangeRefresh);
+}
+
+// Объединение серии событий в одну синхронизацию
+function scheduleChangeRefresh() {
+    clearTimeout(changeRefreshTimer);
+    changeRefreshTimer = setTimeout(async () => {
+        if (await syncLibrary()) {
+            renderActiveSection();
+        }
+    }, 300);
 }
 
 // Проверка сессии пользователя
@@ -184,14 +733,17 @@ async function saveArtist(e) {
     try {
     if (artistId) {
         // Редактирование
-            const result = await apiRequest(`/artists/${artistId}`, {
-                method: 'PUT',
-                body: JSON.stringify({ name })
-            });
+            const id = parseInt(artistId);
+            const result = await optimisticMutation(
+                () => dataStore.artists.set(id, { ...dataStore.artists.get(id), name }),
+                () => apiRequest(`/artists/${artistId}`, {
+                    method: 'PUT',
+                    body: JSON.stringify({ name })
+                })
+            );
             
             if (result) {
                 alert('Исполнитель успешно обновлен!');
-                await loadUserArtists();
                 closeModal();
         }
     } else {
@@ -202,8 +754,14 @@ async function saveArtist(e) {
             });
             
             if (result && result.artist_id) {
+                dataStore.artists.set(result.artist_id, {
+                    artist_id: result.artist_id,
+                    name: result.name,
+                    created_at: new Date().toISOString()
+                });
+                commitLocalChange();
+                reconcileWithServer();
                 alert('Исполнитель успешно добавлен!');
-                await loadUserArtists();
                 closeModal();
             } else {
                 const errorMsg = result?.message || 'Не удалось добавить исполнителя. Возможно, исполнитель с таким именем уже существует.';
@@ -218,11 +776,22 @@ async function saveArtist(e) {
 }
 
 // Удаление автора
+// Опрос состояния фонового задания до его завершения
+const JOB_POLL_INTERVAL_MS = 1000;
+
+async function waitForJob(jobId) {
+    while (true) {
+        const job = await apiRequest(`/jobs/${jobId}`);
+        if (!job || job.status === 'done' || job.status === 'failed') return job;
+        await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+    }
+}
+
 async function deleteArtist(artistId) {
     try {
-        // Сначала получаем количество треков у автора
-        const tracksCountData = await apiRequest(`/artists/${artistId}/tracks-count`);
-        const tracksCount = tracksCountData?.tracks_count || 0;
+        // Количество треков автора берется из локального хранилища
+        const artistTracks = [...dataStore.tracks.values()].filter(t => t.artist_id === artistId);
+        const tracksCount = artistTracks.length;
         
         let confirmMessage;
         if (tracksCount > 0) {
@@ -233,17 +802,26 @@ async function deleteArtist(artistId) {
         
         if (!confirm(confirmMessage)) return;
 
-        const result = await apiRequest(`/artists/${artistId}`, {
-            method: 'DELETE'
-        });
+        const result = await optimisticMutation(
+            () => {
+                dataStore.artists.delete(artistId);
+                artistTracks.forEach(t => removeStoreTrack(t.track_id));
+            },
+            () => apiRequest(`/artists/${artistId}`, {
+                method: 'DELETE'
+            })
+        );
         
-        if (result) {
+        // Треки удаляются фоновым заданием порциями; локально они уже удалены,
+        // а поток изменений приносит удаления по мере выполнения задания
+        const job = result && result.job_id ? await waitForJob(result.job_id) : null;
+        if (job && job.status === 'done') {
             alert('Исполнитель успешно удален!');
-            await loadUserArtists();
-            // Если были удалены треки, обновить список треков
-            if (tracksCount > 0) {
-                await loadUserTracks();
-            }
+        } else if (job) {
+            alert(`Ошибка: ${job.error || 'Не удалось удалить исполнителя'}`);
+            // Часть треков могла быть удалена: полная синхронизация с сервером
+            dataStore.cursor = null;
+            syncLibrary().then(synced => synced && renderActiveSection());
         }
     } catch (error) {
         console.error('Delete artist error:', error);
@@ -271,6 +849,7 @@ function setupEventListeners() {
     
     // Треки
     document.getElementById('add-track-btn').addEventListener('click', showAddTrackModal);
+    document.getElementById('find-duplicates-btn').addEventListener('click', showDuplicatesModal);
     
     // Авторы
     document.getElementById('add-artist-btn').addEventListener('click', showAddArtistModal);
@@ -281,11 +860,14 @@ function setupEventListeners() {
     // Поиск
     document.getElementById('search-submit-btn').addEventListener('click', performSearch);
     document.getElementById('search-reset-btn').addEventListener('click', resetSearch);
+    setupAutocomplete('search-title', 'search-title-suggestions', 'tracks');
+    setupAutocomplete('search-artist', 'search-artist-suggestions', 'artists');
     
     // Админ-панель
     document.getElementById('admin-users-tab').addEventListener('click', () => switchAdminTab('users'));
     document.getElementById('admin-tracks-tab').addEventListener('click', () => switchAdminTab('tracks'));
     document.getElementById('admin-audit-tab').addEventListener('click', () => switchAdminTab('audit'));
+    document.getElementById('admin-stats-tab').addEventListener('click', () => switchAdminTab('stats'));
     
     // Модальные окна
     document.getElementById('close-modal-btn').addEventListener('click', closeModal);
@@ -337,22 +919,20 @@ async function showSection(sectionId) {
     document.getElementById(activeBtnId).classList.add('active');
     
     // Загрузить данные для секции, если нужно
+    // (треки, коллекции и авторы берутся из локального хранилища)
     switch(sectionId) {
         case 'profile-section':
             await loadUserProfile();
             break;
         case 'tracks-section':
-            loadUserTracks();
-            break;
         case 'collections-section':
-            loadUserCollections();
+        case 'artists-section':
+            renderActiveSection();
+            reconcileWithServer();
             break;
         case 'search-section':
             loadGenresForSearch();
             break;
-        case 'artists-section':
-            loadUserArtists();
-            break;
         case 'admin-section':
             if (isAdmin) {
                 loadAdminUsers();
@@ -365,8 +945,9 @@ async function showSection(sectionId) {
 async function loadInitialData() {
     await Promise.all([
         loadGenres(),
-        loadArtists()
+        syncLibrary()
     ]);
+    renderActiveSection();
 }
 
 // Загрузка жанров
@@ -374,20 +955,20 @@ async function loadGenres() {
     try {
         const genres = await apiRequest('/genres');
         if (genres) {
-            allGenres = genres;
+            dataStore.genres.clear();
+            genres.forEach(genre => dataStore.genres.set(genre.genre_id, genre));
+            refreshDerivedLists();
+            schedulePersistStore();
         }
     } catch (error) {
         console.error('Load genres error:', error);
     }
 }
 
-// Загрузка всех исполнителей пользователя
+// Загрузка всех исполнителей пользователя (через синхронизацию хранилища)
 async function loadArtists() {
     try {
-        const artists = await apiRequest('/artists');
-        if (artists) {
-            allArtists = artists;
-        }
+        await syncLibrary();
     } catch (error) {
         console.error('Load artists error:', error);
     }
@@ -396,7 +977,7 @@ async function loadArtists() {
 // Загрузка авторов пользователя
 async function loadUserArtists() {
     try {
-        await loadArtists(); // Reload artists from server
+        await loadArtists();
         displayArtists(allArtists);
     } catch (error) {
         console.error('Load user artists error:', error);
@@ -441,6 +1022,8 @@ function loadGenresForSearch() {
 
 // Выход из системы
 function logout() {
+    if (changeEventsSource) changeEventsSource.close();
+    if (window.indexedDB) indexedDB.deleteDatabase(STORE_DB_NAME);
     localStorage.clear();
     window.location.href = 'login.html';
 }
@@ -499,48 +1082,63 @@ function changeAvatar() {
 }
 
 // Загрузка треков пользователя
+// (администратор видит все треки, поэтому для него список загружается с сервера)
 async function loadUserTracks() {
     try {
-        const tracks = await apiRequest('/tracks');
-        if (tracks) {
-    displayTracks(tracks);
+        if (!isAdmin) {
+            await syncLibrary();
+            displayTracks(getStoreTracks());
+            return;
         }
+        await getTracksTable().reload();
     } catch (error) {
         console.error('Load tracks error:', error);
     }
 }
 
+// Виртуализированная таблица треков (создается при первом обращении)
+let tracksTable = null;
+
+function getTracksTable() {
+    if (!tracksTable) {
+        tracksTable = new VirtualTable(document.getElementById('tracks-list'), {
+            columns: [
+                { label: 'Название', key: 'title' },
+                { label: 'Исполнитель', key: 'artist_name' },
+                { label: 'Жанр', key: 'genre_name' },
+                { label: 'BPM', key: 'bpm' },
+                { label: 'Длительность', key: 'duration_sec' },
+                { label: 'Дата создания', key: 'created_at' },
+                { label: 'Действия', key: null }
+            ],
+            filterKeys: ['title', 'artist_name', 'genre_name'],
+            emptyText: 'Нет треков',
+            // Администратор видит все треки, поэтому они подгружаются с сервера постранично
+            loadPage: pagedLoader('/tracks', 'track_id'),
+            renderRow: track => `<tr>
+                <td>${track.title}</td>
+                <td>${track.artist_name}</td>
+                <td>${track.genre_name}</td>
+                <td>${track.bpm || 'N/A'}</td>
+                <td>${formatDuration(track.duration_sec)}</td>
+                <td>${track.created_at ? new Date(track.created_at).toLocaleDateString('ru-RU') : 'N/A'}</td>
+                <td>
+                    <button class="btn btn-primary" onclick="showAddTrackToCollectionModal(${track.track_id})">В коллекцию</button>
+                    <button class="btn btn-secondary" onclick="showEditTrackModal(${track.track_id})">Редактировать</button>
+                    <button class="btn btn-danger" onclick="deleteTrack(${track.track_id})">Удалить</button>
+                </td>
+            </tr>`
+        });
+    }
+    return tracksTable;
+}
+
 // Отображение треков в таблице
 function displayTracks(tracks) {
-    const tbody = document.getElementById('tracks-tbody');
-    tbody.innerHTML = '';
-    
-    if (!tracks || tracks.length === 0) {
-        tbody.innerHTML = '<tr><td colspan="7">Нет треков</td></tr>';
-        return;
-    }
-    
-    tracks.forEach(track => {
-        const row = document.createElement('tr');
-        
-        const durationFormatted = formatDuration(track.duration_sec);
-        
-        row.innerHTML = `
-            <td>${track.title}</td>
-            <td>${track.artist_name}</td>
-            <td>${track.genre_name}</td>
-            <td>${track.bpm || 'N/A'}</td>
-            <td>${durationFormatted}</td>
-            <td>${track.created_at ? new Date(track.created_at).toLocaleDateString('ru-RU') : 'N/A'}</td>
-            <td>
-                <button class="btn btn-primary" onclick="showAddTrackToCollectionModal(${track.track_id})">В коллекцию</button>
-                <button class="btn btn-secondary" onclick="showEditTrackModal(${track.track_id})">Редактировать</button>
-                <button class="btn btn-danger" onclick="deleteTrack(${track.track_id})">Удалить</button>
-            </td>
-        `;
-        
-        tbody.appendChild(row);
-    });
+    const table = getTracksTable();
+    table.allRows = tracks || [];
+    table.hasMore = false;
+    table.applyView();
 }
 
 // Форматирование длительности (секунды в MM:SS)
@@ -603,9 +1201,12 @@ async function showAddTrackModal() {
 // Показать модальное окно редактирования трека
 async function showEditTrackModal(trackId) {
     try {
-        // Load current tracks to find the one to edit
-        const tracks = await apiRequest('/tracks');
-        const track = tracks.find(t => t.track_id === trackId);
+        // Take the track from the local store; admins may edit tracks outside it
+        let track = dataStore.tracks.get(trackId);
+        if (!track) {
+            const tracks = await apiRequest('/tracks');
+            track = tracks && tracks.find(t => t.track_id === trackId);
+        }
         
         if (!track) {
             alert('Трек не найден');
@@ -616,9 +1217,9 @@ async function showEditTrackModal(trackId) {
         if (allArtists.length === 0) await loadArtists();
         if (allGenres.length === 0) await loadGenres();
         
-        // Find artist_id and genre_id from names
-        const artist = allArtists.find(a => a.name === track.artist_name);
-        const genre = allGenres.find(g => g.name === track.genre_name);
+        // Store tracks carry ids; server listings only carry names
+        const artist = allArtists.find(a => a.artist_id === track.artist_id || a.name === track.artist_name);
+        const genre = allGenres.find(g => g.genre_id === track.genre_id || g.name === track.genre_name);
     
     const modalBody = document.getElementById('modal-body');
     modalBody.innerHTML = `
@@ -686,15 +1287,21 @@ async function saveTrack(e) {
     try {
         if (trackId) {
             // Редактирование
-            const result = await apiRequest(`/tracks/${trackId}`, {
-                method: 'PUT',
-                body: JSON.stringify(trackData)
-            });
+            const id = parseInt(trackId);
+            const result = await optimisticMutation(
+                () => {
+                    const track = dataStore.tracks.get(id);
+                    if (track) dataStore.tracks.set(id, { ...track, ...trackData });
+                },
+                () => apiRequest(`/tracks/${trackId}`, {
+                    method: 'PUT',
+                    body: JSON.stringify(trackData)
+                })
+            );
             
             if (result) {
                 alert('Трек успешно обновлен!');
     closeModal();
-                await loadUserTracks();
             }
         } else {
             // Добавление
@@ -704,9 +1311,16 @@ async function saveTrack(e) {
             });
             
             if (result && result.track_id) {
+                dataStore.tracks.set(result.track_id, {
+                    ...trackData,
+                    track_id: result.track_id,
+                    created_at: result.created_at,
+                    updated_at: result.created_at
+                });
+                commitLocalChange();
+                reconcileWithServer();
                 alert('Трек успешно добавлен!');
                 closeModal();
-                await loadUserTracks();
             } else {
                 const errorMsg = result?.message || 'Не удалось добавить трек. Проверьте, что все поля заполнены правильно.';
                 alert(`Ошибка: ${errorMsg}`);
@@ -724,31 +1338,129 @@ async function deleteTrack(trackId) {
     if (!confirm('Вы уверены, что хотите удалить этот трек?')) return;
 
     try {
-        const result = await apiRequest(`/tracks/${trackId}`, {
-            method: 'DELETE'
-        });
+        const result = await optimisticMutation(
+            () => removeStoreTrack(trackId),
+            () => apiRequest(`/tracks/${trackId}`, {
+                method: 'DELETE'
+            })
+        );
         
         if (result) {
             alert('Трек успешно удален!');
-            await loadUserTracks();
         }
     } catch (error) {
         console.error('Delete track error:', error);
     }
 }
 
-// Загрузка коллекций пользователя
-async function loadUserCollections() {
+// Группы дубликатов, показанные в модальном окне
+let duplicateClusters = [];
+
+// Поиск дубликатов среди треков пользователя (группировка выполняется на сервере)
+async function showDuplicatesModal() {
     try {
-        const collections = await apiRequest('/collections');
-        if (collections) {
-            // Load tracks for each collection
-            for (let collection of collections) {
-                // Note: Backend doesn't return tracks in collection, so we'll display basic info
-                collection.tracks = []; // Placeholder
+        // Без готового результата сервер запускает фоновое задание и возвращает его номер
+        const result = await apiRequest('/tracks/duplicates', { method: 'POST' });
+        if (!result) return;
+        let clusters = result;
+        if (result.job_id) {
+            const job = await waitForJob(result.job_id);
+            if (!job) return;
+            if (job.status !== 'done') {
+                alert(`Ошибка: ${job.error || 'Не удалось найти дубликаты'}`);
+                return;
             }
-    displayCollections(collections);
+            clusters = job.result;
+        }
+        duplicateClusters = clusters;
+        
+        const modalBody = document.getElementById('modal-body');
+        if (clusters.length === 0) {
+            modalBody.innerHTML = '<p>Дубликаты не найдены.</p>';
+        } else {
+            modalBody.innerHTML = clusters.map((cluster, index) => `
+                <div class="duplicate-cluster" id="duplicate-cluster-${index}">
+                    <table>
+                        <thead>
+                            <tr>
+                                <th>Название</th>
+                                <th>Исполнитель</th>
+                                <th>Длительность</th>
+                                <th>Коллекций</th>
+                                <th>Сходство</th>
+                                <th></th>
+                            </tr>
+                        </thead>
+                        <tbody>
+                            ${cluster.tracks.map(track => `<tr>
+                                <td>${track.title}</td>
+                                <td>${track.artist_name}</td>
+                                <td>${formatDuration(track.duration_sec)}</td>
+                                <td>${track.collections_count}</td>
+                                <td>${Math.round(track.similarity * 100)}%</td>
+                                <td>${track.track_id === cluster.keep_track_id ? '<strong>Оставить</strong>' : ''}</td>
+                            </tr>`).join('')}
+                        </tbody>
+                    </table>
+                    <button class="btn btn-danger" onclick="mergeDuplicateCluster(${index})">Объединить в отмеченный трек</button>
+                </div>
+            `).join('');
+        }
+        
+        document.getElementById('modal-title').textContent = `Дубликаты треков (групп: ${clusters.length})`;
+        showModal();
+    } catch (error) {
+        console.error('Find duplicates error:', error);
+        alert('Ошибка при поиске дубликатов');
+    }
+}
+
+// Объединение группы: коллекции дубликатов переходят к предложенному треку, дубликаты удаляются
+async function mergeDuplicateCluster(index) {
+    const cluster = duplicateClusters[index];
+    if (!cluster) return;
+    if (!confirm(`Удалить треков: ${cluster.duplicate_track_ids.length}? Останется трек, отмеченный "Оставить"; коллекции удаляемых треков будут перенесены на него.`)) return;
+    
+    const keepTrackId = cluster.keep_track_id;
+    try {
+        const result = await optimisticMutation(
+            () => {
+                // Состав умных коллекций пересчитывается на сервере
+                dataStore.collectionTracks.forEach((membership, collectionId) => {
+                    const collection = dataStore.collections.get(collectionId);
+                    if (collection && collection.is_smart) return;
+                    cluster.duplicate_track_ids.forEach(trackId => {
+                        if (membership.has(trackId) && !membership.has(keepTrackId)) {
+                            membership.set(keepTrackId, membership.get(trackId));
+                        }
+                    });
+                });
+                cluster.duplicate_track_ids.forEach(removeStoreTrack);
+            },
+            () => apiRequest('/tracks/duplicates/merge', {
+                method: 'POST',
+                body: JSON.stringify({
+                    keep_track_id: keepTrackId,
+                    duplicate_track_ids: cluster.duplicate_track_ids
+                })
+            })
+        );
+        if (result) {
+            document.getElementById(`duplicate-cluster-${index}`)?.remove();
         }
+    } catch (error) {
+        console.error('Merge duplicates error:', error);
+    }
+}
+
+// Коллекции, у которых раскрыт список треков (сохраняется между перерисовками)
+const expandedCollections = new Set();
+
+// Загрузка коллекций пользователя
+async function loadUserCollections() {
+    try {
+        await syncLibrary();
+        displayCollections(getStoreCollections());
     } catch (error) {
         console.error('Load collections error:', error);
     }
@@ -771,7 +1483,8 @@ function displayCollections(collections) {
         
         collectionDiv.innerHTML = `
             <div class="collection-header">
-                <div class="collection-name">${collection.name} ${collection.is_favorite ? '❤️' : ''}</div>
+                <div class="collection-name">${collection.name} ${collection.is_favorite ? '❤️' : ''} ${collection.is_smart ? '⚙️' : ''}</div>
+                ${collection.is_smart ? `<div class="collection-info">Правила: ${describeCollectionRules(collection.rules)}</div>` : ''}
                 <div class="collection-info">Создано: ${collection.created_at ? new Date(collection.created_at).toLocaleDateString('ru-RU') : 'N/A'}</div>
                 <div class="collection-info">Треков: <span id="tracks-count-${collection.collection_id}">${collection.tracks_count || 0}</span></div>
             </div>
@@ -789,9 +1502,67 @@ function displayCollections(collections) {
         `;
         
         container.appendChild(collectionDiv);
+        
+        if (expandedCollections.has(collection.collection_id)) {
+            document.getElementById(`tracks-list-${collection.collection_id}`).style.display = 'block';
+            document.getElementById(`toggle-btn-${collection.collection_id}`).textContent = 'Скрыть треки';
+            renderCollectionTracks(collection.collection_id);
+        }
     });
 }
 
+// Виртуализированные таблицы раскрытых коллекций
+const collectionTables = new Map();
+
+// Отображение треков коллекции из локального хранилища
+function renderCollectionTracks(collectionId) {
+    const tracksContent = document.getElementById(`tracks-content-${collectionId}`);
+    if (!tracksContent) return;
+    
+    const tracks = getStoreCollectionTracks(collectionId);
+    const isSmart = Boolean(dataStore.collections.get(collectionId)?.is_smart);
+    if (tracks.length === 0) {
+        collectionTables.delete(collectionId);
+        tracksContent.innerHTML = isSmart
+            ? '<p>Нет треков, подходящих под правила коллекции.</p>'
+            : '<p>В коллекции пока нет треков. Добавьте треки из списка "Мои треки".</p>';
+        return;
+    }
+    
+    // Таблица переиспользуется, пока ее контейнер не перерисован, чтобы сохранить прокрутку и сортировку
+    let table = collectionTables.get(collectionId);
+    if (table && table.isSmart !== isSmart) table = null;
+    if (!table || table.container !== tracksContent || !tracksContent.querySelector('.virtual-table')) {
+        table = new VirtualTable(tracksContent, {
+            columns: [
+                { label: 'Название', key: 'title' },
+                { label: 'Исполнитель', key: 'artist_name' },
+                { label: 'Жанр', key: 'genre_name' },
+                { label: 'BPM', key: 'bpm' },
+                { label: 'Длительность', key: 'duration_sec' },
+                { label: 'Добавлено', key: 'added_at' },
+                { label: 'Действия', key: null }
+            ],
+            filterKeys: ['title', 'artist_name', 'genre_name'],
+            emptyText: 'Нет треков',
+            renderRow: track => `<tr>
+                <td>${track.title}</td>
+                <td>${track.artist_name}</td>
+                <td>${track.genre_name}</td>
+                <td>${track.bpm || 'N/A'}</td>
+                <td>${formatDuration(track.duration_sec)}</td>
+                <td>${track.added_at ? new Date(track.added_at).toLocaleDateString('ru-RU') : 'N/A'}</td>
+                <td>${isSmart ? '' : `<button class="btn btn-sm btn-danger" onclick="removeTrackFromCollection(${collectionId}, ${track.track_id})">Удалить</button>`}</td>
+            </tr>`
+        });
+        // Состав умной коллекции задается правилами, удалять треки вручную нельзя
+        table.isSmart = isSmart;
+        collectionTables.set(collectionId, table);
+    }
+    table.allRows = tracks;
+    table.applyView();
+}
+
 // Переключение отображения треков коллекции (безопасная версия)
 async function toggleCollectionTracks(collectionId) {
     try {
@@ -805,38 +1576,13 @@ async function toggleCollectionTracks(collectionId) {
         }
         
         if (tracksList.style.display === 'none' || tracksList.style.display === '') {
-            // Загрузить треки
-            tracksContent.innerHTML = '<p>Загрузка...</p>';
+            // Показать треки из локального хранилища
+            expandedCollections.add(collectionId);
             tracksList.style.display = 'block';
             button.textContent = 'Скрыть треки';
-            
-            try {
-                const tracks = await apiRequest(`/collections/${collectionId}/tracks`);
-                if (tracks) {
-                    if (tracks.length === 0) {
-                        tracksContent.innerHTML = '<p>В коллекции пока нет треков. Добавьте треки из списка "Мои треки".</p>';
-                    } else {
-                        let html = '<table class="tracks-table"><thead><tr><th>Название</th><th>Исполнитель</th><th>Жанр</th><th>BPM</th><th>Длительность</th><th>Добавлено</th><th>Действия</th></tr></thead><tbody>';
-                        tracks.forEach(track => {
-                            html += `<tr>
-                                <td>${track.title}</td>
-                                <td>${track.artist_name}</td>
-                                <td>${track.genre_name}</td>
-                                <td>${track.bpm || 'N/A'}</td>
-                                <td>${formatDuration(track.duration_sec)}</td>
-                                <td>${track.added_at ? new Date(track.added_at).toLocaleDateString('ru-RU') : 'N/A'}</td>
-                                <td><button class="btn btn-sm btn-danger" onclick="removeTrackFromCollection(${collectionId}, ${track.track_id})">Удалить</button></td>
-                            </tr>`;
-                        });
-                        html += '</tbody></table>';
-                        tracksContent.innerHTML = html;
-                    }
-                }
-            } catch (error) {
-                console.error('Load collection tracks error:', error);
-                tracksContent.innerHTML = '<p>Ошибка при загрузке треков</p>';
-            }
+            renderCollectionTracks(collectionId);
         } else {
+            expandedCollections.delete(collectionId);
             tracksList.style.display = 'none';
             button.textContent = 'Показать треки';
         }
@@ -847,8 +1593,98 @@ async function toggleCollectionTracks(collectionId) {
 }
 
 
+// Правила умной коллекции: состав поддерживается сервером при изменении треков
+function collectionRulesFields(collection) {
+    const rules = collection?.rules || {};
+    const value = key => rules[key] ?? '';
+    return `
+            <div class="form-group">
+                <label>
+                    <input type="checkbox" id="collection-smart" ${collection?.is_smart ? 'checked' : ''}
+                           onchange="document.getElementById('collection-rules').style.display = this.checked ? 'block' : 'none'">
+                    Умная коллекция (треки подбираются по правилам)
+                </label>
+            </div>
+            <div id="collection-rules" style="display: ${collection?.is_smart ? 'block' : 'none'};">
+                <div class="form-group">
+                    <label for="rule-genre">Жанр:</label>
+                    <select id="rule-genre">
+                        <option value="">Любой</option>
+                        ${allGenres.map(genre => `<option value="${genre.genre_id}" ${genre.genre_id === rules.genre_id ? 'selected' : ''}>${genre.name}</option>`).join('')}
+                    </select>
+                </div>
+                <div class="form-group">
+                    <label for="rule-artist">Исполнитель:</label>
+                    <select id="rule-artist">
+                        <option value="">Любой</option>
+                        ${getStoreArtists().map(artist => `<option value="${artist.artist_id}" ${artist.artist_id === rules.artist_id ? 'selected' : ''}>${artist.name}</option>`).join('')}
+                    </select>
+                </div>
+                <div class="form-row">
+                    <div class="form-group">
+                        <label for="rule-bpm-min">BPM от:</label>
+                        <input type="number" id="rule-bpm-min" min="0" value="${value('bpm_min')}">
+                    </div>
+                    <div class="form-group">
+                        <label for="rule-bpm-max">BPM до:</label>
+                        <input type="number" id="rule-bpm-max" min="0" value="${value('bpm_max')}">
+                    </div>
+                </div>
+                <div class="form-row">
+                    <div class="form-group">
+                        <label for="rule-duration-min">Длительность от (сек):</label>
+                        <input type="number" id="rule-duration-min" min="0" value="${value('duration_min')}">
+                    </div>
+                    <div class="form-group">
+                        <label for="rule-duration-max">Длительность до (сек):</label>
+                        <input type="number" id="rule-duration-max" min="0" value="${value('duration_max')}">
+                    </div>
+                </div>
+                <div class="form-group">
+                    <label for="rule-title">Название содержит:</label>
+                    <input type="text" id="rule-title" maxlength="255" value="${String(value('title')).replace(/"/g, '&quot;')}">
+                </div>
+            </div>
+    `;
+}
+
+// Чтение правил из формы коллекции (null - обычная коллекция)
+function readCollectionRules() {
+    if (!document.getElementById('collection-smart').checked) return null;
+    
+    const number = id => {
+        const value = document.getElementById(id).value;
+        return value === '' ? null : parseInt(value);
+    };
+    return {
+        genre_id: number('rule-genre'),
+        artist_id: number('rule-artist'),
+        bpm_min: number('rule-bpm-min'),
+        bpm_max: number('rule-bpm-max'),
+        duration_min: number('rule-duration-min'),
+        duration_max: number('rule-duration-max'),
+        title: document.getElementById('rule-title').value.trim() || null
+    };
+}
+
+// Краткое описание правил для списка коллекций
+function describeCollectionRules(rules) {
+    if (!rules) return '';
+    const parts = [];
+    if (rules.genre_id) parts.push(`жанр: ${dataStore.genres.get(rules.genre_id)?.name || rules.genre_id}`);
+    if (rules.artist_id) parts.push(`исполнитель: ${dataStore.artists.get(rules.artist_id)?.name || rules.artist_id}`);
+    if (rules.bpm_min !== null || rules.bpm_max !== null) parts.push(`BPM ${rules.bpm_min ?? '…'}–${rules.bpm_max ?? '…'}`);
+    if (rules.duration_min !== null || rules.duration_max !== null) {
+        parts.push(`длительность ${rules.duration_min ?? '…'}–${rules.duration_max ?? '…'} сек`);
+    }
+    if (rules.title) parts.push(`название содержит «${rules.title}»`);
+    return parts.join(', ');
+}
+
 // Показать модальное окно добавления коллекции
-function showAddCollectionModal() {
+async function showAddCollectionModal() {
+    if (allGenres.length === 0) await loadGenres();
+    
     const modalBody = document.getElementById('modal-body');
     modalBody.innerHTML = `
         <form id="collection-form">
@@ -862,6 +1698,7 @@ function showAddCollectionModal() {
                     Сделать коллекцией "Любимые треки"
                 </label>
             </div>
+            ${collectionRulesFields(null)}
             <div class="form-group">
                 <button type="submit" class="btn btn-primary">Создать</button>
                 <button type="button" class="btn btn-secondary" onclick="closeModal()">Отмена</button>
@@ -900,6 +1737,13 @@ async function saveCollection(e) {
         is_favorite: document.getElementById('collection-favorite').checked
     };
     
+    // Правила отправляются при создании умной коллекции и при любом изменении ее типа или правил
+    const rules = readCollectionRules();
+    const wasSmart = Boolean(collectionId && dataStore.collections.get(parseInt(collectionId))?.is_smart);
+    if (rules || wasSmart) {
+        collectionData.rules = rules;
+    }
+    
     if (!collectionData.name) {
         alert('Название коллекции обязательно');
         if (submitButton) {
@@ -912,15 +1756,23 @@ async function saveCollection(e) {
     try {
         if (collectionId) {
             // Редактирование
-            const result = await apiRequest(`/collections/${collectionId}`, {
-                method: 'PUT',
-                body: JSON.stringify(collectionData)
-            });
+            const id = parseInt(collectionId);
+            const result = await optimisticMutation(
+                () => {
+                    if (collectionData.is_favorite) clearFavoriteCollection();
+                    const updated = { ...dataStore.collections.get(id), ...collectionData };
+                    if ('rules' in collectionData) updated.is_smart = Boolean(rules);
+                    dataStore.collections.set(id, updated);
+                },
+                () => apiRequest(`/collections/${collectionId}`, {
+                    method: 'PUT',
+                    body: JSON.stringify(collectionData)
+                })
+            );
             
             if (result) {
                 alert('Коллекция успешно обновлена!');
                 closeModal();
-                await loadUserCollections();
             }
         } else {
             // Создание
@@ -930,9 +1782,12 @@ async function saveCollection(e) {
             });
             
             if (result && result.collection_id) {
+                if (result.is_favorite) clearFavoriteCollection();
+                dataStore.collections.set(result.collection_id, { ...result, is_smart: Boolean(rules), rules });
+                commitLocalChange();
+                reconcileWithServer();
                 alert('Коллекция успешно создана!');
                 closeModal();
-                await loadUserCollections();
             } else {
                 const errorMsg = result?.message || 'Не удалось создать коллекцию';
                 alert(`Ошибка: ${errorMsg}`);
@@ -950,16 +1805,25 @@ async function saveCollection(e) {
     }
 }
 
+// Снять отметку "Любимые треки" со всех коллекций (она может быть только у одной)
+function clearFavoriteCollection() {
+    dataStore.collections.forEach((collection, id) => {
+        if (collection.is_favorite) {
+            dataStore.collections.set(id, { ...collection, is_favorite: false });
+        }
+    });
+}
+
 // Показать модальное окно редактирования коллекции
 async function showEditCollectionModal(collectionId) {
     try {
-        const collections = await apiRequest('/collections');
-        const collection = collections.find(c => c.collection_id === collectionId);
+        const collection = dataStore.collections.get(collectionId);
         
         if (!collection) {
             alert('Коллекция не найдена');
             return;
         }
+        if (allGenres.length === 0) await loadGenres();
         
         const modalBody = document.getElementById('modal-body');
         modalBody.innerHTML = `
@@ -975,6 +1839,7 @@ async function showEditCollectionModal(collectionId) {
                         Сделать коллекцией "Любимые треки"
                     </label>
                 </div>
+                ${collectionRulesFields(collection)}
                 <div class="form-group">
                     <button type="submit" class="btn btn-primary">Сохранить</button>
                     <button type="button" class="btn btn-secondary" onclick="closeModal()">Отмена</button>
@@ -1001,13 +1866,19 @@ async function deleteCollection(collectionId) {
     if (!confirm('Вы уверены, что хотите удалить эту коллекцию?')) return;
 
     try {
-        const result = await apiRequest(`/collections/${collectionId}`, {
-            method: 'DELETE'
-        });
+        const result = await optimisticMutation(
+            () => {
+                dataStore.collections.delete(collectionId);
+                dataStore.collectionTracks.delete(collectionId);
+                expandedCollections.delete(collectionId);
+            },
+            () => apiRequest(`/collections/${collectionId}`, {
+                method: 'DELETE'
+            })
+        );
         
         if (result) {
             alert('Коллекция успешно удалена!');
-            await loadUserCollections();
         }
     } catch (error) {
         console.error('Delete collection error:', error);
@@ -1015,6 +1886,39 @@ async function deleteCollection(collectionId) {
 }
 
 // Выполнение поиска
+// Подсказки при вводе (индекс названий на сервере, без обращения к базе данных)
+const AUTOCOMPLETE_DELAY_MS = 100;
+
+function setupAutocomplete(inputId, datalistId, entities) {
+    const input = document.getElementById(inputId);
+    const datalist = document.getElementById(datalistId);
+    let timer = null;
+    let lastPrefix = '';
+    
+    input.addEventListener('input', () => {
+        clearTimeout(timer);
+        timer = setTimeout(async () => {
+            const prefix = input.value.trim();
+            if (prefix === lastPrefix) return;
+            lastPrefix = prefix;
+            
+            if (!prefix) {
+                datalist.innerHTML = '';
+                return;
+            }
+            
+            const params = new URLSearchParams({ q: prefix, entities });
+            const suggestions = await apiRequest(`/autocomplete?${params.toString()}`);
+            // Ответ мог устареть, пока пользователь продолжал ввод
+            if (!suggestions || input.value.trim() !== prefix) return;
+            
+            datalist.innerHTML = suggestions
+                .map(s => `<option value="${s.name.replace(/"/g, '&quot;')}"></option>`)
+                .join('');
+        }, AUTOCOMPLETE_DELAY_MS);
+    });
+}
+
 async function performSearch() {
     const title = document.getElementById('search-title').value.trim() || null;
     const artist = document.getElementById('search-artist').value.trim() || null;
@@ -1083,10 +1987,10 @@ function resetSearch() {
 // Показать модальное окно добавления трека в коллекцию
 async function showAddTrackToCollectionModal(trackId) {
     try {
-        // Загрузить список коллекций пользователя
-        const collections = await apiRequest('/collections');
-        if (!collections || collections.length === 0) {
-            alert('У вас нет коллекций. Создайте коллекцию сначала!');
+        // Список обычных коллекций пользователя из локального хранилища (умные заполняются по правилам)
+        const collections = getStoreCollections().filter(c => !c.is_smart);
+        if (collections.length === 0) {
+            alert('У вас нет коллекций, в которые можно добавить трек. Создайте коллекцию сначала!');
             return;
         }
         
@@ -1127,16 +2031,17 @@ async function showAddTrackToCollectionModal(trackId) {
 // Добавление трека в коллекцию
 async function addTrackToCollection(collectionId, trackId) {
     try {
-        const result = await apiRequest(`/collections/${collectionId}/tracks`, {
-            method: 'POST',
-            body: JSON.stringify({ track_id: trackId })
-        });
+        const result = await optimisticMutation(
+            () => getCollectionMembership(collectionId).set(trackId, new Date().toISOString()),
+            () => apiRequest(`/collections/${collectionId}/tracks`, {
+                method: 'POST',
+                body: JSON.stringify({ track_id: trackId })
+            })
+        );
         
         if (result) {
             alert('Трек успешно добавлен в коллекцию!');
             closeModal();
-            // Обновить список коллекций, чтобы обновить счетчики
-            await loadUserCollections();
         }
     } catch (error) {
         console.error('Add track to collection error:', error);
@@ -1150,21 +2055,15 @@ async function removeTrackFromCollection(collectionId, trackId) {
     if (!confirm('Удалить трек из коллекции?')) return;
 
     try {
-        const result = await apiRequest(`/collections/${collectionId}/tracks/${trackId}`, {
-            method: 'DELETE'
-        });
+        const result = await optimisticMutation(
+            () => getCollectionMembership(collectionId).delete(trackId),
+            () => apiRequest(`/collections/${collectionId}/tracks/${trackId}`, {
+                method: 'DELETE'
+            })
+        );
         
         if (result) {
             alert('Трек удален из коллекции');
-            // Обновить список треков в коллекции, если он открыт
-            const tracksList = document.getElementById(`tracks-list-${collectionId}`);
-            if (tracksList && tracksList.style.display !== 'none') {
-                // Перезагрузить треки
-                await toggleCollectionTracks(collectionId); // Скрыть
-                await toggleCollectionTracks(collectionId); // Показать снова (загрузит заново)
-            }
-            // Обновить счетчик
-            await loadUserCollections();
         }
     } catch (error) {
         console.error('Remove track from collection error:', error);
@@ -1194,6 +2093,9 @@ function switchAdminTab(tabName) {
         case 'audit':
             loadAdminAudit();
             break;
+        case 'stats':
+            loadAdminAuditStats();
+            break;
     }
 }
 
@@ -1228,64 +2130,120 @@ async function loadAdminUsers() {
     }
 }
 
-// Загрузка всех треков для админ-панели
+// Загрузка всех треков для админ-панели (постранично, по мере прокрутки)
 async function loadAdminTracks() {
     if (!isAdmin) return;
     
     try {
-        const tracks = await apiRequest('/admin/tracks');
-        if (tracks) {
-            const adminContent = document.querySelector('.admin-content');
-            let html = '<h3>Все треки</h3><table class="admin-table"><thead><tr><th>ID</th><th>Название</th><th>Исполнитель</th><th>Жанр</th><th>BPM</th><th>Длительность</th><th>Пользователь</th><th>Дата создания</th></tr></thead><tbody>';
-            
-            tracks.forEach(track => {
-                html += `<tr>
-                    <td>${track.track_id}</td>
-                    <td>${track.title}</td>
-                    <td>${track.artist_name}</td>
-                    <td>${track.genre_name}</td>
-                    <td>${track.bpm || 'N/A'}</td>
-                    <td>${formatDuration(track.duration_sec)}</td>
-                    <td>${track.user_login || 'N/A'}</td>
-                    <td>${track.created_at ? new Date(track.created_at).toLocaleDateString('ru-RU') : 'N/A'}</td>
-                </tr>`;
-            });
-            
-            html += '</tbody></table>';
-            adminContent.innerHTML = html;
-        }
+        const adminContent = document.querySelector('.admin-content');
+        adminContent.innerHTML = '<h3>Все треки</h3><div class="admin-table-container"></div>';
+        const table = new VirtualTable(adminContent.querySelector('.admin-table-container'), {
+            columns: [
+                { label: 'ID', key: 'track_id' },
+                { label: 'Название', key: 'title' },
+                { label: 'Исполнитель', key: 'artist_name' },
+                { label: 'Жанр', key: 'genre_name' },
+                { label: 'BPM', key: 'bpm' },
+                { label: 'Длительность', key: 'duration_sec' },
+                { label: 'Пользователь', key: 'user_login' },
+                { label: 'Дата создания', key: 'created_at' }
+            ],
+            filterKeys: ['title', 'artist_name', 'genre_name', 'user_login'],
+            emptyText: 'Нет треков',
+            loadPage: pagedLoader('/admin/tracks', 'track_id'),
+            renderRow: track => `<tr>
+                <td>${track.track_id}</td>
+                <td>${track.title}</td>
+                <td>${track.artist_name}</td>
+                <td>${track.genre_name}</td>
+                <td>${track.bpm || 'N/A'}</td>
+                <td>${formatDuration(track.duration_sec)}</td>
+                <td>${track.user_login || 'N/A'}</td>
+                <td>${track.created_at ? new Date(track.created_at).toLocaleDateString('ru-RU') : 'N/A'}</td>
+            </tr>`
+        });
+        await table.reload();
     } catch (error) {
         console.error('Load admin tracks error:', error);
     }
 }
 
-// Загрузка журнала аудита
+// Загрузка журнала аудита (постранично, по мере прокрутки)
 async function loadAdminAudit() {
     if (!isAdmin) return;
     
     try {
-        const auditLog = await apiRequest('/admin/audit');
-        if (auditLog) {
-            const adminContent = document.querySelector('.admin-content');
-            let html = '<h3>Журнал операций</h3><table class="admin-table"><thead><tr><th>ID</th><th>Пользователь</th><th>Тип операции</th><th>Таблица</th><th>ID записи</th><th>Время</th><th>Детали</th></tr></thead><tbody>';
-            
-            auditLog.forEach(entry => {
-                html += `<tr>
-                    <td>${entry.log_id}</td>
-                    <td>${entry.user_login || 'N/A'}</td>
-                    <td>${entry.operation_type}</td>
-                    <td>${entry.table_name}</td>
-                    <td>${entry.record_id || 'N/A'}</td>
-                    <td>${entry.operation_time ? new Date(entry.operation_time).toLocaleString('ru-RU') : 'N/A'}</td>
-                    <td>${entry.details ? JSON.stringify(entry.details) : 'N/A'}</td>
-                </tr>`;
+        const adminContent = document.querySelector('.admin-content');
+        adminContent.innerHTML = '<h3>Журнал операций</h3><div class="admin-table-container"></div>';
+        const table = new VirtualTable(adminContent.querySelector('.admin-table-container'), {
+            columns: [
+                { label: 'ID', key: 'log_id' },
+                { label: 'Пользователь', key: 'user_login' },
+                { label: 'Тип операции', key: 'operation_type' },
+                { label: 'Таблица', key: 'table_name' },
+                { label: 'ID записи', key: 'record_id' },
+                { label: 'Время', key: 'operation_time' },
+                { label: 'Детали', key: null }
+            ],
+            filterKeys: ['user_login', 'operation_type', 'table_name'],
+            emptyText: 'Журнал пуст',
+            loadPage: pagedLoader('/admin/audit', 'log_id'),
+            renderRow: entry => `<tr>
+                <td>${entry.log_id}</td>
+                <td>${entry.user_login || 'N/A'}</td>
+                <td>${entry.operation_type}</td>
+                <td>${entry.table_name}</td>
+                <td>${entry.record_id || 'N/A'}</td>
+                <td>${entry.operation_time ? new Date(entry.operation_time).toLocaleString('ru-RU') : 'N/A'}</td>
+                <td>${entry.details ? JSON.stringify(entry.details) : 'N/A'}</td>
+            </tr>`
+        });
+        await table.reload();
+    } catch (error) {
+        console.error('Load admin audit error:', error);
+    }
+}
+
+// Статистика операций по дням или часам (из агрегатов журнала аудита)
+async function loadAdminAuditStats(granularity = 'day') {
+    if (!isAdmin) return;
+    
+    try {
+        const stats = await apiRequest(`/admin/audit/stats?granularity=${granularity}&group_by=table,operation`);
+        if (!stats) return;
+        
+        // Сводная таблица: строка - интервал, столбец - таблица и тип операции
+        const columns = [...new Set(stats.series.map(row => `${row.table_name}: ${row.operation_type}`))].sort();
+        const buckets = new Map();
+        stats.series.forEach(row => {
+            if (!buckets.has(row.bucket)) buckets.set(row.bucket, {});
+            buckets.get(row.bucket)[`${row.table_name}: ${row.operation_type}`] = row.operation_count;
+        });
+        
+        const formatBucket = bucket => granularity === 'hour'
+            ? new Date(bucket).toLocaleString('ru-RU')
+            : new Date(bucket).toLocaleDateString('ru-RU');
+        
+        let html = `<h3>Статистика операций</h3>
+            <div class="section-controls">
+                <button class="btn ${granularity === 'day' ? 'btn-primary' : 'btn-secondary'}" onclick="loadAdminAuditStats('day')">По дням (30 дней)</button>
+                <button class="btn ${granularity === 'hour' ? 'btn-primary' : 'btn-secondary'}" onclick="loadAdminAuditStats('hour')">По часам (48 часов)</button>
+            </div>`;
+        
+        if (buckets.size === 0) {
+            html += '<p>Нет операций за период</p>';
+        } else {
+            html += `<table class="admin-table"><thead><tr><th>Период</th>${columns.map(c => `<th>${c}</th>`).join('')}<th>Всего</th></tr></thead><tbody>`;
+            buckets.forEach((counts, bucket) => {
+                const total = Object.values(counts).reduce((sum, count) => sum + count, 0);
+                html += `<tr><td>${formatBucket(bucket)}</td>${columns.map(c => `<td>${counts[c] || 0}</td>`).join('')}<td>${total}</td></tr>`;
             });
-            
             html += '</tbody></table>';
-            adminContent.innerHTML = html;
         }
+        
+        document.querySelector('.admin-content').innerHTML = html;
     } catch (error) {
-        console.error('Load admin audit error:', error);
+        console.error('Load audit stats error:', error);
     }
 }
 
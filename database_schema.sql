@@ -3,6 +3,9 @@
 -- Включение расширения для шифрования паролей
 CREATE EXTENSION IF NOT EXISTS pgcrypto;
 
+-- Включение расширения для составных GiST-индексов (user_id + признаки трека)
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+
 -- Таблица пользователей
 CREATE TABLE IF NOT EXISTS "user" (
     user_id SERIAL PRIMARY KEY,
@@ -31,6 +34,7 @@ CREATE TABLE IF NOT EXISTS artists (
     user_id INTEGER NOT NULL,
     name VARCHAR(100) NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (user_id) REFERENCES "user"(user_id) ON DELETE CASCADE,
     UNIQUE(user_id, name) -- Один и тот же автор может быть у разных пользователей, но у одного пользователя имя должно быть уникальным
 );
@@ -44,22 +48,51 @@ CREATE TABLE IF NOT EXISTS tracks (
     bpm INTEGER,
     duration_sec INTEGER,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     user_id INTEGER NOT NULL,
     FOREIGN KEY (artist_id) REFERENCES artists(artist_id) ON DELETE CASCADE,
     FOREIGN KEY (genre_id) REFERENCES genres(genre_id) ON DELETE RESTRICT,
     FOREIGN KEY (user_id) REFERENCES "user"(user_id) ON DELETE CASCADE
 );
 
+-- Точка признаков трека для поиска похожих треков: BPM и длительность,
+-- приведенная к масштабу BPM (4 секунды длительности ~ 1 BPM)
+CREATE OR REPLACE FUNCTION track_features(p_bpm INTEGER, p_duration_sec INTEGER)
+RETURNS POINT AS $$
+    SELECT point(p_bpm::FLOAT8, p_duration_sec::FLOAT8 / 4.0);
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Индекс для упорядоченного поиска ближайших соседей (ORDER BY ... <-> ... LIMIT k)
+CREATE INDEX IF NOT EXISTS idx_tracks_features_knn
+    ON tracks USING gist (user_id, track_features(bpm, duration_sec))
+    WHERE bpm IS NOT NULL AND duration_sec IS NOT NULL;
+
 -- Таблица коллекций
 CREATE TABLE IF NOT EXISTS collections (
     collection_id SERIAL PRIMARY KEY,
     user_id INTEGER NOT NULL,
     name VARCHAR(255) NOT NULL,
     is_favorite BOOLEAN DEFAULT FALSE,
+    -- Умная коллекция: состав определяется правилами (NULL - правило не задано)
+    -- и поддерживается триггерами при изменении треков
+    is_smart BOOLEAN DEFAULT FALSE,
+    rule_genre_id INTEGER,
+    rule_artist_id INTEGER,
+    rule_bpm_min INTEGER,
+    rule_bpm_max INTEGER,
+    rule_duration_min INTEGER,
+    rule_duration_max INTEGER,
+    rule_title VARCHAR(255), -- подстрока названия (без учета регистра)
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (user_id) REFERENCES "user"(user_id) ON DELETE CASCADE
 );
 
+-- Умные коллекции пользователя перебираются при каждом изменении его треков
+CREATE INDEX IF NOT EXISTS idx_collections_smart
+    ON collections (user_id)
+    WHERE is_smart;
+
 -- Таблица связи коллекций и треков
 CREATE TABLE IF NOT EXISTS collection_tracks (
     collection_id INTEGER,
@@ -114,6 +147,21 @@ CREATE TRIGGER update_user_updated_at
     FOR EACH ROW 
     EXECUTE FUNCTION update_updated_at_column();
 
+CREATE TRIGGER update_artists_updated_at 
+    BEFORE UPDATE ON artists 
+    FOR EACH ROW 
+    EXECUTE FUNCTION update_updated_at_column();
+
+CREATE TRIGGER update_tracks_updated_at 
+    BEFORE UPDATE ON tracks 
+    FOR EACH ROW 
+    EXECUTE FUNCTION update_updated_at_column();
+
+CREATE TRIGGER update_collections_updated_at 
+    BEFORE UPDATE ON collections 
+    FOR EACH ROW 
+    EXECUTE FUNCTION update_updated_at_column();
+
 -- Триггеры для аудита операций
 
 -- Триггер для аудита операций с треками
@@ -175,6 +223,343 @@ CREATE TRIGGER audit_users_trigger
     AFTER INSERT OR UPDATE OR DELETE ON "user"
     FOR EACH ROW EXECUTE FUNCTION audit_user_operations();
 
+-- Агрегаты журнала аудита (по часам и по дням) для статистики админ-панели
+-- Ключ: начало интервала, таблица, тип операции и пользователь (0 - без пользователя)
+CREATE TABLE IF NOT EXISTS audit_rollup_hourly (
+    bucket TIMESTAMP NOT NULL,
+    table_name VARCHAR(50) NOT NULL,
+    operation_type VARCHAR(20) NOT NULL,
+    user_id INTEGER NOT NULL DEFAULT 0,
+    operation_count BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, table_name, operation_type, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS audit_rollup_daily (
+    bucket DATE NOT NULL,
+    table_name VARCHAR(50) NOT NULL,
+    operation_type VARCHAR(20) NOT NULL,
+    user_id INTEGER NOT NULL DEFAULT 0,
+    operation_count BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, table_name, operation_type, user_id)
+);
+
+-- Состояние заполнения агрегатов записями, существовавшими до создания триггера:
+-- записи с log_id <= upto учитываются процедурой backfill_audit_rollups(), position - уже учтенные
+CREATE TABLE IF NOT EXISTS audit_rollup_backfill (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    position INTEGER NOT NULL DEFAULT 0,
+    upto INTEGER NOT NULL
+);
+
+-- Триггер инкрементального обновления агрегатов при записи в журнал аудита
+CREATE OR REPLACE FUNCTION rollup_audit_log()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO audit_rollup_hourly (bucket, table_name, operation_type, user_id, operation_count)
+    VALUES (date_trunc('hour', NEW.operation_time), NEW.table_name, NEW.operation_type, COALESCE(NEW.user_id, 0), 1)
+    ON CONFLICT (bucket, table_name, operation_type, user_id)
+    DO UPDATE SET operation_count = audit_rollup_hourly.operation_count + 1;
+    
+    INSERT INTO audit_rollup_daily (bucket, table_name, operation_type, user_id, operation_count)
+    VALUES (NEW.operation_time::date, NEW.table_name, NEW.operation_type, COALESCE(NEW.user_id, 0), 1)
+    ON CONFLICT (bucket, table_name, operation_type, user_id)
+    DO UPDATE SET operation_count = audit_rollup_daily.operation_count + 1;
+    
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+-- Триггер и граница заполнения создаются одной командой (блок DO атомарен и не управляет
+-- транзакцией сам, поэтому файл можно выполнять и через psql -1): CREATE TRIGGER блокирует
+-- запись в audit_log до конца транзакции, поэтому каждая запись учитывается ровно один раз -
+-- триггером или заполнением
+DO $$
+BEGIN
+    CREATE TRIGGER rollup_audit_log_trigger
+        AFTER INSERT ON audit_log
+        FOR EACH ROW EXECUTE FUNCTION rollup_audit_log();
+    
+    INSERT INTO audit_rollup_backfill (upto)
+    SELECT COALESCE(MAX(log_id), 0) FROM audit_log
+    ON CONFLICT (id) DO NOTHING;
+END;
+$$;
+
+-- Очередь фоновых заданий (тяжелые удаления, заполнение агрегатов и т.п.)
+-- Обработчики сервера забирают задания через FOR UPDATE SKIP LOCKED; выполняемое задание
+-- держит аренду (locked_until), задание упавшего обработчика забирается повторно после ее истечения
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id SERIAL PRIMARY KEY,
+    job_type VARCHAR(50) NOT NULL,
+    user_id INTEGER, -- инициатор; без внешнего ключа, чтобы история заданий переживала удаление данных
+    payload JSONB NOT NULL DEFAULT '{}',
+    dedup_key VARCHAR(255), -- одно незавершенное задание на ключ
+    status VARCHAR(20) NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'done', 'failed')),
+    progress JSONB,
+    result JSONB,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_until TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_jobs_queued
+    ON jobs (run_after, job_id)
+    WHERE status = 'queued';
+
+CREATE INDEX IF NOT EXISTS idx_jobs_running
+    ON jobs (locked_until)
+    WHERE status = 'running';
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_dedup
+    ON jobs (job_type, dedup_key)
+    WHERE status IN ('queued', 'running');
+
+-- Журнал изменений библиотеки и уведомления (LISTEN/NOTIFY, канал library_changes)
+
+-- Последовательность версий изменений: каждое событие получает новую версию
+CREATE SEQUENCE IF NOT EXISTS library_change_seq;
+
+-- Журнал изменений для дельта-синхронизации (включая удаления)
+-- txid - транзакция изменения; курсор синхронизации - xmin снимка, поэтому
+-- изменения еще не зафиксированных транзакций не будут пропущены
+CREATE TABLE IF NOT EXISTS library_changes (
+    change_id BIGINT PRIMARY KEY DEFAULT nextval('library_change_seq'),
+    txid BIGINT NOT NULL DEFAULT txid_current(),
+    user_id INTEGER NOT NULL,
+    entity VARCHAR(50) NOT NULL, -- 'tracks', 'artists', 'collections', 'collection_tracks'
+    entity_id INTEGER NOT NULL,
+    collection_id INTEGER, -- для collection_tracks
+    operation VARCHAR(20) NOT NULL, -- 'INSERT', 'UPDATE', 'DELETE'
+    changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_library_changes_user_txid
+    ON library_changes (user_id, txid);
+
+CREATE INDEX IF NOT EXISTS idx_library_changes_changed_at
+    ON library_changes (changed_at);
+
+-- Граница журнала изменений: записи транзакций с txid < min_txid удалены процедурой
+-- prune_library_changes(), поэтому курсор синхронизации меньше границы не принимается
+CREATE TABLE IF NOT EXISTS library_changes_horizon (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    min_txid BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO library_changes_horizon (id) VALUES (TRUE)
+ON CONFLICT (id) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION notify_library_change()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_row RECORD;
+    v_user_id INTEGER;
+    v_entity_id INTEGER;
+    v_collection_id INTEGER;
+    v_name TEXT;
+    v_version BIGINT;
+BEGIN
+    IF (TG_OP = 'DELETE') THEN
+        v_row := OLD;
+    ELSE
+        v_row := NEW;
+    END IF;
+    
+    IF TG_TABLE_NAME = 'tracks' THEN
+        v_user_id := v_row.user_id;
+        v_entity_id := v_row.track_id;
+        v_name := v_row.title;
+    ELSIF TG_TABLE_NAME = 'artists' THEN
+        v_user_id := v_row.user_id;
+        v_entity_id := v_row.artist_id;
+        v_name := v_row.name;
+    ELSIF TG_TABLE_NAME = 'collections' THEN
+        v_user_id := v_row.user_id;
+        v_entity_id := v_row.collection_id;
+        v_name := v_row.name;
+    ELSIF TG_TABLE_NAME = 'collection_tracks' THEN
+        -- При каскадном удалении коллекции ее строки уже нет: событие удаления коллекции покрывает состав
+        SELECT c.user_id INTO v_user_id
+        FROM collections c
+        WHERE c.collection_id = v_row.collection_id;
+        v_entity_id := v_row.track_id;
+        v_collection_id := v_row.collection_id;
+    END IF;
+    
+    IF v_user_id IS NOT NULL THEN
+        INSERT INTO library_changes (user_id, entity, entity_id, collection_id, operation)
+        VALUES (v_user_id, TG_TABLE_NAME, v_entity_id, v_collection_id, TG_OP)
+        RETURNING change_id INTO v_version;
+        
+        -- Уведомление доставляется слушателям только после фиксации транзакции
+        PERFORM pg_notify('library_changes', json_build_object(
+            'user_id', v_user_id,
+            'entity', TG_TABLE_NAME,
+            'id', v_entity_id,
+            'collection_id', v_collection_id,
+            'operation', TG_OP,
+            'version', v_version,
+            'name', v_name
+        )::TEXT);
+    END IF;
+    
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER notify_tracks_changes
+    AFTER INSERT OR UPDATE OR DELETE ON tracks
+    FOR EACH ROW EXECUTE FUNCTION notify_library_change();
+
+CREATE TRIGGER notify_artists_changes
+    AFTER INSERT OR UPDATE OR DELETE ON artists
+    FOR EACH ROW EXECUTE FUNCTION notify_library_change();
+
+CREATE TRIGGER notify_collections_changes
+    AFTER INSERT OR UPDATE OR DELETE ON collections
+    FOR EACH ROW EXECUTE FUNCTION notify_library_change();
+
+CREATE TRIGGER notify_collection_tracks_changes
+    AFTER INSERT OR UPDATE OR DELETE ON collection_tracks
+    FOR EACH ROW EXECUTE FUNCTION notify_library_change();
+
+-- Умные коллекции: проверка трека по правилам коллекции
+-- Правило названия - подстрока без учета регистра: strpos, а не ILIKE, чтобы символы % и _
+-- в правиле (например, "100%") не работали как шаблон. STABLE, а не IMMUTABLE: приведение
+-- регистра зависит от локали базы данных, а в индексах функция не используется
+CREATE OR REPLACE FUNCTION smart_collection_matches(p_collection collections, p_track tracks)
+RETURNS BOOLEAN AS $$
+    SELECT COALESCE(
+        (p_collection.rule_genre_id IS NULL OR p_track.genre_id = p_collection.rule_genre_id)
+        AND (p_collection.rule_artist_id IS NULL OR p_track.artist_id = p_collection.rule_artist_id)
+        AND (p_collection.rule_bpm_min IS NULL OR p_track.bpm >= p_collection.rule_bpm_min)
+        AND (p_collection.rule_bpm_max IS NULL OR p_track.bpm <= p_collection.rule_bpm_max)
+        AND (p_collection.rule_duration_min IS NULL OR p_track.duration_sec >= p_collection.rule_duration_min)
+        AND (p_collection.rule_duration_max IS NULL OR p_track.duration_sec <= p_collection.rule_duration_max)
+        AND (p_collection.rule_title IS NULL OR strpos(lower(p_track.title), lower(p_collection.rule_title)) > 0),
+        false
+    );
+$$ LANGUAGE sql STABLE;
+
+-- Пересчет состава умной коллекции по всем трекам владельца (при создании и изменении правил)
+CREATE OR REPLACE FUNCTION refresh_smart_collection(p_collection_id INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    v_collection collections;
+    v_count INTEGER;
+BEGIN
+    SELECT * INTO v_collection
+    FROM collections c
+    WHERE c.collection_id = p_collection_id AND c.is_smart;
+    
+    IF NOT FOUND THEN
+        RETURN 0;
+    END IF;
+    
+    DELETE FROM collection_tracks ct
+    USING tracks t
+    WHERE ct.collection_id = p_collection_id
+      AND ct.track_id = t.track_id
+      AND NOT smart_collection_matches(v_collection, t);
+    
+    INSERT INTO collection_tracks (collection_id, track_id)
+    SELECT p_collection_id, t.track_id
+    FROM tracks t
+    WHERE t.user_id = v_collection.user_id
+      AND smart_collection_matches(v_collection, t)
+    ON CONFLICT (collection_id, track_id) DO NOTHING;
+    
+    SELECT COUNT(*) INTO v_count
+    FROM collection_tracks ct
+    WHERE ct.collection_id = p_collection_id;
+    
+    RETURN v_count;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Инкрементальное обновление умных коллекций владельца при добавлении и изменении трека
+-- (удаление трека убирает его из коллекций каскадно)
+CREATE OR REPLACE FUNCTION maintain_smart_collections()
+RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM collection_tracks ct
+    USING collections c
+    WHERE ct.collection_id = c.collection_id
+      AND ct.track_id = NEW.track_id
+      AND c.user_id = NEW.user_id
+      AND c.is_smart
+      AND NOT smart_collection_matches(c, NEW);
+    
+    INSERT INTO collection_tracks (collection_id, track_id)
+    SELECT c.collection_id, NEW.track_id
+    FROM collections c
+    WHERE c.user_id = NEW.user_id
+      AND c.is_smart
+      AND smart_collection_matches(c, NEW)
+    ON CONFLICT (collection_id, track_id) DO NOTHING;
+    
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER maintain_smart_collections_trigger
+    AFTER INSERT OR UPDATE OF title, artist_id, genre_id, bpm, duration_sec ON tracks
+    FOR EACH ROW EXECUTE FUNCTION maintain_smart_collections();
+
+-- Пересчет состава при создании умной коллекции и изменении ее правил
+CREATE OR REPLACE FUNCTION refresh_smart_collection_on_rules()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.is_smart THEN
+        PERFORM refresh_smart_collection(NEW.collection_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER refresh_smart_collection_trigger
+    AFTER INSERT OR UPDATE OF is_smart, rule_genre_id, rule_artist_id, rule_bpm_min, rule_bpm_max,
+                              rule_duration_min, rule_duration_max, rule_title ON collections
+    FOR EACH ROW EXECUTE FUNCTION refresh_smart_collection_on_rules();
+
+-- Поколение данных поиска: сумма счетчиков увеличивается при каждом изменении треков,
+-- исполнителей и жанров; кеш результатов поиска на сервере привязан к поколению.
+-- Счетчик разбит на слоты, чтобы параллельные транзакции не ждали блокировку одной строки
+CREATE TABLE IF NOT EXISTS search_generation (
+    slot INTEGER PRIMARY KEY,
+    counter BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO search_generation (slot)
+SELECT generate_series(0, 15)
+ON CONFLICT (slot) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_search_generation()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE search_generation
+    SET counter = counter + 1
+    WHERE slot = pg_backend_pid() % 16;
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER bump_search_generation_tracks
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON tracks
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_search_generation();
+
+CREATE TRIGGER bump_search_generation_artists
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON artists
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_search_generation();
+
+CREATE TRIGGER bump_search_generation_genres
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON genres
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_search_generation();
+
 -- Хранимые процедуры
 
 -- Процедура аутентификации пользователя
@@ -503,6 +888,202 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- Процедура удаления очередной порции треков исполнителя (для фонового задания удаления)
+-- Короткие транзакции не держат блокировки треков, коллекций и журнала аудита надолго
+CREATE OR REPLACE FUNCTION delete_artist_tracks_batch(p_artist_id INTEGER, p_user_id INTEGER, p_batch_size INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    deleted_count INTEGER;
+BEGIN
+    DELETE FROM tracks
+    WHERE tracks.track_id IN (
+        SELECT t.track_id
+        FROM tracks t
+        WHERE t.artist_id = p_artist_id AND t.user_id = p_user_id
+        LIMIT p_batch_size
+        FOR UPDATE SKIP LOCKED
+    );
+    
+    GET DIAGNOSTICS deleted_count = ROW_COUNT;
+    RETURN deleted_count;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Процедура постановки задания в очередь
+-- При незавершенном задании с тем же ключом новое не создается, возвращается существующее
+CREATE OR REPLACE FUNCTION enqueue_job(
+    p_job_type VARCHAR(50),
+    p_user_id INTEGER,
+    p_payload JSONB,
+    p_dedup_key VARCHAR(255)
+)
+RETURNS TABLE(job_id INTEGER, status VARCHAR(20)) AS $$
+#variable_conflict use_column
+BEGIN
+    RETURN QUERY
+    INSERT INTO jobs (job_type, user_id, payload, dedup_key)
+    VALUES (p_job_type, p_user_id, p_payload, p_dedup_key)
+    ON CONFLICT (job_type, dedup_key) WHERE status IN ('queued', 'running') DO NOTHING
+    RETURNING jobs.job_id, jobs.status;
+    
+    IF NOT FOUND THEN
+        RETURN QUERY
+        SELECT j.job_id, j.status
+        FROM jobs j
+        WHERE j.job_type = p_job_type
+          AND j.dedup_key = p_dedup_key
+          AND j.status IN ('queued', 'running');
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Процедура получения задания обработчиком: готовое к запуску задание или задание
+-- с истекшей арендой; задания, уже забранные другими обработчиками, пропускаются.
+-- Задание с истекшей арендой, исчерпавшее p_max_attempts попыток, помечается как неуспешное.
+-- Возвращаемое число попыток - маркер аренды для update_job_progress, complete_job и fail_job
+DROP FUNCTION IF EXISTS claim_job(TEXT[], INTEGER);
+CREATE OR REPLACE FUNCTION claim_job(p_job_types TEXT[], p_lease_sec INTEGER, p_max_attempts INTEGER)
+RETURNS TABLE(
+    job_id INTEGER,
+    job_type VARCHAR(50),
+    user_id INTEGER,
+    payload JSONB,
+    progress JSONB,
+    attempts INTEGER
+) AS $$
+BEGIN
+    -- Обработчик упал на последней попытке, не успев сообщить об ошибке
+    UPDATE jobs j
+    SET status = 'failed',
+        error = COALESCE(j.error, 'Истекла аренда последней попытки'),
+        locked_until = NULL,
+        updated_at = CURRENT_TIMESTAMP,
+        finished_at = CURRENT_TIMESTAMP
+    WHERE j.job_id IN (
+        SELECT c.job_id
+        FROM jobs c
+        WHERE c.job_type = ANY(p_job_types)
+          AND c.status = 'running'
+          AND c.locked_until < CURRENT_TIMESTAMP
+          AND c.attempts >= p_max_attempts
+        FOR UPDATE SKIP LOCKED
+    );
+    
+    RETURN QUERY
+    UPDATE jobs j
+    SET status = 'running',
+        attempts = j.attempts + 1,
+        locked_until = CURRENT_TIMESTAMP + make_interval(secs => p_lease_sec),
+        updated_at = CURRENT_TIMESTAMP
+    WHERE j.job_id = (
+        SELECT c.job_id
+        FROM jobs c
+        WHERE c.job_type = ANY(p_job_types)
+          AND ((c.status = 'queued' AND c.run_after <= CURRENT_TIMESTAMP)
+               OR (c.status = 'running' AND c.locked_until < CURRENT_TIMESTAMP
+                   AND c.attempts < p_max_attempts))
+        ORDER BY c.job_id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING j.job_id, j.job_type, j.user_id, j.payload, j.progress, j.attempts;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Процедуры update_job_progress, complete_job и fail_job изменяют задание, только пока
+-- аренда принадлежит вызывающему (задание выполняется, число попыток равно полученному
+-- в claim_job); FALSE означает, что аренда истекла и задание забрал другой обработчик
+
+-- Процедура сохранения хода выполнения задания с продлением аренды
+-- Вызывается в транзакции очередной порции работы
+DROP FUNCTION IF EXISTS update_job_progress(INTEGER, JSONB, INTEGER);
+CREATE OR REPLACE FUNCTION update_job_progress(p_job_id INTEGER, p_attempts INTEGER, p_progress JSONB, p_lease_sec INTEGER)
+RETURNS BOOLEAN AS $$
+BEGIN
+    UPDATE jobs
+    SET progress = p_progress,
+        locked_until = CURRENT_TIMESTAMP + make_interval(secs => p_lease_sec),
+        updated_at = CURRENT_TIMESTAMP
+    WHERE jobs.job_id = p_job_id
+      AND jobs.status = 'running'
+      AND jobs.attempts = p_attempts;
+    
+    RETURN FOUND;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Процедура успешного завершения задания
+DROP FUNCTION IF EXISTS complete_job(INTEGER, JSONB);
+CREATE OR REPLACE FUNCTION complete_job(p_job_id INTEGER, p_attempts INTEGER, p_result JSONB)
+RETURNS BOOLEAN AS $$
+BEGIN
+    UPDATE jobs
+    SET status = 'done',
+        result = p_result,
+        error = NULL,
+        locked_until = NULL,
+        updated_at = CURRENT_TIMESTAMP,
+        finished_at = CURRENT_TIMESTAMP
+    WHERE jobs.job_id = p_job_id
+      AND jobs.status = 'running'
+      AND jobs.attempts = p_attempts;
+    
+    RETURN FOUND;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Процедура обработки ошибки задания: повтор с увеличивающейся задержкой,
+-- после p_max_attempts попыток задание помечается как неуспешное
+DROP FUNCTION IF EXISTS fail_job(INTEGER, TEXT, INTEGER, INTEGER);
+CREATE OR REPLACE FUNCTION fail_job(
+    p_job_id INTEGER,
+    p_attempts INTEGER,
+    p_error TEXT,
+    p_max_attempts INTEGER,
+    p_retry_delay_sec INTEGER
+)
+RETURNS BOOLEAN AS $$
+BEGIN
+    UPDATE jobs
+    SET status = CASE WHEN jobs.attempts >= p_max_attempts THEN 'failed' ELSE 'queued' END,
+        error = p_error,
+        run_after = CURRENT_TIMESTAMP + make_interval(secs => p_retry_delay_sec * jobs.attempts),
+        locked_until = NULL,
+        updated_at = CURRENT_TIMESTAMP,
+        finished_at = CASE WHEN jobs.attempts >= p_max_attempts THEN CURRENT_TIMESTAMP END
+    WHERE jobs.job_id = p_job_id
+      AND jobs.status = 'running'
+      AND jobs.attempts = p_attempts;
+    
+    RETURN FOUND;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Процедура получения состояния задания
+CREATE OR REPLACE FUNCTION get_job(p_job_id INTEGER)
+RETURNS TABLE(
+    job_id INTEGER,
+    job_type VARCHAR(50),
+    user_id INTEGER,
+    payload JSONB,
+    status VARCHAR(20),
+    progress JSONB,
+    result JSONB,
+    error TEXT,
+    attempts INTEGER,
+    created_at TIMESTAMP,
+    updated_at TIMESTAMP,
+    finished_at TIMESTAMP
+) AS $$
+BEGIN
+    RETURN QUERY
+    SELECT j.job_id, j.job_type, j.user_id, j.payload, j.status, j.progress, j.result, j.error,
+           j.attempts, j.created_at, j.updated_at, j.finished_at
+    FROM jobs j
+    WHERE j.job_id = p_job_id;
+END;
+$$ LANGUAGE plpgsql;
+
 -- Процедура добавления трека
 CREATE OR REPLACE FUNCTION add_track(
     p_user_id INTEGER,
@@ -599,7 +1180,15 @@ END;
 $$ LANGUAGE plpgsql;
 
 -- Процедура получения треков пользователя
-CREATE OR REPLACE FUNCTION get_user_tracks(p_user_id INTEGER)
+-- Постраничная выдача по ключу: p_limit строк с track_id < p_before_id (NULL - без ограничений)
+-- Прежняя версия (без постраничных параметров и updated_at) удаляется явно: CREATE OR REPLACE
+-- не меняет набор столбцов, а новая сигнатура с умолчаниями создала бы неоднозначную перегрузку
+DROP FUNCTION IF EXISTS get_user_tracks(INTEGER);
+CREATE OR REPLACE FUNCTION get_user_tracks(
+    p_user_id INTEGER,
+    p_limit INTEGER DEFAULT NULL,
+    p_before_id INTEGER DEFAULT NULL
+)
 RETURNS TABLE(
     track_id INTEGER,
     title VARCHAR(255),
@@ -607,21 +1196,30 @@ RETURNS TABLE(
     genre_name VARCHAR(100),
     bpm INTEGER,
     duration_sec INTEGER,
-    created_at TIMESTAMP
+    created_at TIMESTAMP,
+    updated_at TIMESTAMP
 ) AS $$
 BEGIN
     RETURN QUERY
-    SELECT t.track_id, t.title, a.name, g.name, t.bpm, t.duration_sec, t.created_at
+    SELECT t.track_id, t.title, a.name, g.name, t.bpm, t.duration_sec, t.created_at, t.updated_at
     FROM tracks t
     JOIN artists a ON t.artist_id = a.artist_id
     JOIN genres g ON t.genre_id = g.genre_id
     WHERE t.user_id = p_user_id
-    ORDER BY t.created_at DESC;
+      AND (p_before_id IS NULL OR t.track_id < p_before_id)
+    ORDER BY t.track_id DESC
+    LIMIT p_limit;
 END;
 $$ LANGUAGE plpgsql;
 
 -- Процедура получения всех треков (для администраторов)
-CREATE OR REPLACE FUNCTION get_all_tracks_admin()
+-- Постраничная выдача по ключу: p_limit строк с track_id < p_before_id (NULL - без ограничений)
+-- Прежняя версия без параметров удаляется, чтобы вызов без аргументов не был неоднозначным
+DROP FUNCTION IF EXISTS get_all_tracks_admin();
+CREATE OR REPLACE FUNCTION get_all_tracks_admin(
+    p_limit INTEGER DEFAULT NULL,
+    p_before_id INTEGER DEFAULT NULL
+)
 RETURNS TABLE(
     track_id INTEGER,
     title VARCHAR(255),
@@ -639,7 +1237,9 @@ BEGIN
     JOIN artists a ON t.artist_id = a.artist_id
     JOIN genres g ON t.genre_id = g.genre_id
     JOIN "user" u ON t.user_id = u.user_id
-    ORDER BY t.created_at DESC;
+    WHERE (p_before_id IS NULL OR t.track_id < p_before_id)
+    ORDER BY t.track_id DESC
+    LIMIT p_limit;
 END;
 $$ LANGUAGE plpgsql;
 
@@ -719,6 +1319,71 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- Правила умной коллекции в виде JSON (NULL для обычной коллекции)
+-- IMMUTABLE: результат зависит только от полей переданной строки
+CREATE OR REPLACE FUNCTION collection_rules(p_collection collections)
+RETURNS JSONB AS $$
+    SELECT CASE WHEN p_collection.is_smart THEN jsonb_build_object(
+        'genre_id', p_collection.rule_genre_id,
+        'artist_id', p_collection.rule_artist_id,
+        'bpm_min', p_collection.rule_bpm_min,
+        'bpm_max', p_collection.rule_bpm_max,
+        'duration_min', p_collection.rule_duration_min,
+        'duration_max', p_collection.rule_duration_max,
+        'title', p_collection.rule_title
+    ) END;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Процедура задания правил коллекции (p_is_smart = false - обычная коллекция, текущий состав сохраняется)
+-- Возвращает false, если коллекции нет, жанр не существует или исполнитель не принадлежит владельцу коллекции
+CREATE OR REPLACE FUNCTION set_collection_rules(
+    p_collection_id INTEGER,
+    p_is_smart BOOLEAN,
+    p_genre_id INTEGER,
+    p_artist_id INTEGER,
+    p_bpm_min INTEGER,
+    p_bpm_max INTEGER,
+    p_duration_min INTEGER,
+    p_duration_max INTEGER,
+    p_title VARCHAR(255)
+)
+RETURNS TABLE(success BOOLEAN) AS $$
+DECLARE
+    v_user_id INTEGER;
+BEGIN
+    SELECT c.user_id INTO v_user_id
+    FROM collections c
+    WHERE c.collection_id = p_collection_id;
+    
+    IF v_user_id IS NULL
+       OR (p_genre_id IS NOT NULL AND NOT EXISTS (
+               SELECT 1 FROM genres g WHERE g.genre_id = p_genre_id))
+       OR (p_artist_id IS NOT NULL AND NOT EXISTS (
+               SELECT 1 FROM artists a WHERE a.artist_id = p_artist_id AND a.user_id = v_user_id)) THEN
+        RETURN QUERY SELECT false::BOOLEAN;
+        RETURN;
+    END IF;
+    
+    -- Состав пересчитывается триггером refresh_smart_collection_trigger
+    UPDATE collections
+    SET is_smart = p_is_smart,
+        rule_genre_id = p_genre_id,
+        rule_artist_id = p_artist_id,
+        rule_bpm_min = p_bpm_min,
+        rule_bpm_max = p_bpm_max,
+        rule_duration_min = p_duration_min,
+        rule_duration_max = p_duration_max,
+        rule_title = p_title
+    WHERE collections.collection_id = p_collection_id;
+    
+    IF FOUND THEN
+        RETURN QUERY SELECT true::BOOLEAN;
+    ELSE
+        RETURN QUERY SELECT false::BOOLEAN;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
 -- Процедура получения коллекций пользователя
 CREATE OR REPLACE FUNCTION get_user_collections(p_user_id INTEGER)
 RETURNS TABLE(
@@ -726,12 +1391,16 @@ RETURNS TABLE(
     name VARCHAR(255),
     is_favorite BOOLEAN,
     created_at TIMESTAMP,
-    tracks_count INTEGER
+    tracks_count INTEGER,
+    is_smart BOOLEAN,
+    rules JSONB
 ) AS $$
 BEGIN
     RETURN QUERY
     SELECT c.collection_id, c.name, c.is_favorite, c.created_at,
-           (SELECT COUNT(*)::INTEGER FROM collection_tracks ct WHERE ct.collection_id = c.collection_id) AS tracks_count
+           (SELECT COUNT(*)::INTEGER FROM collection_tracks ct WHERE ct.collection_id = c.collection_id) AS tracks_count,
+           c.is_smart,
+           collection_rules(c)
     FROM collections c
     WHERE c.user_id = p_user_id
     ORDER BY c.is_favorite DESC, c.name;
@@ -745,6 +1414,12 @@ CREATE OR REPLACE FUNCTION add_track_to_collection(
 )
 RETURNS TABLE(success BOOLEAN) AS $$
 BEGIN
+    -- Состав умной коллекции определяется только правилами
+    IF EXISTS (SELECT 1 FROM collections c WHERE c.collection_id = p_collection_id AND c.is_smart) THEN
+        RETURN QUERY SELECT false::BOOLEAN;
+        RETURN;
+    END IF;
+    
     INSERT INTO collection_tracks (collection_id, track_id)
     VALUES (p_collection_id, p_track_id);
     
@@ -766,6 +1441,11 @@ CREATE OR REPLACE FUNCTION remove_track_from_collection(
 )
 RETURNS TABLE(success BOOLEAN) AS $$
 BEGIN
+    IF EXISTS (SELECT 1 FROM collections c WHERE c.collection_id = p_collection_id AND c.is_smart) THEN
+        RETURN QUERY SELECT false::BOOLEAN;
+        RETURN;
+    END IF;
+    
     DELETE FROM collection_tracks
     WHERE collection_id = p_collection_id AND track_id = p_track_id;
     
@@ -832,6 +1512,310 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- Процедура получения названий для автодополнения: треки, исполнители и коллекции пользователя
+CREATE OR REPLACE FUNCTION get_user_typeahead_terms(p_user_id INTEGER)
+RETURNS TABLE(
+    entity VARCHAR(20),
+    entity_id INTEGER,
+    name VARCHAR(255)
+) AS $$
+BEGIN
+    RETURN QUERY
+    SELECT 'tracks'::VARCHAR(20), t.track_id, t.title
+    FROM tracks t
+    WHERE t.user_id = p_user_id
+    UNION ALL
+    SELECT 'artists'::VARCHAR(20), a.artist_id, a.name::VARCHAR(255)
+    FROM artists a
+    WHERE a.user_id = p_user_id
+    UNION ALL
+    SELECT 'collections'::VARCHAR(20), c.collection_id, c.name::VARCHAR(255)
+    FROM collections c
+    WHERE c.user_id = p_user_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Процедура получения текущего поколения данных поиска
+-- Читается до выполнения поиска: результат не старше поколения, под которым он кешируется
+CREATE OR REPLACE FUNCTION get_search_generation()
+RETURNS BIGINT AS $$
+BEGIN
+    RETURN (SELECT COALESCE(SUM(counter), 0) FROM search_generation);
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- Процедура поиска похожих треков (k ближайших по BPM и длительности)
+-- Цель задается либо парой (p_bpm, p_duration), либо существующим треком p_track_id
+CREATE OR REPLACE FUNCTION find_similar_tracks(
+    p_user_id INTEGER,
+    p_bpm INTEGER,
+    p_duration INTEGER,
+    p_genre_id INTEGER,
+    p_track_id INTEGER,
+    p_limit INTEGER
+)
+RETURNS TABLE(
+    track_id INTEGER,
+    title VARCHAR(255),
+    artist_name VARCHAR(100),
+    genre_name VARCHAR(100),
+    bpm INTEGER,
+    duration_sec INTEGER,
+    created_at TIMESTAMP,
+    distance DOUBLE PRECISION
+) AS $$
+DECLARE
+    v_target POINT;
+BEGIN
+    IF p_track_id IS NOT NULL THEN
+        SELECT track_features(t.bpm, t.duration_sec) INTO v_target
+        FROM tracks t
+        WHERE t.track_id = p_track_id AND t.user_id = p_user_id;
+    ELSE
+        v_target := track_features(p_bpm, p_duration);
+    END IF;
+    
+    -- Трек не найден или у цели не заданы BPM/длительность
+    IF v_target IS NULL THEN
+        RETURN;
+    END IF;
+    
+    -- Сортировка по оператору расстояния <-> обслуживается индексом idx_tracks_features_knn
+    -- без сортировки всех треков пользователя
+    RETURN QUERY
+    SELECT t.track_id, t.title, a.name, g.name, t.bpm, t.duration_sec, t.created_at,
+           (track_features(t.bpm, t.duration_sec) <-> v_target)::DOUBLE PRECISION
+    FROM tracks t
+    JOIN artists a ON t.artist_id = a.artist_id
+    JOIN genres g ON t.genre_id = g.genre_id
+    WHERE t.user_id = p_user_id
+      AND t.bpm IS NOT NULL AND t.duration_sec IS NOT NULL
+      AND (p_genre_id IS NULL OR t.genre_id = p_genre_id)
+      AND (p_track_id IS NULL OR t.track_id <> p_track_id)
+    ORDER BY track_features(t.bpm, t.duration_sec) <-> v_target
+    LIMIT p_limit;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Процедура получения треков пользователя для поиска дубликатов
+-- (сравнение и группировка выполняются сервером; число коллекций нужно для выбора сохраняемого трека)
+CREATE OR REPLACE FUNCTION get_user_duplicate_candidates(p_user_id INTEGER)
+RETURNS TABLE(
+    track_id INTEGER,
+    title VARCHAR(255),
+    artist_id INTEGER,
+    artist_name VARCHAR(100),
+    genre_name VARCHAR(100),
+    bpm INTEGER,
+    duration_sec INTEGER,
+    created_at TIMESTAMP,
+    collections_count INTEGER
+) AS $$
+BEGIN
+    RETURN QUERY
+    SELECT t.track_id, t.title, t.artist_id, a.name, g.name, t.bpm, t.duration_sec, t.created_at,
+           COALESCE(ct.collections_count, 0)::INTEGER
+    FROM tracks t
+    JOIN artists a ON t.artist_id = a.artist_id
+    JOIN genres g ON t.genre_id = g.genre_id
+    LEFT JOIN (
+        SELECT ct2.track_id, COUNT(*) AS collections_count
+        FROM collection_tracks ct2
+        JOIN collections c ON ct2.collection_id = c.collection_id
+        WHERE c.user_id = p_user_id
+        GROUP BY ct2.track_id
+    ) ct ON ct.track_id = t.track_id
+    WHERE t.user_id = p_user_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Процедура объединения дубликатов: членство дубликатов в обычных коллекциях переносится
+-- на сохраняемый трек (с самой ранней датой добавления), затем дубликаты удаляются.
+-- Состав умных коллекций поддерживают триггеры. Возвращает NULL, если сохраняемый трек
+-- не принадлежит пользователю
+CREATE OR REPLACE FUNCTION merge_duplicate_tracks(
+    p_user_id INTEGER,
+    p_keep_track_id INTEGER,
+    p_duplicate_track_ids INTEGER[]
+)
+RETURNS TABLE(deleted_tracks INTEGER, moved_memberships INTEGER) AS $$
+DECLARE
+    v_moved INTEGER;
+    v_deleted INTEGER;
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM tracks t WHERE t.track_id = p_keep_track_id AND t.user_id = p_user_id
+    ) THEN
+        RETURN QUERY SELECT NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+    
+    INSERT INTO collection_tracks (collection_id, track_id, added_at)
+    SELECT ct.collection_id, p_keep_track_id, MIN(ct.added_at)
+    FROM collection_tracks ct
+    JOIN collections c ON ct.collection_id = c.collection_id
+    JOIN tracks t ON ct.track_id = t.track_id
+    WHERE ct.track_id = ANY(p_duplicate_track_ids)
+      AND ct.track_id <> p_keep_track_id
+      AND t.user_id = p_user_id
+      AND c.user_id = p_user_id
+      AND NOT c.is_smart
+    GROUP BY ct.collection_id
+    ON CONFLICT (collection_id, track_id) DO NOTHING;
+    
+    GET DIAGNOSTICS v_moved = ROW_COUNT;
+    
+    DELETE FROM tracks t
+    WHERE t.track_id = ANY(p_duplicate_track_ids)
+      AND t.track_id <> p_keep_track_id
+      AND t.user_id = p_user_id;
+    
+    GET DIAGNOSTICS v_deleted = ROW_COUNT;
+    
+    RETURN QUERY SELECT v_deleted, v_moved;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Процедура получения курсора синхронизации (xmin текущего снимка)
+-- Все транзакции с txid меньше курсора уже завершены и видны
+CREATE OR REPLACE FUNCTION get_sync_cursor()
+RETURNS BIGINT AS $$
+BEGIN
+    RETURN txid_snapshot_xmin(txid_current_snapshot());
+END;
+$$ LANGUAGE plpgsql;
+
+-- Процедура получения границы журнала изменений для синхронизации
+-- Блокировка строки до конца транзакции синхронизации не дает prune_library_changes()
+-- удалить изменения между проверкой курсора и чтением журнала
+CREATE OR REPLACE FUNCTION get_library_changes_horizon()
+RETURNS BIGINT AS $$
+DECLARE
+    v_min_txid BIGINT;
+BEGIN
+    SELECT h.min_txid INTO v_min_txid
+    FROM library_changes_horizon h
+    FOR SHARE;
+    
+    RETURN COALESCE(v_min_txid, 0);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Процедура удаления записей журнала изменений старше p_retention_days дней
+-- Удаляет не более p_batch_size записей; граница сдвигается до удаления, поэтому курсоры,
+-- для которых часть изменений удалена, получают полную синхронизацию
+CREATE OR REPLACE FUNCTION prune_library_changes(p_retention_days INTEGER, p_batch_size INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    v_horizon BIGINT;
+    v_deleted INTEGER;
+BEGIN
+    SELECT MAX(lc.txid) + 1 INTO v_horizon
+    FROM library_changes lc
+    WHERE lc.changed_at < CURRENT_TIMESTAMP - make_interval(days => p_retention_days);
+    
+    IF v_horizon IS NULL THEN
+        RETURN 0;
+    END IF;
+    
+    UPDATE library_changes_horizon
+    SET min_txid = GREATEST(min_txid, v_horizon);
+    
+    DELETE FROM library_changes
+    WHERE change_id IN (
+        SELECT lc.change_id
+        FROM library_changes lc
+        WHERE lc.txid < v_horizon
+        LIMIT p_batch_size
+    );
+    
+    GET DIAGNOSTICS v_deleted = ROW_COUNT;
+    RETURN v_deleted;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Процедура получения изменений библиотеки с момента курсора
+-- p_since = NULL - полный снимок библиотеки; иначе сущности, измененные транзакциями с txid >= p_since.
+-- operation = 'upsert' (data - текущее состояние) или 'delete' (надгробие, data = NULL)
+CREATE OR REPLACE FUNCTION get_library_changes(p_user_id INTEGER, p_since BIGINT)
+RETURNS TABLE(
+    entity VARCHAR(50),
+    entity_id INTEGER,
+    collection_id INTEGER,
+    operation VARCHAR(20),
+    data JSONB
+) AS $$
+BEGIN
+    RETURN QUERY
+    WITH changed AS (
+        SELECT lc.entity, lc.entity_id, lc.collection_id
+        FROM library_changes lc
+        WHERE p_since IS NOT NULL AND lc.user_id = p_user_id AND lc.txid >= p_since
+        UNION
+        SELECT 'tracks'::VARCHAR(50), t.track_id, NULL::INTEGER
+        FROM tracks t
+        WHERE p_since IS NULL AND t.user_id = p_user_id
+        UNION
+        SELECT 'artists'::VARCHAR(50), a.artist_id, NULL::INTEGER
+        FROM artists a
+        WHERE p_since IS NULL AND a.user_id = p_user_id
+        UNION
+        SELECT 'collections'::VARCHAR(50), c.collection_id, NULL::INTEGER
+        FROM collections c
+        WHERE p_since IS NULL AND c.user_id = p_user_id
+        UNION
+        SELECT 'collection_tracks'::VARCHAR(50), ct.track_id, ct.collection_id
+        FROM collection_tracks ct
+        JOIN collections c ON ct.collection_id = c.collection_id
+        WHERE p_since IS NULL AND c.user_id = p_user_id
+    )
+    SELECT ch.entity, ch.entity_id, ch.collection_id,
+           (CASE WHEN t.track_id IS NULL THEN 'delete' ELSE 'upsert' END)::VARCHAR(20),
+           CASE WHEN t.track_id IS NULL THEN NULL ELSE jsonb_build_object(
+               'track_id', t.track_id, 'title', t.title,
+               'artist_id', t.artist_id, 'artist_name', a.name,
+               'genre_id', t.genre_id, 'genre_name', g.name,
+               'bpm', t.bpm, 'duration_sec', t.duration_sec,
+               'created_at', t.created_at, 'updated_at', t.updated_at
+           ) END
+    FROM changed ch
+    LEFT JOIN tracks t ON t.track_id = ch.entity_id AND t.user_id = p_user_id
+    LEFT JOIN artists a ON t.artist_id = a.artist_id
+    LEFT JOIN genres g ON t.genre_id = g.genre_id
+    WHERE ch.entity = 'tracks'
+    UNION ALL
+    SELECT ch.entity, ch.entity_id, ch.collection_id,
+           (CASE WHEN a.artist_id IS NULL THEN 'delete' ELSE 'upsert' END)::VARCHAR(20),
+           CASE WHEN a.artist_id IS NULL THEN NULL ELSE jsonb_build_object(
+               'artist_id', a.artist_id, 'name', a.name,
+               'created_at', a.created_at, 'updated_at', a.updated_at
+           ) END
+    FROM changed ch
+    LEFT JOIN artists a ON a.artist_id = ch.entity_id AND a.user_id = p_user_id
+    WHERE ch.entity = 'artists'
+    UNION ALL
+    SELECT ch.entity, ch.entity_id, ch.collection_id,
+           (CASE WHEN c.collection_id IS NULL THEN 'delete' ELSE 'upsert' END)::VARCHAR(20),
+           CASE WHEN c.collection_id IS NULL THEN NULL ELSE jsonb_build_object(
+               'collection_id', c.collection_id, 'name', c.name, 'is_favorite', c.is_favorite,
+               'is_smart', c.is_smart, 'rules', collection_rules(c),
+               'created_at', c.created_at, 'updated_at', c.updated_at
+           ) END
+    FROM changed ch
+    LEFT JOIN collections c ON c.collection_id = ch.entity_id AND c.user_id = p_user_id
+    WHERE ch.entity = 'collections'
+    UNION ALL
+    SELECT ch.entity, ch.entity_id, ch.collection_id,
+           (CASE WHEN ct.track_id IS NULL THEN 'delete' ELSE 'upsert' END)::VARCHAR(20),
+           CASE WHEN ct.track_id IS NULL THEN NULL ELSE jsonb_build_object(
+               'collection_id', ct.collection_id, 'track_id', ct.track_id, 'added_at', ct.added_at
+           ) END
+    FROM changed ch
+    LEFT JOIN collection_tracks ct ON ct.collection_id = ch.collection_id AND ct.track_id = ch.entity_id
+    WHERE ch.entity = 'collection_tracks';
+END;
+$$ LANGUAGE plpgsql;
+
 -- Процедура получения всех пользователей (для администраторов)
 CREATE OR REPLACE FUNCTION get_all_users_admin()
 RETURNS TABLE(
@@ -853,7 +1837,13 @@ END;
 $$ LANGUAGE plpgsql;
 
 -- Процедура получения журнала аудита
-CREATE OR REPLACE FUNCTION get_audit_log()
+-- Постраничная выдача по ключу: p_limit строк с log_id < p_before_id (NULL - без ограничений)
+-- Прежняя версия без параметров удаляется, чтобы вызов без аргументов не был неоднозначным
+DROP FUNCTION IF EXISTS get_audit_log();
+CREATE OR REPLACE FUNCTION get_audit_log(
+    p_limit INTEGER DEFAULT NULL,
+    p_before_id INTEGER DEFAULT NULL
+)
 RETURNS TABLE(
     log_id INTEGER,
     user_login VARCHAR(50),
@@ -868,7 +1858,101 @@ BEGIN
     SELECT al.log_id, u.login, al.operation_type, al.table_name, al.record_id, al.operation_time, al.details
     FROM audit_log al
     LEFT JOIN "user" u ON al.user_id = u.user_id
-    ORDER BY al.operation_time DESC;
+    WHERE (p_before_id IS NULL OR al.log_id < p_before_id)
+    ORDER BY al.log_id DESC
+    LIMIT p_limit;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Процедура заполнения агрегатов аудита записями, существовавшими до создания триггера
+-- Обрабатывает следующую порцию из p_batch_size записей и возвращает их количество (0 - заполнение завершено)
+CREATE OR REPLACE FUNCTION backfill_audit_rollups(p_batch_size INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    v_position INTEGER;
+    v_upto INTEGER;
+    v_next INTEGER;
+BEGIN
+    -- Блокировка строки состояния исключает параллельное заполнение
+    SELECT position, upto INTO v_position, v_upto
+    FROM audit_rollup_backfill
+    FOR UPDATE;
+    
+    IF v_position IS NULL OR v_position >= v_upto THEN
+        RETURN 0;
+    END IF;
+    
+    v_next := LEAST(v_position + p_batch_size, v_upto);
+    
+    INSERT INTO audit_rollup_hourly AS r (bucket, table_name, operation_type, user_id, operation_count)
+    SELECT date_trunc('hour', al.operation_time), al.table_name, al.operation_type, COALESCE(al.user_id, 0), COUNT(*)
+    FROM audit_log al
+    WHERE al.log_id > v_position AND al.log_id <= v_next
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (bucket, table_name, operation_type, user_id)
+    DO UPDATE SET operation_count = r.operation_count + EXCLUDED.operation_count;
+    
+    INSERT INTO audit_rollup_daily AS r (bucket, table_name, operation_type, user_id, operation_count)
+    SELECT al.operation_time::date, al.table_name, al.operation_type, COALESCE(al.user_id, 0), COUNT(*)
+    FROM audit_log al
+    WHERE al.log_id > v_position AND al.log_id <= v_next
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (bucket, table_name, operation_type, user_id)
+    DO UPDATE SET operation_count = r.operation_count + EXCLUDED.operation_count;
+    
+    UPDATE audit_rollup_backfill SET position = v_next;
+    
+    RETURN v_next - v_position;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Процедура получения статистики операций из агрегатов аудита
+-- p_granularity: 'hour' или 'day'; измерения, по которым не нужна разбивка, суммируются (возвращаются как NULL)
+CREATE OR REPLACE FUNCTION get_audit_stats(
+    p_granularity VARCHAR(10),
+    p_from TIMESTAMP,
+    p_to TIMESTAMP,
+    p_table_name VARCHAR(50),
+    p_operation_type VARCHAR(20),
+    p_user_id INTEGER,
+    p_by_table BOOLEAN,
+    p_by_operation BOOLEAN,
+    p_by_user BOOLEAN
+)
+RETURNS TABLE(
+    bucket TIMESTAMP,
+    table_name VARCHAR(50),
+    operation_type VARCHAR(20),
+    user_id INTEGER,
+    user_login VARCHAR(50),
+    operation_count BIGINT
+) AS $$
+BEGIN
+    RETURN QUERY
+    WITH rollup AS (
+        SELECT h.bucket, h.table_name, h.operation_type, h.user_id, h.operation_count
+        FROM audit_rollup_hourly h
+        WHERE p_granularity = 'hour'
+          AND h.bucket >= p_from AND h.bucket < p_to
+        UNION ALL
+        SELECT d.bucket::timestamp, d.table_name, d.operation_type, d.user_id, d.operation_count
+        FROM audit_rollup_daily d
+        WHERE p_granularity = 'day'
+          AND d.bucket >= p_from::date AND d.bucket < p_to::date
+    )
+    SELECT r.bucket,
+           CASE WHEN p_by_table THEN r.table_name END,
+           CASE WHEN p_by_operation THEN r.operation_type END,
+           CASE WHEN p_by_user THEN NULLIF(r.user_id, 0) END,
+           CASE WHEN p_by_user THEN u.login END,
+           SUM(r.operation_count)::BIGINT
+    FROM rollup r
+    LEFT JOIN "user" u ON u.user_id = r.user_id
+    WHERE (p_table_name IS NULL OR r.table_name = p_table_name)
+      AND (p_operation_type IS NULL OR r.operation_type = p_operation_type)
+      AND (p_user_id IS NULL OR r.user_id = p_user_id)
+    GROUP BY 1, 2, 3, 4, 5
+    ORDER BY 1, 2, 3, 4;
 END;
 $$ LANGUAGE plpgsql;
 
@@ -928,6 +2012,107 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- Шардирование по пользователям
+-- Шард пользователя определяется хешем логина; формула должна совпадать с shard_for_login() в server.py
+CREATE OR REPLACE FUNCTION shard_for_login(p_login VARCHAR(50), p_shard_count INTEGER)
+RETURNS INTEGER AS $$
+BEGIN
+    RETURN ('x' || substr(md5(p_login), 1, 7))::bit(28)::integer % p_shard_count;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+-- Настройка базы как шарда p_shard_index из p_shard_count (выполняется один раз на новой базе)
+-- Удаляет пользователей, логин которых относится к другому шарду (на новой базе это начальные
+-- учетные записи), и чередует последовательности: шард выдает только идентификаторы,
+-- сравнимые с p_shard_index по модулю p_shard_count, поэтому идентификаторы уникальны между шардами
+CREATE OR REPLACE FUNCTION configure_shard(p_shard_index INTEGER, p_shard_count INTEGER)
+RETURNS VOID AS $$
+DECLARE
+    v_table TEXT;
+    v_column TEXT;
+    v_sequence TEXT;
+    v_last BIGINT;
+    v_next BIGINT;
+BEGIN
+    IF p_shard_index < 0 OR p_shard_index >= p_shard_count THEN
+        RAISE EXCEPTION 'Неверный номер шарда % из %', p_shard_index, p_shard_count;
+    END IF;
+    
+    DELETE FROM "user" u WHERE shard_for_login(u.login, p_shard_count) <> p_shard_index;
+    
+    FOR v_table, v_column IN
+        SELECT * FROM (VALUES
+            ('"user"', 'user_id'),
+            ('artists', 'artist_id'),
+            ('tracks', 'track_id'),
+            ('collections', 'collection_id'),
+            ('audit_log', 'log_id'),
+            ('jobs', 'job_id')
+        ) AS s(table_name, column_name)
+    LOOP
+        v_sequence := pg_get_serial_sequence(v_table, v_column);
+        
+        -- Значения, уже выданные последовательностью на любом шарде (начальные данные
+        -- одинаковы везде), не переиспользуются
+        EXECUTE format('SELECT GREATEST((SELECT last_value FROM %s), (SELECT COALESCE(MAX(%I), 0) FROM %s))',
+                       v_sequence, v_column, v_table)
+        INTO v_last;
+        
+        v_next := v_last + 1;
+        v_next := v_next + ((p_shard_index - v_next % p_shard_count) + p_shard_count) % p_shard_count;
+        
+        EXECUTE format('ALTER SEQUENCE %s INCREMENT BY %s', v_sequence, p_shard_count);
+        PERFORM setval(v_sequence, v_next, false);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Репликация справочника жанров с основного шарда
+CREATE OR REPLACE FUNCTION replicate_genre(
+    p_genre_id INTEGER,
+    p_name VARCHAR(100),
+    p_created_at TIMESTAMP
+)
+RETURNS VOID AS $$
+DECLARE
+    v_conflict_id INTEGER;
+BEGIN
+    -- Жанр с тем же названием, созданный на шарде под другим ID, сливается с реплицируемым:
+    -- название освобождается, ссылки переносятся, локальная запись удаляется
+    SELECT g.genre_id INTO v_conflict_id
+    FROM genres g
+    WHERE g.name = p_name AND g.genre_id <> p_genre_id;
+    
+    IF v_conflict_id IS NOT NULL THEN
+        UPDATE genres
+        SET name = left(genres.name, 80) || ' #' || genres.genre_id
+        WHERE genres.genre_id = v_conflict_id;
+    END IF;
+    
+    INSERT INTO genres (genre_id, name, created_at)
+    VALUES (p_genre_id, p_name, p_created_at)
+    ON CONFLICT (genre_id) DO UPDATE
+    SET name = EXCLUDED.name,
+        created_at = EXCLUDED.created_at;
+    
+    IF v_conflict_id IS NOT NULL THEN
+        UPDATE tracks SET genre_id = p_genre_id WHERE tracks.genre_id = v_conflict_id;
+        UPDATE collections SET rule_genre_id = p_genre_id WHERE collections.rule_genre_id = v_conflict_id;
+        
+        INSERT INTO user_favorite_genres (user_id, genre_id)
+        SELECT ufg.user_id, p_genre_id
+        FROM user_favorite_genres ufg
+        WHERE ufg.genre_id = v_conflict_id
+        ON CONFLICT DO NOTHING;
+        
+        DELETE FROM genres WHERE genres.genre_id = v_conflict_id;
+    END IF;
+    
+    PERFORM setval(pg_get_serial_sequence('genres', 'genre_id'),
+                   GREATEST((SELECT MAX(genre_id) FROM genres), 1));
+END;
+$$ LANGUAGE plpgsql;
+
 -- Вставка начальных данных
 INSERT INTO genres (name) VALUES 
     ('Рок'), 
@@ -1,13 +1,34 @@
-from flask import Flask, request, jsonify, session
+from flask import Flask, request, jsonify, session, Response, g, has_request_context, make_response
 import psycopg2
+import psycopg2.extensions
 from psycopg2.extras import RealDictCursor
 import os
+import gzip
+import hashlib
+import bisect
+import heapq
+import itertools
+import json
+import mimetypes
+import queue
+from collections import OrderedDict
+import select
+import threading
+import time
+import unicodedata
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import jwt
 from functools import wraps
 from flask_cors import CORS
 import re
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
 CORS(app)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here')
@@ -20,13 +41,1383 @@ DB_CONFIG = {
     'password': 'NIf9J_HT8B'
 }
 
-def get_db_connection():
-    """Create a database connection"""
-    conn = psycopg2.connect(**DB_CONFIG)
+# Shard map: JSON list of per-shard overrides of DB_CONFIG, one entry per database, e.g.
+# DB_SHARDS='[{"database": "music_library_0"}, {"database": "music_library_1"}]'
+# Users are placed by a hash of their login; the shard is carried in the JWT.
+# Genres are replicated from GENRES_PRIMARY_SHARD to every other shard at startup and
+# then every GENRES_REPLICATION_INTERVAL_SEC (the API never writes genres itself).
+DB_SHARDS = [dict(DB_CONFIG, **shard) for shard in json.loads(os.environ.get('DB_SHARDS', '[{}]'))]
+GENRES_PRIMARY_SHARD = 0
+GENRES_REPLICATION_INTERVAL_SEC = 300
+
+# Background threads (genre replication, sync journal pruning, job workers) are started when the app is
+# loaded; BACKGROUND_TASKS=0 disables them, e.g. for tests or web-only processes
+BACKGROUND_TASKS = os.environ.get('BACKGROUND_TASKS', '1') != '0'
+
+# Admission control: at most DB_MAX_CONCURRENT requests per worker use the database
+# at once, up to DB_MAX_WAITING more wait in a priority queue, the rest get 503
+DB_MAX_CONCURRENT = int(os.environ.get('DB_MAX_CONCURRENT', 10))
+DB_MAX_WAITING = int(os.environ.get('DB_MAX_WAITING', 50))
+ADMISSION_RETRY_AFTER_SEC = 2
+
+# Request classes: a lower priority is admitted first, queue_share caps the part of the
+# wait queue the class may occupy, statement_timeout_ms = 0 disables the timeout.
+# hold_stream keeps the slot until a streamed response is closed; max_active caps the slots
+# one class may hold at once, so long-running streams cannot take the whole pool.
+REQUEST_CLASSES = {
+    'auth': {'priority': 0, 'queue_share': 1.0, 'max_wait_sec': 5, 'statement_timeout_ms': 2000},
+    'read': {'priority': 1, 'queue_share': 1.0, 'max_wait_sec': 3, 'statement_timeout_ms': 3000},
+    'write': {'priority': 1, 'queue_share': 0.75, 'max_wait_sec': 3, 'statement_timeout_ms': 5000},
+    'heavy': {'priority': 2, 'queue_share': 0.25, 'max_wait_sec': 1, 'statement_timeout_ms': 10000},
+    'export': {'priority': 2, 'queue_share': 0.1, 'max_wait_sec': 1, 'statement_timeout_ms': 0,
+               'hold_stream': True, 'max_active': 2}
+}
+
+# Keyset pagination limit for track and audit listings
+MAX_PAGE_SIZE = 1000
+
+# Smart collection rules, in set_collection_rules argument order; unset rules match everything
+COLLECTION_RULE_FIELDS = ('genre_id', 'artist_id', 'bpm_min', 'bpm_max', 'duration_min', 'duration_max', 'title')
+
+# Search result cache: serialized results are kept in an LRU bounded by total size;
+# entries are keyed by the search generation, so writes make them unreachable
+SEARCH_CACHE_MAX_BYTES = int(os.environ.get('SEARCH_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+SEARCH_CACHE_MAX_ENTRY_BYTES = SEARCH_CACHE_MAX_BYTES // 16
+
+# Audit statistics: maximum requested range per rollup granularity, and the
+# number of audit rows aggregated per transaction by the rollup backfill
+AUDIT_STATS_MAX_RANGE = {
+    'hour': timedelta(days=31),
+    'day': timedelta(days=3660)
+}
+AUDIT_STATS_DEFAULT_RANGE = {
+    'hour': timedelta(hours=48),
+    'day': timedelta(days=30)
+}
+AUDIT_STATS_DIMENSIONS = ('table', 'operation', 'user')
+AUDIT_BACKFILL_BATCH_SIZE = 10000
+
+# Background job queue (jobs table, claimed with FOR UPDATE SKIP LOCKED): each server
+# process runs JOB_WORKERS_PER_SHARD worker threads per shard; a running job holds a
+# lease that is extended after every batch and reclaimed by another worker if it expires
+JOB_WORKERS_PER_SHARD = int(os.environ.get('JOB_WORKERS_PER_SHARD', 1))
+JOB_POLL_INTERVAL_SEC = 2
+JOB_LEASE_SEC = 60
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY_SEC = 10  # multiplied by the attempt number
+JOB_DELETE_BATCH_SIZE = 500  # tracks deleted per transaction by delete jobs
+
+# Typeahead: per-user prefix indexes over track, artist and collection names,
+# kept current from the change feed and evicted by LRU above TYPEAHEAD_MAX_BYTES
+TYPEAHEAD_MAX_BYTES = int(os.environ.get('TYPEAHEAD_MAX_BYTES', 64 * 1024 * 1024))
+TYPEAHEAD_ENTITIES = ('tracks', 'artists', 'collections')
+TYPEAHEAD_DEFAULT_LIMIT = 10
+TYPEAHEAD_MAX_LIMIT = 50
+TYPEAHEAD_MAX_WORD_STARTS = 6  # a name is found by a prefix of any of its first words
+TYPEAHEAD_LISTEN_TIMEOUT_SEC = 2
+TYPEAHEAD_BUILD_WAIT_SEC = 5  # lookups arriving during a build wait for it this long
+
+# Similar-track (nearest neighbor) search limits
+SIMILAR_TRACKS_DEFAULT_LIMIT = 20
+SIMILAR_TRACKS_MAX_LIMIT = 100
+
+# Duplicate detection: titles are compared by trigram similarity, but only for pairs
+# sharing a blocking key (same artist or same title signature, durations in adjacent
+# buckets), so the work grows with block sizes rather than quadratically with the library
+DUPLICATE_MIN_SIMILARITY = 0.8
+DUPLICATE_DURATION_TOLERANCE_SEC = 3  # also the duration bucket width
+# Title signature bands (MinHash LSH): each band keys a block by the two smallest trigram
+# hashes under its own salt; similar titles share at least one band with high probability
+DUPLICATE_SIGNATURE_SALTS = (0x5bd1e995, 0x27d4eb2f, 0x165667b1)
+DUPLICATE_MAX_BLOCK_SIZE = 500  # larger blocks only pair identical normalized titles
+# Finished scans are cached separately from search results, keyed by the search generation
+DUPLICATE_CACHE_MAX_BYTES = int(os.environ.get('DUPLICATE_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+DUPLICATE_TITLE_QUALIFIERS = re.compile(
+    r'[\(\[][^\)\]]*\b(?:remaster(?:ed)?|ремастер\w*|radio edit|single version|album version|'
+    r'mono|stereo|explicit|clean|deluxe|bonus track|feat|ft)\b[^\)\]]*[\)\]]'
+    r'|\s-\s[^-]*\b(?:remaster(?:ed)?|ремастер\w*|radio edit|single version|album version|'
+    r'mono|stereo|explicit|clean|deluxe|bonus track)\b.*$'
+    r'|\s(?:feat|ft)\.?\s.*$',
+    re.IGNORECASE
+)
+
+# Streaming export settings: COPY output is buffered into chunks of
+# EXPORT_CHUNK_SIZE bytes and at most EXPORT_QUEUE_CHUNKS chunks are held in memory
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_QUEUE_CHUNKS = 8
+
+# COPY statement templates per export format; {source} is a set-returning procedure call
+EXPORT_FORMATS = {
+    'csv': {
+        'copy_sql': "COPY (SELECT * FROM {source}) TO STDOUT WITH (FORMAT csv, HEADER)",
+        'mimetype': 'text/csv',
+        'extension': 'csv'
+    },
+    'ndjson': {
+        # Single JSON column, CSV mode with control-character quote/delimiter so the
+        # JSON text is written verbatim (text mode would escape backslashes)
+        'copy_sql': "COPY (SELECT row_to_json(r) FROM {source} r) TO STDOUT "
+                    "WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')",
+        'mimetype': 'application/x-ndjson',
+        'extension': 'ndjson'
+    }
+}
+
+# Change feed (LISTEN/NOTIFY -> server-sent events) settings
+CHANGE_FEED_CHANNEL = 'library_changes'
+CHANGE_FEED_QUEUE_SIZE = 1000
+CHANGE_FEED_KEEPALIVE_SEC = 15
+CHANGE_FEED_RECONNECT_SEC = 5
+
+# Delta sync journal retention: changes older than LIBRARY_CHANGES_RETENTION_DAYS are
+# pruned every LIBRARY_CHANGES_PRUNE_INTERVAL_SEC; older sync cursors get a full snapshot
+LIBRARY_CHANGES_RETENTION_DAYS = int(os.environ.get('LIBRARY_CHANGES_RETENTION_DAYS', 30))
+LIBRARY_CHANGES_PRUNE_INTERVAL_SEC = 3600
+LIBRARY_CHANGES_PRUNE_BATCH_SIZE = 5000
+
+# Client bundle: assets are served under content-hash fingerprinted names with
+# precompressed variants; HTML pages are revalidated on every load via ETag
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'client')
+CLIENT_FINGERPRINTED_EXTENSIONS = ('.js', '.css')
+CLIENT_HASH_LENGTH = 12
+CLIENT_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+CLIENT_MIN_COMPRESS_SIZE = 256
+
+class AdmissionController:
+    """Per-worker bounded, prioritized admission of requests to the database"""
+    
+    def __init__(self, max_concurrent, max_waiting):
+        self._condition = threading.Condition()
+        self._max_concurrent = max_concurrent
+        self._max_waiting = max_waiting
+        self._active = 0
+        self._class_active = {name: 0 for name in REQUEST_CLASSES}
+        self._waiting = []  # heap of (priority, arrival order, request class)
+        self._arrivals = itertools.count()
+        self._metrics = {
+            name: {'admitted': 0, 'queued': 0, 'shed': 0, 'timed_out': 0}
+            for name in REQUEST_CLASSES
+        }
+    
+    def acquire(self, request_class):
+        """Take a database slot, waiting by priority; False means the request is shed"""
+        settings = REQUEST_CLASSES[request_class]
+        metrics = self._metrics[request_class]
+        
+        with self._condition:
+            # A class at its own cap is shed right away rather than queued behind itself
+            if self._class_full(request_class):
+                metrics['shed'] += 1
+                return False
+            
+            if self._active < self._max_concurrent and not self._waiting:
+                self._active += 1
+                self._class_active[request_class] += 1
+                metrics['admitted'] += 1
+                return True
+            
+            if len(self._waiting) >= self._max_waiting * settings['queue_share']:
+                metrics['shed'] += 1
+                return False
+            
+            entry = (settings['priority'], next(self._arrivals), request_class)
+            heapq.heappush(self._waiting, entry)
+            metrics['queued'] += 1
+            deadline = time.monotonic() + settings['max_wait_sec']
+            
+            while self._active >= self._max_concurrent or self._next_admissible() != entry:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    metrics['shed'] += 1
+                    # The head of the queue may have changed
+                    self._condition.notify_all()
+                    return False
+                self._condition.wait(remaining)
+            
+            self._waiting.remove(entry)
+            heapq.heapify(self._waiting)
+            self._active += 1
+            self._class_active[request_class] += 1
+            metrics['admitted'] += 1
+            self._condition.notify_all()
+            return True
+    
+    def _class_full(self, request_class):
+        cap = REQUEST_CLASSES[request_class].get('max_active', self._max_concurrent)
+        return self._class_active[request_class] >= cap
+    
+    def _next_admissible(self):
+        # The first waiter in priority order whose class is below its cap; a waiter of
+        # a full class does not hold up the classes behind it
+        return min((entry for entry in self._waiting if not self._class_full(entry[2])), default=None)
+    
+    def release(self, request_class):
+        with self._condition:
+            self._active -= 1
+            self._class_active[request_class] -= 1
+            self._condition.notify_all()
+    
+    def record_timeout(self, request_class):
+        with self._condition:
+            self._metrics[request_class]['timed_out'] += 1
+    
+    def snapshot(self):
+        with self._condition:
+            return {
+                'active': self._active,
+                'waiting': len(self._waiting),
+                'max_concurrent': self._max_concurrent,
+                'max_waiting': self._max_waiting,
+                'classes': {
+                    name: dict(metrics, active=self._class_active[name])
+                    for name, metrics in self._metrics.items()
+                }
+            }
+
+admission = AdmissionController(DB_MAX_CONCURRENT, DB_MAX_WAITING)
+
+class SearchCache:
+    """Size-bounded LRU of serialized search results keyed by (shard, generation, parameters)"""
+    
+    def __init__(self, max_bytes, max_entry_bytes):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> bytes
+        self._max_bytes = max_bytes
+        self._max_entry_bytes = max_entry_bytes
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+    
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return body
+    
+    def put(self, key, body):
+        if len(body) > self._max_entry_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._entries[key] = body
+            self._bytes += len(body)
+            # Entries of older generations are never hit again and age out first
+            while self._bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._evictions += 1
+    
+    def snapshot(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self._max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_rate': round(self._hits / lookups, 4) if lookups else None
+            }
+
+search_cache = SearchCache(SEARCH_CACHE_MAX_BYTES, SEARCH_CACHE_MAX_ENTRY_BYTES)
+# Duplicate clusters have their own budget, so scans neither evict search results nor skew their metrics
+duplicate_cache = SearchCache(DUPLICATE_CACHE_MAX_BYTES, DUPLICATE_CACHE_MAX_BYTES // 4)
+
+_monitored_cursor_classes = {}
+
+def monitored_cursor_class(base):
+    """Subclass of a cursor class that reports statement timeouts to the admission metrics"""
+    cursor_class = _monitored_cursor_classes.get(base)
+    if cursor_class is not None:
+        return cursor_class
+    
+    class MonitoredCursor(base):
+        def _timed_out(self):
+            request_class = self.connection.request_class
+            if request_class:
+                admission.record_timeout(request_class)
+            if has_request_context():
+                g.statement_timed_out = True
+        
+        def execute(self, *args, **kwargs):
+            try:
+                return super().execute(*args, **kwargs)
+            except psycopg2.extensions.QueryCanceledError:
+                self._timed_out()
+                raise
+        
+        def callproc(self, *args, **kwargs):
+            try:
+                return super().callproc(*args, **kwargs)
+            except psycopg2.extensions.QueryCanceledError:
+                self._timed_out()
+                raise
+        
+        def copy_expert(self, *args, **kwargs):
+            try:
+                return super().copy_expert(*args, **kwargs)
+            except psycopg2.extensions.QueryCanceledError:
+                self._timed_out()
+                raise
+    
+    _monitored_cursor_classes[base] = MonitoredCursor
+    return MonitoredCursor
+
+class MonitoredConnection(psycopg2.extensions.connection):
+    """Connection tagged with its request class whose cursors report statement timeouts"""
+    request_class = None
+    
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = monitored_cursor_class(base)
+        return super().cursor(*args, **kwargs)
+
+def get_db_connection(shard=0, request_class=None):
+    """Create a connection to the given shard database with the request class statement timeout"""
+    if request_class is None and has_request_context():
+        request_class = g.get('request_class')
+    
+    params = dict(DB_SHARDS[shard])
+    if request_class:
+        params['options'] = f"-c statement_timeout={REQUEST_CLASSES[request_class]['statement_timeout_ms']}"
+    
+    conn = psycopg2.connect(connection_factory=MonitoredConnection, **params)
+    conn.request_class = request_class
     return conn
 
-def token_required(f):
-    """Decorator to protect routes that require authentication"""
+def shard_for_login(login):
+    """Shard that owns a login; must agree with shard_for_login() in the schema"""
+    return int(hashlib.md5(login.encode('utf-8')).hexdigest()[:7], 16) % len(DB_SHARDS)
+
+def token_shard(data):
+    """Shard of the user a decoded JWT belongs to (tokens issued before sharding map to 0)"""
+    shard = data.get('shard', 0)
+    if not isinstance(shard, int) or not 0 <= shard < len(DB_SHARDS):
+        raise jwt.InvalidTokenError('Unknown shard')
+    return shard
+
+def query_all_shards(procname, params=()):
+    """Call a set-returning procedure on every shard in parallel, returning one row list per shard"""
+    # Worker threads have no request context, so the request class is passed explicitly
+    request_class = g.get('request_class') if has_request_context() else None
+    
+    def query_shard(shard):
+        conn = get_db_connection(shard, request_class)
+        try:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            cursor.callproc(procname, params)
+            return cursor.fetchall()
+        finally:
+            conn.close()
+    
+    if len(DB_SHARDS) == 1:
+        return [query_shard(0)]
+    with ThreadPoolExecutor(max_workers=len(DB_SHARDS)) as executor:
+        try:
+            return list(executor.map(query_shard, range(len(DB_SHARDS))))
+        except psycopg2.extensions.QueryCanceledError:
+            # The timeout was hit in a worker thread; flag it on the request, so that
+            # admission_control answers 503 rather than the route's generic 500
+            if has_request_context():
+                g.statement_timed_out = True
+            raise
+
+def find_track_shard(track_id):
+    """Shard holding a track and its owner, looked up on every shard (for admin actions)
+
+    Returns (None, None) when no shard has the track.
+    """
+    for shard, rows in enumerate(query_all_shards('get_track_owner', (track_id,))):
+        if rows:
+            return shard, rows[0]['user_id']
+    return None, None
+
+def merge_shard_rows(shard_rows, key, limit=None):
+    """Merge per-shard row lists that are each sorted by key descending"""
+    merged = heapq.merge(*shard_rows, key=lambda row: row[key], reverse=True)
+    rows = list(merged)
+    return rows[:limit] if limit is not None else rows
+
+def replicate_genres():
+    """Copy the genre dictionary from the primary shard to all other shards"""
+    if len(DB_SHARDS) == 1:
+        return
+    
+    conn = get_db_connection(GENRES_PRIMARY_SHARD)
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.callproc('get_all_genres')
+        genres = cursor.fetchall()
+    finally:
+        conn.close()
+    
+    for shard in range(len(DB_SHARDS)):
+        if shard == GENRES_PRIMARY_SHARD:
+            continue
+        conn = get_db_connection(shard)
+        try:
+            cursor = conn.cursor()
+            for genre in genres:
+                cursor.callproc('replicate_genre', (genre['genre_id'], genre['name'], genre['created_at']))
+            conn.commit()
+        finally:
+            conn.close()
+
+def replicate_genres_periodically():
+    while True:
+        try:
+            replicate_genres()
+        except Exception as e:
+            print(f"Replicate genres error: {str(e)}")
+        time.sleep(GENRES_REPLICATION_INTERVAL_SEC)
+
+def prune_library_changes():
+    """Delete expired delta sync changes on every shard, one short transaction per batch"""
+    for shard in range(len(DB_SHARDS)):
+        conn = get_db_connection(shard)
+        try:
+            cursor = conn.cursor()
+            while True:
+                cursor.callproc('prune_library_changes',
+                                (LIBRARY_CHANGES_RETENTION_DAYS, LIBRARY_CHANGES_PRUNE_BATCH_SIZE))
+                deleted = cursor.fetchone()[0]
+                conn.commit()
+                if deleted < LIBRARY_CHANGES_PRUNE_BATCH_SIZE:
+                    break
+        finally:
+            conn.close()
+
+def prune_library_changes_periodically():
+    while True:
+        try:
+            prune_library_changes()
+        except Exception as e:
+            print(f"Prune library changes error: {str(e)}")
+        time.sleep(LIBRARY_CHANGES_PRUNE_INTERVAL_SEC)
+
+def start_background_tasks():
+    """Start the per-process background threads; runs on app load, also under a WSGI server"""
+    if not BACKGROUND_TASKS:
+        return
+    if len(DB_SHARDS) > 1:
+        threading.Thread(target=replicate_genres_periodically, daemon=True).start()
+    threading.Thread(target=prune_library_changes_periodically, daemon=True).start()
+    # Picks up jobs left queued or with expired leases by earlier runs
+    job_queue.ensure_started()
+
+class JobLeaseLost(Exception):
+    """The job's lease expired and another worker claimed it; the current run must stop"""
+
+class JobQueue:
+    """Postgres-backed background jobs served by worker threads of every server process
+
+    A job lives on the shard of the data it touches. Handlers receive the worker's
+    connection and the claimed job, commit their work in short batches through
+    report_progress() and return a JSON-serializable result; the result is stored in
+    the same transaction as the last batch. Handlers must be safe to re-run from the
+    last reported progress, since a job is retried after an error or an expired lease.
+    Every state change is fenced by the attempt number returned with the claim, so a
+    worker that lost its lease cannot overwrite the state written by the new owner.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handlers = {}  # job type -> handler(conn, job)
+        self._wakeups = {}  # shard -> threading.Event set when a job is enqueued
+        self._started = False
+    
+    def handler(self, job_type):
+        """Decorator registering the handler of a job type"""
+        def decorator(func):
+            self._handlers[job_type] = func
+            return func
+        return decorator
+    
+    def enqueue(self, cursor, job_type, user_id, payload, dedup_key=None):
+        """Add a job in the caller's transaction; call wake() after committing
+
+        Returns the (job_id, status) row; an unfinished job with the same dedup key is
+        returned instead of creating a new one.
+        """
+        cursor.callproc('enqueue_job', (job_type, user_id, json.dumps(payload), dedup_key))
+        return cursor.fetchone()
+    
+    def wake(self, shard):
+        event = self._wakeups.get(shard)
+        if event is not None:
+            event.set()
+    
+    def ensure_started(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            for shard in range(len(DB_SHARDS)):
+                self._wakeups[shard] = threading.Event()
+                for _ in range(JOB_WORKERS_PER_SHARD):
+                    threading.Thread(target=self._work, args=(shard,), daemon=True).start()
+    
+    def report_progress(self, conn, job, progress):
+        """Save progress and extend the lease, committing the handler's current batch
+
+        Raises JobLeaseLost, rolling the batch back, when the job is no longer ours.
+        """
+        cursor = conn.cursor()
+        cursor.callproc('update_job_progress',
+                        (job['job_id'], job['attempts'], json.dumps(progress), JOB_LEASE_SEC))
+        if not cursor.fetchone()[0]:
+            conn.rollback()
+            raise JobLeaseLost(f"Job {job['job_id']} lease lost")
+        conn.commit()
+        job['progress'] = progress
+    
+    def _work(self, shard):
+        while True:
+            conn = None
+            try:
+                conn = get_db_connection(shard)
+                while True:
+                    job = self._claim(conn)
+                    if job is None:
+                        self._wakeups[shard].wait(JOB_POLL_INTERVAL_SEC)
+                        self._wakeups[shard].clear()
+                        continue
+                    job['shard'] = shard
+                    self._run(conn, job, shard)
+            except Exception as e:
+                print(f"Job worker error (shard {shard}): {str(e)}")
+                time.sleep(JOB_POLL_INTERVAL_SEC)
+            finally:
+                if conn is not None:
+                    conn.close()
+    
+    def _claim(self, conn):
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.callproc('claim_job', (list(self._handlers), JOB_LEASE_SEC, JOB_MAX_ATTEMPTS))
+        job = cursor.fetchone()
+        conn.commit()
+        return job
+    
+    def _run(self, conn, job, shard):
+        cursor = conn.cursor()
+        try:
+            result = self._handlers[job['job_type']](conn, job)
+            cursor.callproc('complete_job', (job['job_id'], job['attempts'], app.json.dumps(result)))
+            if not cursor.fetchone()[0]:
+                raise JobLeaseLost(f"Job {job['job_id']} lease lost")
+            conn.commit()
+        except JobLeaseLost as e:
+            # The new owner redoes the work from the last committed progress
+            conn.rollback()
+            print(f"Job {job['job_id']} ({job['job_type']}, shard {shard}) stopped: {str(e)}")
+        except Exception as e:
+            conn.rollback()
+            print(f"Job {job['job_id']} ({job['job_type']}, shard {shard}) error: {str(e)}")
+            cursor.callproc('fail_job', (job['job_id'], job['attempts'], str(e),
+                                         JOB_MAX_ATTEMPTS, JOB_RETRY_DELAY_SEC))
+            if not cursor.fetchone()[0]:
+                print(f"Job {job['job_id']} ({job['job_type']}, shard {shard}) lease lost before failing")
+            conn.commit()
+
+job_queue = JobQueue()
+
+@job_queue.handler('delete_artist')
+def delete_artist_job(conn, job):
+    """Delete an artist's tracks in short transactions, then the artist itself"""
+    artist_id = job['payload']['artist_id']
+    deleted = (job['progress'] or {}).get('deleted_tracks', 0)
+    cursor = conn.cursor()
+    
+    while True:
+        cursor.callproc('delete_artist_tracks_batch', (artist_id, job['user_id'], JOB_DELETE_BATCH_SIZE))
+        count = cursor.fetchone()[0]
+        if not count:
+            break
+        deleted += count
+        job_queue.report_progress(conn, job, {'deleted_tracks': deleted})
+    
+    # Also removes tracks added or skipped while the batches ran
+    cursor.callproc('delete_artist', (artist_id, job['user_id']))
+    artist_deleted = cursor.fetchone()[0]
+    return {'deleted_tracks': deleted, 'artist_deleted': artist_deleted}
+
+@job_queue.handler('audit_backfill')
+def audit_backfill_job(conn, job):
+    """Aggregate audit rows written before the rollup trigger existed, in short batches"""
+    total = (job['progress'] or {}).get('rows', 0)
+    cursor = conn.cursor()
+    
+    while True:
+        cursor.callproc('backfill_audit_rollups', (AUDIT_BACKFILL_BATCH_SIZE,))
+        processed = cursor.fetchone()[0]
+        if not processed:
+            break
+        total += processed
+        job_queue.report_progress(conn, job, {'rows': total})
+    
+    return {'rows': total}
+
+@job_queue.handler('duplicate_scan')
+def duplicate_scan_job(conn, job):
+    """Cluster a user's near-duplicate tracks; the clusters are the job result"""
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.callproc('get_search_generation')
+    generation = cursor.fetchone()['get_search_generation']
+    cursor.callproc('get_user_duplicate_candidates', (job['user_id'],))
+    clusters = find_duplicate_clusters(cursor.fetchall())
+    
+    # Later requests of this process are answered from the cache until tracks change
+    cache_key = (job['shard'], generation, job['user_id'])
+    duplicate_cache.put(cache_key, app.json.dumps(clusters).encode('utf-8'))
+    return clusters
+
+class ChangeFeed:
+    """One LISTEN connection per worker fanning change events out to subscribed clients"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # user_id -> set of queue.Queue
+        self._listeners = []  # in-process callbacks(shard, event) receiving every event
+        self._threads = {}  # shard -> listener thread
+        self._ready = {}  # shard -> threading.Event, set while LISTEN is active
+    
+    def _start(self, shard):
+        # A shard's listener is started lazily on first use; caller holds the lock
+        thread = self._threads.get(shard)
+        if thread is None or not thread.is_alive():
+            self._ready.setdefault(shard, threading.Event())
+            thread = threading.Thread(target=self._listen, args=(shard,), daemon=True)
+            self._threads[shard] = thread
+            thread.start()
+    
+    def ensure_listening(self, shard, timeout):
+        """Start the shard listener if needed; True once LISTEN is active"""
+        with self._lock:
+            self._start(shard)
+            ready = self._ready[shard]
+        return ready.wait(timeout)
+    
+    def add_listener(self, callback):
+        with self._lock:
+            self._listeners.append(callback)
+    
+    def subscribe(self, user_id, shard=0):
+        subscriber = queue.Queue(maxsize=CHANGE_FEED_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscriber)
+            self._start(shard)
+        return subscriber
+    
+    def unsubscribe(self, user_id, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[user_id]
+    
+    def _deliver(self, subscriber, event):
+        try:
+            subscriber.put_nowait(event)
+        except queue.Full:
+            # Slow client: drop its backlog and ask it to resynchronize instead
+            while True:
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    break
+            subscriber.put_nowait({'type': 'resync'})
+    
+    def _dispatch(self, payload, shard):
+        event = json.loads(payload)
+        event['type'] = 'change'
+        with self._lock:
+            subscribers = list(self._subscribers.get(event['user_id'], ()))
+            listeners = list(self._listeners)
+        for subscriber in subscribers:
+            self._deliver(subscriber, event)
+        for listener in listeners:
+            listener(shard, event)
+    
+    def _broadcast_resync(self, shard):
+        # Subscribers are not indexed by shard, so everyone resynchronizes
+        with self._lock:
+            subscribers = [s for group in self._subscribers.values() for s in group]
+            listeners = list(self._listeners)
+        for subscriber in subscribers:
+            self._deliver(subscriber, {'type': 'resync'})
+        for listener in listeners:
+            listener(shard, {'type': 'resync'})
+    
+    def _listen(self, shard):
+        while True:
+            conn = None
+            try:
+                conn = get_db_connection(shard)
+                conn.autocommit = True
+                cursor = conn.cursor()
+                cursor.execute(f'LISTEN {CHANGE_FEED_CHANNEL}')
+                self._ready[shard].set()
+                
+                while True:
+                    if select.select([conn], [], [], CHANGE_FEED_KEEPALIVE_SEC) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._dispatch(conn.notifies.pop(0).payload, shard)
+                        
+            except Exception as e:
+                print(f"Change feed listener error (shard {shard}): {str(e)}")
+                # Notifications sent while disconnected are lost
+                self._ready[shard].clear()
+                self._broadcast_resync(shard)
+                time.sleep(CHANGE_FEED_RECONNECT_SEC)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+change_feed = ChangeFeed()
+
+def normalize_typeahead(text):
+    return ' '.join(text.lower().split())
+
+class TypeaheadIndex:
+    """Sorted array of (term, entity, id) for one user; prefix lookup by binary search"""
+    
+    # Rough per-entry memory cost used for the cache cap
+    ENTRY_OVERHEAD = 150
+    
+    def __init__(self):
+        self.lock = threading.Lock()  # held while the index is read or changed
+        self._keys = []    # sorted (term, entity, entity_id)
+        self._names = {}   # (entity, entity_id) -> display name
+        self._terms = {}   # (entity, entity_id) -> terms of the name
+        self.size = 0
+    
+    def put(self, entity, entity_id, name):
+        self.remove(entity, entity_id)
+        words = normalize_typeahead(name).split()
+        terms = [' '.join(words[i:]) for i in range(min(len(words), TYPEAHEAD_MAX_WORD_STARTS))]
+        for term in terms:
+            bisect.insort(self._keys, (term, entity, entity_id))
+            self.size += self.ENTRY_OVERHEAD + 2 * len(term)
+        self._names[(entity, entity_id)] = name
+        self._terms[(entity, entity_id)] = terms
+        self.size += self.ENTRY_OVERHEAD + 2 * len(name)
+    
+    def remove(self, entity, entity_id):
+        terms = self._terms.pop((entity, entity_id), None)
+        if terms is None:
+            return
+        for term in terms:
+            key = (term, entity, entity_id)
+            i = bisect.bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                del self._keys[i]
+            self.size -= self.ENTRY_OVERHEAD + 2 * len(term)
+        name = self._names.pop((entity, entity_id))
+        self.size -= self.ENTRY_OVERHEAD + 2 * len(name)
+    
+    def complete(self, prefix, entities, limit):
+        prefix = normalize_typeahead(prefix)
+        seen = set()
+        matches = []
+        i = bisect.bisect_left(self._keys, (prefix,))
+        # Scan a bounded window of matching terms, then rank: whole-name prefix matches
+        # first, shorter names next
+        while i < len(self._keys) and len(matches) < limit * 4:
+            term, entity, entity_id = self._keys[i]
+            if not term.startswith(prefix):
+                break
+            i += 1
+            if entity not in entities or (entity, entity_id) in seen:
+                continue
+            seen.add((entity, entity_id))
+            name = self._names[(entity, entity_id)]
+            matches.append((not normalize_typeahead(name).startswith(prefix), len(name), name, entity, entity_id))
+        
+        matches.sort()
+        return [
+            {'entity': entity, 'id': entity_id, 'name': name}
+            for _, _, name, entity, entity_id in matches[:limit]
+        ]
+
+class TypeaheadCache:
+    """Per-user typeahead indexes: built lazily, updated from change events, evicted by LRU
+
+    The cache lock only guards the user -> index map and the byte count; each index has
+    its own lock, so applying a burst of events for one user does not block lookups of
+    others. A cold index is built once: concurrent lookups of the same user wait for it.
+    """
+    
+    def __init__(self, max_bytes):
+        self._lock = threading.Lock()
+        self._indexes = OrderedDict()  # user_id -> (shard, TypeaheadIndex)
+        self._building = {}  # user_id -> in-progress build (events received meanwhile, result)
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._hits = 0
+        self._builds = 0
+        self._evictions = 0
+        change_feed.add_listener(self._on_change)
+    
+    def _apply(self, index, event):
+        if event['operation'] == 'DELETE':
+            index.remove(event['entity'], event['id'])
+        else:
+            index.put(event['entity'], event['id'], event['name'])
+    
+    def _on_change(self, shard, event):
+        with self._lock:
+            if event['type'] == 'resync':
+                # Events were lost: indexes of the shard can no longer be trusted
+                for user_id in [u for u, (s, _) in self._indexes.items() if s == shard]:
+                    self._bytes -= self._indexes.pop(user_id)[1].size
+                for build in self._building.values():
+                    build['events'].append(event)
+                return
+            
+            if event['entity'] not in TYPEAHEAD_ENTITIES:
+                return
+            user_id = event['user_id']
+            if user_id in self._building:
+                self._building[user_id]['events'].append(event)
+                return
+            entry = self._indexes.get(user_id)
+            if entry is None:
+                return
+            index = entry[1]
+        
+        # Events of one shard are dispatched by a single thread, so they stay in order
+        with index.lock:
+            size = index.size
+            self._apply(index, event)
+            delta = index.size - size
+        with self._lock:
+            self._bytes += delta
+    
+    def _build(self, user_id, shard, build):
+        # The listener must be active before the terms are read, so that no change
+        # committed after the read is missed; events arriving meanwhile are replayed
+        try:
+            listening = change_feed.ensure_listening(shard, TYPEAHEAD_LISTEN_TIMEOUT_SEC)
+            conn = get_db_connection(shard, 'read')
+            try:
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                cursor.callproc('get_user_typeahead_terms', (user_id,))
+                rows = cursor.fetchall()
+            finally:
+                conn.close()
+            
+            index = TypeaheadIndex()
+            for row in rows:
+                index.put(row['entity'], row['entity_id'], row['name'])
+            
+            with self._lock:
+                self._builds += 1
+                events = build['events']
+                build['index'] = index
+                if not listening or any(event['type'] == 'resync' for event in events):
+                    # Serve the waiting lookups, but do not keep an index that may miss changes
+                    return index
+                for event in events:
+                    self._apply(index, event)
+                
+                self._indexes[user_id] = (shard, index)
+                self._bytes += index.size
+                while self._bytes > self._max_bytes and len(self._indexes) > 1:
+                    _, (_, evicted) = self._indexes.popitem(last=False)
+                    self._bytes -= evicted.size
+                    self._evictions += 1
+            return index
+        finally:
+            with self._lock:
+                self._building.pop(user_id, None)
+            build['done'].set()
+    
+    def complete(self, user_id, shard, prefix, entities, limit):
+        with self._lock:
+            entry = self._indexes.get(user_id)
+            if entry is not None:
+                self._indexes.move_to_end(user_id)
+                self._hits += 1
+                index = entry[1]
+            else:
+                index = None
+                build = self._building.get(user_id)
+                owner = build is None
+                if owner:
+                    build = {'events': [], 'index': None, 'done': threading.Event()}
+                    self._building[user_id] = build
+        
+        if index is None:
+            if owner:
+                index = self._build(user_id, shard, build)
+            else:
+                build['done'].wait(TYPEAHEAD_BUILD_WAIT_SEC)
+                index = build['index']
+                if index is None:
+                    raise RuntimeError(f'Typeahead index of user {user_id} is not available')
+        
+        with index.lock:
+            return index.complete(prefix, entities, limit)
+    
+    def snapshot(self):
+        with self._lock:
+            return {
+                'users': len(self._indexes),
+                'bytes': self._bytes,
+                'max_bytes': self._max_bytes,
+                'hits': self._hits,
+                'builds': self._builds,
+                'evictions': self._evictions
+            }
+
+typeahead_cache = TypeaheadCache(TYPEAHEAD_MAX_BYTES)
+
+def normalize_duplicate_title(title):
+    """Title reduced for duplicate comparison: no case, accents, punctuation or version qualifiers"""
+    text = title
+    if not text.isascii():
+        text = ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+    stripped = DUPLICATE_TITLE_QUALIFIERS.sub(' ', text)
+    # A title that is nothing but a qualifier is kept as is
+    if re.search(r'\w', stripped):
+        text = stripped
+    return ' '.join(re.sub(r'[\W_]+', ' ', text.lower()).split())
+
+def title_trigrams(text):
+    padded = f'  {text} '
+    return frozenset({padded[i:i + 3] for i in range(len(padded) - 2)})
+
+def trigram_similarity(a, b):
+    """Jaccard similarity of two trigram sets"""
+    if not a or not b:
+        return 0.0
+    common = len(a & b)
+    return common / (len(a) + len(b) - common)
+
+def find_duplicate_clusters(tracks):
+    """Group near-duplicate tracks into clusters, each with a suggested track to keep
+
+    Pairs are compared only within blocks: tracks of one artist, or tracks whose titles
+    share a signature band (catches differently spelled artists), with durations in
+    the same or the next bucket. Matching pairs are joined by
+    union-find, so a cluster may contain pairs that were never compared directly.
+    """
+    # A punctuation-only title normalizes to '' and would match every other such title
+    normalized = [(track, normalize_duplicate_title(track['title'])) for track in tracks]
+    tracks = [track for track, title in normalized if title]
+    titles = [title for _, title in normalized if title]
+    grams = [title_trigrams(title) for title in titles]
+    artist_grams = {}
+    blocks = {}
+    
+    for i, track in enumerate(tracks):
+        duration = track['duration_sec']
+        bucket = duration // DUPLICATE_DURATION_TOLERANCE_SEC if duration is not None else None
+        # Built-in string hashes are consistent within the process, which is all blocking needs
+        hashes = [hash(gram) for gram in grams[i]]
+        blocks.setdefault(('artist', track['artist_id'], bucket), []).append(i)
+        for salt in DUPLICATE_SIGNATURE_SALTS:
+            band = tuple(sorted([value ^ salt for value in hashes])[:2])
+            blocks.setdefault(('signature', (salt, band), bucket), []).append(i)
+        if track['artist_id'] not in artist_grams:
+            artist_grams[track['artist_id']] = title_trigrams(normalize_duplicate_title(track['artist_name']))
+    
+    parent = list(range(len(tracks)))
+    
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    compared = set()
+    
+    def compare(i, j):
+        pair = (i, j) if i < j else (j, i)
+        if pair in compared:
+            return
+        compared.add(pair)
+        a, b = tracks[i], tracks[j]
+        if a['duration_sec'] is not None and b['duration_sec'] is not None and \
+                abs(a['duration_sec'] - b['duration_sec']) > DUPLICATE_DURATION_TOLERANCE_SEC:
+            return
+        # Jaccard similarity cannot exceed the ratio of set sizes
+        if min(len(grams[i]), len(grams[j])) < DUPLICATE_MIN_SIMILARITY * max(len(grams[i]), len(grams[j])):
+            return
+        if a['artist_id'] != b['artist_id'] and trigram_similarity(
+                artist_grams[a['artist_id']], artist_grams[b['artist_id']]) < DUPLICATE_MIN_SIMILARITY:
+            return
+        if titles[i] == titles[j] or trigram_similarity(grams[i], grams[j]) >= DUPLICATE_MIN_SIMILARITY:
+            parent[find(i)] = find(j)
+    
+    for (kind, value, bucket), members in blocks.items():
+        neighbors = blocks.get((kind, value, bucket + 1), []) if bucket is not None else []
+        if len(members) == 1 and not neighbors:
+            continue
+        if len(members) + len(neighbors) > DUPLICATE_MAX_BLOCK_SIZE:
+            # Oversized block (a prolific artist or a common trigram): exact titles only,
+            # neighbors by duration within each title group
+            by_title = {}
+            for i in itertools.chain(members, neighbors):
+                by_title.setdefault(titles[i], []).append(i)
+            for group in by_title.values():
+                group.sort(key=lambda i: tracks[i]['duration_sec'] or 0)
+                for i, j in zip(group, group[1:]):
+                    compare(i, j)
+            continue
+        for position, i in enumerate(members):
+            for j in members[position + 1:]:
+                compare(i, j)
+            for j in neighbors:
+                compare(i, j)
+    
+    groups = {}
+    for i in range(len(tracks)):
+        groups.setdefault(find(i), []).append(i)
+    
+    clusters = []
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        # Keep the track that is in the most collections, then one with BPM, then the oldest
+        keep = max(members, key=lambda i: (
+            tracks[i]['collections_count'], tracks[i]['bpm'] is not None, -tracks[i]['track_id']
+        ))
+        cluster_tracks = []
+        for i in sorted(members, key=lambda i: tracks[i]['track_id']):
+            entry = dict(tracks[i])
+            entry['normalized_title'] = titles[i]
+            entry['similarity'] = round(trigram_similarity(grams[i], grams[keep]), 3)
+            cluster_tracks.append(entry)
+        clusters.append({
+            'keep_track_id': tracks[keep]['track_id'],
+            'duplicate_track_ids': [tracks[i]['track_id'] for i in sorted(members) if i != keep],
+            'tracks': cluster_tracks
+        })
+    
+    clusters.sort(key=lambda cluster: (-len(cluster['tracks']), cluster['keep_track_id']))
+    return clusters
+
+class CopyStreamWriter:
+    """File-like sink for cursor.copy_expert that hands fixed-size chunks to a bounded queue"""
+    
+    def __init__(self):
+        self.chunks = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+        self.cancelled = threading.Event()
+        self.error = None
+        self._buffer = bytearray()
+    
+    def _put(self, item):
+        # Block while the consumer is behind, but give up once the download is aborted
+        while not self.cancelled.is_set():
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise IOError('Export cancelled')
+    
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._buffer.extend(data)
+        if len(self._buffer) >= EXPORT_CHUNK_SIZE:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+    
+    def close(self):
+        try:
+            if self._buffer:
+                self._put(bytes(self._buffer))
+                self._buffer.clear()
+            self._put(None)
+        except IOError:
+            pass
+
+def stream_copy(conn, copy_sql, compress=False):
+    """Run COPY ... TO STDOUT in a background thread and yield its output in chunks"""
+    writer = CopyStreamWriter()
+    
+    def run_copy():
+        try:
+            cursor = conn.cursor()
+            cursor.copy_expert(copy_sql, writer)
+            cursor.close()
+        except Exception as e:
+            writer.error = e
+        finally:
+            writer.close()
+    
+    thread = threading.Thread(target=run_copy, daemon=True)
+    thread.start()
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    
+    try:
+        while True:
+            chunk = writer.chunks.get()
+            if chunk is None:
+                break
+            if compressor:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            yield chunk
+        
+        if writer.error:
+            # Headers are already sent, so the failure is signalled by aborting the
+            # connection: the chunked body (and the gzip trailer) is left unterminated
+            # and the client sees a broken download instead of a short 200
+            print(f"Export stream error: {str(writer.error)}")
+            raise IOError('Export aborted') from writer.error
+        
+        if compressor:
+            yield compressor.flush()
+    finally:
+        writer.cancelled.set()
+        if thread.is_alive():
+            # Client went away mid-export: abort the COPY on the server side
+            conn.cancel()
+        thread.join()
+        conn.close()
+
+def export_response(conn, source_sql, params, export_format, compress, filename):
+    """Build a streaming HTTP response for COPY of a set-returning procedure call"""
+    export = EXPORT_FORMATS[export_format]
+    cursor = conn.cursor()
+    source = cursor.mogrify(source_sql, params).decode('utf-8')
+    cursor.close()
+    copy_sql = export['copy_sql'].format(source=source)
+    
+    filename = f"{filename}.{export['extension']}"
+    mimetype = export['mimetype']
+    if compress:
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    
+    response = Response(
+        stream_copy(conn, copy_sql, compress),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Cache-Control': 'no-store'
+        }
+    )
+    # Covers the case where the stream is never iterated
+    response.call_on_close(conn.close)
+    return response
+
+def parse_export_args():
+    """Validate export query parameters, returning (format, compress, error_response)"""
+    export_format = request.args.get('format', 'csv')
+    compression = request.args.get('compress')
+    
+    if export_format not in EXPORT_FORMATS:
+        return None, None, (jsonify({'message': 'Поддерживаемые форматы экспорта: csv, ndjson'}), 400)
+    
+    if compression not in (None, '', 'gzip'):
+        return None, None, (jsonify({'message': 'Поддерживаемое сжатие: gzip'}), 400)
+    
+    return export_format, compression == 'gzip', None
+
+def parse_page_args():
+    """Validate keyset pagination parameters, returning (limit, before_id, error_response)"""
+    limit = request.args.get('limit', type=int)
+    before_id = request.args.get('before_id', type=int)
+    
+    if limit is not None and (limit < 1 or limit > MAX_PAGE_SIZE):
+        return None, None, (jsonify({'message': f'Размер страницы должен быть от 1 до {MAX_PAGE_SIZE}'}), 400)
+    
+    return limit, before_id, None
+
+def parse_collection_rules(rules):
+    """Validate smart collection rules, returning (set_collection_rules params, error_response)
+
+    None turns the collection back into a regular one.
+    """
+    if rules is None:
+        return (False,) + (None,) * len(COLLECTION_RULE_FIELDS), None
+    if not isinstance(rules, dict):
+        return None, (jsonify({'message': 'Правила коллекции должны быть объектом'}), 400)
+    
+    unknown = set(rules) - set(COLLECTION_RULE_FIELDS)
+    if unknown:
+        return None, (jsonify({'message': f'Неизвестные правила: {", ".join(sorted(unknown))}'}), 400)
+    
+    values = []
+    for field in COLLECTION_RULE_FIELDS:
+        value = rules.get(field)
+        if field == 'title':
+            if value is not None and (not isinstance(value, str) or len(value) > 255):
+                return None, (jsonify({'message': 'Правило title должно быть строкой до 255 символов'}), 400)
+            value = value or None
+        elif value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < 0):
+            return None, (jsonify({'message': f'Правило {field} должно быть неотрицательным целым числом'}), 400)
+        values.append(value)
+    
+    if all(value is None for value in values):
+        return None, (jsonify({'message': 'Умная коллекция должна содержать хотя бы одно правило'}), 400)
+    
+    params = dict(zip(COLLECTION_RULE_FIELDS, values))
+    for low, high in (('bpm_min', 'bpm_max'), ('duration_min', 'duration_max')):
+        if params[low] is not None and params[high] is not None and params[low] > params[high]:
+            return None, (jsonify({'message': f'Правило {low} не может быть больше {high}'}), 400)
+    
+    return (True,) + tuple(values), None
+
+class ClientAssets:
+    """Client bundle built once at startup: fingerprinted names, ETags and gzip/brotli variants"""
+    
+    def __init__(self, directory):
+        self._assets = {}  # request path -> asset dict
+        if os.path.isdir(directory):
+            self._build(directory)
+    
+    def _build(self, directory):
+        files = sorted(f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f)))
+        renames = {}
+        
+        # Fingerprinted assets first, so HTML pages can reference their hashed names
+        for filename in files:
+            if not filename.endswith(CLIENT_FINGERPRINTED_EXTENSIONS):
+                continue
+            with open(os.path.join(directory, filename), 'rb') as f:
+                body = f.read()
+            digest = hashlib.sha256(body).hexdigest()[:CLIENT_HASH_LENGTH]
+            base, extension = os.path.splitext(filename)
+            hashed_name = f'{base}.{digest}{extension}'
+            renames[filename] = hashed_name
+            
+            asset = self._make_asset(filename, body)
+            self._assets[hashed_name] = dict(asset, immutable=True)
+            # The plain name stays available for stale pages, but is always revalidated
+            self._assets[filename] = asset
+        
+        for filename in files:
+            if not filename.endswith('.html'):
+                continue
+            with open(os.path.join(directory, filename), encoding='utf-8') as f:
+                html = f.read()
+            for original, hashed_name in renames.items():
+                html = re.sub(r'(href|src)="' + re.escape(original) + '"', rf'\1="{hashed_name}"', html)
+            self._assets[filename] = self._make_asset(filename, html.encode('utf-8'))
+        
+        if 'index.html' in self._assets:
+            self._assets[''] = self._assets['index.html']
+    
+    def _make_asset(self, filename, body):
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if mimetype.startswith('text/') or mimetype == 'application/javascript':
+            mimetype += '; charset=utf-8'
+        
+        etag = hashlib.sha256(body).hexdigest()[:CLIENT_HASH_LENGTH]
+        variants = {'identity': body}
+        if len(body) >= CLIENT_MIN_COMPRESS_SIZE:
+            variants['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                variants['br'] = brotli.compress(body, quality=11)
+            # Keep only variants that are actually smaller
+            variants = {k: v for k, v in variants.items() if k == 'identity' or len(v) < len(body)}
+        
+        return {'mimetype': mimetype, 'etag': etag, 'variants': variants, 'immutable': False}
+    
+    def _choose_encoding(self, asset):
+        accepted = request.accept_encodings
+        best, best_quality = 'identity', 0
+        for encoding in ('br', 'gzip'):
+            quality = accepted[encoding]
+            if encoding in asset['variants'] and quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+    
+    def response(self, path):
+        asset = self._assets.get(path)
+        if asset is None:
+            return None
+        
+        encoding = self._choose_encoding(asset)
+        # A distinct ETag per encoding, since the representations differ byte-wise
+        etag = asset['etag'] if encoding == 'identity' else f"{asset['etag']}-{encoding}"
+        
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(asset['variants'][encoding], mimetype=asset['mimetype'])
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        if asset['immutable']:
+            response.headers['Cache-Control'] = f'public, max-age={CLIENT_IMMUTABLE_MAX_AGE}, immutable'
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+client_assets = ClientAssets(CLIENT_DIR)
+
+def admission_control(request_class):
+    """Decorator admitting a request to the database by class, shedding it with 503 when saturated"""
+    settings = REQUEST_CLASSES[request_class]
+    
+    def overloaded(message):
+        response = jsonify({'message': message})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(ADMISSION_RETRY_AFTER_SEC)
+        return response
+    
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if not admission.acquire(request_class):
+                return overloaded('Сервер перегружен, повторите запрос позже')
+            
+            g.request_class = request_class
+            try:
+                response = make_response(f(*args, **kwargs))
+            except Exception:
+                admission.release(request_class)
+                raise
+            
+            if settings.get('hold_stream') and response.is_streamed:
+                response.call_on_close(lambda: admission.release(request_class))
+            else:
+                admission.release(request_class)
+            
+            # A statement timeout is reported as a transient overload, not as a server error
+            if response.status_code == 500 and g.get('statement_timed_out'):
+                return overloaded('Превышено время выполнения запроса, повторите запрос позже')
+            return response
+        
+        return decorated
+    
+    return decorator
+
+def token_required(f=None, *, allow_query_token=False, verify_user=True):
+    """Decorator to protect routes that require authentication
+
+    allow_query_token also accepts the token in the ?token= query parameter, for clients
+    that cannot send headers (EventSource). verify_user=False checks only the token's
+    signature and expiry, without a database round trip; the route then receives just
+    user_id and shard.
+    """
+    if f is None:
+        return lambda func: token_required(func, allow_query_token=allow_query_token,
+                                           verify_user=verify_user)
+    
     @wraps(f)
     def decorated(*args, **kwargs):
         token = None
@@ -37,6 +1428,8 @@ def token_required(f):
                 token = auth_header.split(" ")[1]  # Bearer token
             except IndexError:
                 return jsonify({'message': 'Неверный формат токена'}), 401
+        elif allow_query_token:
+            token = request.args.get('token')
         
         if not token:
             return jsonify({'message': 'Токен отсутствует'}), 401
@@ -44,17 +1437,24 @@ def token_required(f):
         try:
             data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
             current_user_id = data['user_id']
+            shard = token_shard(data)
             
-            # Check if user still exists in database using stored procedure
-            conn = get_db_connection()
-            cursor = conn.cursor(cursor_factory=RealDictCursor)
-            cursor.callproc('get_user_by_id', (current_user_id,))
-            current_user = cursor.fetchone()
-            cursor.close()
-            conn.close()
+            if verify_user:
+                # Check if user still exists in database using stored procedure
+                conn = get_db_connection(shard)
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                cursor.callproc('get_user_by_id', (current_user_id,))
+                current_user = cursor.fetchone()
+                cursor.close()
+                conn.close()
+                
+                if not current_user:
+                    return jsonify({'message': 'Пользователь больше не существует'}), 401
+            else:
+                current_user = {'user_id': current_user_id}
             
-            if not current_user:
-                return jsonify({'message': 'Пользователь больше не существует'}), 401
+            # All per-user procedure calls are routed to the user's shard
+            current_user['shard'] = shard
                 
         except jwt.ExpiredSignatureError:
             return jsonify({'message': 'Токен истек'}), 401
@@ -86,7 +1486,7 @@ def admin_required(f):
             current_user_id = data['user_id']
             
             # Check if user is admin using stored procedure
-            conn = get_db_connection()
+            conn = get_db_connection(token_shard(data))
             cursor = conn.cursor(cursor_factory=RealDictCursor)
             cursor.callproc('check_user_is_admin', (current_user_id,))
             result = cursor.fetchone()
@@ -107,6 +1507,7 @@ def admin_required(f):
 
 # Authentication routes
 @app.route('/api/auth/login', methods=['POST'])
+@admission_control('auth')
 def login():
     data = request.get_json()
     login = data.get('login')
@@ -132,7 +1533,9 @@ def login():
         return jsonify({'message': 'Пароль должен содержать от 6 до 255 символов'}), 400
     
     try:
-        conn = get_db_connection()
+        # The login determines the shard that holds the user
+        shard = shard_for_login(login)
+        conn = get_db_connection(shard)
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # Call stored procedure to authenticate user
@@ -145,6 +1548,7 @@ def login():
             # Generate JWT token
             token = jwt.encode({
                 'user_id': user_data['user_id'],
+                'shard': shard,
                 'exp': datetime.utcnow() + timedelta(hours=24)
             }, app.config['SECRET_KEY'], algorithm='HS256')
             
@@ -171,6 +1575,7 @@ def login():
             conn.close()
 
 @app.route('/api/auth/register', methods=['POST'])
+@admission_control('auth')
 def register():
     data = request.get_json()
     login = data.get('login')
@@ -226,7 +1631,9 @@ def register():
         return jsonify({'message': 'Введите корректный email адрес'}), 400
     
     try:
-        conn = get_db_connection()
+        # Logins are unique per shard, and a login always maps to the same shard
+        shard = shard_for_login(login)
+        conn = get_db_connection(shard)
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # Call stored procedure to register user
@@ -242,6 +1649,7 @@ def register():
             # Generate JWT token
             token = jwt.encode({
                 'user_id': user_data['user_id'],
+                'shard': shard,
                 'exp': datetime.utcnow() + timedelta(hours=24)
             }, app.config['SECRET_KEY'], algorithm='HS256')
             
@@ -281,10 +1689,11 @@ def register():
 
 # User profile routes
 @app.route('/api/profile', methods=['GET'])
+@admission_control('read')
 @token_required
 def get_profile(current_user):
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # Get user profile with favorite genres and artists
@@ -316,6 +1725,7 @@ def get_profile(current_user):
             conn.close()
 
 @app.route('/api/profile', methods=['PUT'])
+@admission_control('write')
 @token_required
 def update_profile(current_user):
     data = request.get_json()
@@ -326,7 +1736,7 @@ def update_profile(current_user):
     avatar_url = data.get('avatar_url')
     
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # Call stored procedure to update profile
@@ -354,10 +1764,11 @@ def update_profile(current_user):
 
 # Genre routes
 @app.route('/api/genres', methods=['GET'])
+@admission_control('read')
 @token_required
 def get_genres(current_user):
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         cursor.callproc('get_all_genres')
@@ -374,10 +1785,11 @@ def get_genres(current_user):
 
 # Artist routes
 @app.route('/api/artists', methods=['GET'])
+@admission_control('read')
 @token_required
 def get_artists(current_user):
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # Get user's artists
@@ -394,6 +1806,7 @@ def get_artists(current_user):
             conn.close()
 
 @app.route('/api/artists', methods=['POST'])
+@admission_control('write')
 @token_required
 def add_artist(current_user):
     data = request.get_json()
@@ -403,7 +1816,7 @@ def add_artist(current_user):
         return jsonify({'message': 'Имя исполнителя обязательно'}), 400
     
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         cursor.callproc('add_artist', (current_user['user_id'], name))
@@ -427,6 +1840,7 @@ def add_artist(current_user):
             conn.close()
 
 @app.route('/api/artists/<int:artist_id>', methods=['PUT'])
+@admission_control('write')
 @token_required
 def update_artist(current_user, artist_id):
     data = request.get_json()
@@ -436,7 +1850,7 @@ def update_artist(current_user, artist_id):
         return jsonify({'message': 'Имя исполнителя обязательно'}), 400
     
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # Check if artist belongs to user using stored procedure
@@ -468,11 +1882,12 @@ def update_artist(current_user, artist_id):
             conn.close()
 
 @app.route('/api/artists/<int:artist_id>/tracks-count', methods=['GET'])
+@admission_control('read')
 @token_required
 def get_artist_tracks_count(current_user, artist_id):
     """Получить количество треков исполнителя"""
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # Check if artist belongs to user using stored procedure
@@ -498,10 +1913,11 @@ def get_artist_tracks_count(current_user, artist_id):
             conn.close()
 
 @app.route('/api/artists/<int:artist_id>', methods=['DELETE'])
+@admission_control('write')
 @token_required
 def delete_artist(current_user, artist_id):
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # Check if artist belongs to user using stored procedure
@@ -512,16 +1928,20 @@ def delete_artist(current_user, artist_id):
         if not artist_exists:
             return jsonify({'message': 'Нет прав для удаления этого исполнителя'}), 403
         
-        cursor.callproc('delete_artist', (artist_id, current_user['user_id']))
-        result = cursor.fetchone()
+        # Deleting the tracks cascades through collections and the audit trigger row by row,
+        # so it runs as a background job in short batches; the client polls /api/jobs/<id>
+        job = job_queue.enqueue(cursor, 'delete_artist', current_user['user_id'],
+                                {'artist_id': artist_id}, f'artist:{artist_id}')
         
         # Commit the transaction
         conn.commit()
+        job_queue.wake(current_user['shard'])
         
-        if result and result['success']:
-            return jsonify({'message': 'Исполнитель и все связанные треки успешно удалены'}), 200
-        else:
-            return jsonify({'message': 'Не удалось удалить исполнителя'}), 400
+        return jsonify({
+            'message': 'Удаление исполнителя и связанных треков запущено',
+            'job_id': job['job_id'],
+            'status': job['status']
+        }), 202
             
     except Exception as e:
         print(f"Delete artist error: {str(e)}")
@@ -534,6 +1954,7 @@ def delete_artist(current_user, artist_id):
 
 # Track routes
 @app.route('/api/tracks', methods=['GET'])
+@admission_control('read')
 @token_required
 def get_tracks(current_user):
     # Check if user is admin to determine if they can see all tracks
@@ -547,16 +1968,21 @@ def get_tracks(current_user):
     bpm_filter = request.args.get('bpm')
     duration_filter = request.args.get('duration')
     
+    # Keyset pagination: ?limit=N&before_id=<track_id of the last row of the previous page>
+    limit, before_id, error = parse_page_args()
+    if error:
+        return error
+    
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # Call appropriate stored procedure based on admin status
+        # Admins see tracks of every shard
         if is_admin:
-            cursor.callproc('get_all_tracks_admin')
-        else:
-            cursor.callproc('get_user_tracks', (user_id,))
+            shard_tracks = query_all_shards('get_all_tracks_admin', (limit, before_id))
+            return jsonify(merge_shard_rows(shard_tracks, 'track_id', limit)), 200
         
+        conn = get_db_connection(current_user['shard'])
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cursor.callproc('get_user_tracks', (user_id, limit, before_id))
         tracks = cursor.fetchall()
         
         return jsonify(tracks), 200
@@ -569,6 +1995,7 @@ def get_tracks(current_user):
             conn.close()
 
 @app.route('/api/tracks', methods=['POST'])
+@admission_control('write')
 @token_required
 def add_track(current_user):
     data = request.get_json()
@@ -583,7 +2010,7 @@ def add_track(current_user):
         return jsonify({'message': 'Название, исполнитель и жанр обязательны'}), 400
     
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         cursor.callproc('add_track', (
@@ -609,6 +2036,7 @@ def add_track(current_user):
             conn.close()
 
 @app.route('/api/tracks/<int:track_id>', methods=['PUT'])
+@admission_control('write')
 @token_required
 def update_track(current_user, track_id):
     data = request.get_json()
@@ -623,7 +2051,14 @@ def update_track(current_user, track_id):
         return jsonify({'message': 'Название, исполнитель и жанр обязательны'}), 400
     
     try:
-        conn = get_db_connection()
+        shard, owner_id = current_user['shard'], current_user['user_id']
+        if current_user.get('is_admin'):
+            # Admins see tracks of every shard; the change is made on the owner's shard
+            shard, owner_id = find_track_shard(track_id)
+            if shard is None:
+                return jsonify({'message': 'Трек не найден'}), 404
+        
+        conn = get_db_connection(shard)
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # First, check if the track belongs to the current user (unless admin) using stored procedure
@@ -634,7 +2069,7 @@ def update_track(current_user, track_id):
                 return jsonify({'message': 'Нет прав для изменения этого трека'}), 403
         
         cursor.callproc('update_track', (
-            track_id, current_user['user_id'], title, artist_id, genre_id, bpm, duration_sec
+            track_id, owner_id, title, artist_id, genre_id, bpm, duration_sec
         ))
         result = cursor.fetchone()
         
@@ -656,10 +2091,18 @@ def update_track(current_user, track_id):
             conn.close()
 
 @app.route('/api/tracks/<int:track_id>', methods=['DELETE'])
+@admission_control('write')
 @token_required
 def delete_track(current_user, track_id):
     try:
-        conn = get_db_connection()
+        shard = current_user['shard']
+        if current_user.get('is_admin'):
+            # Admins see tracks of every shard; the track is deleted on the owner's shard
+            shard, _ = find_track_shard(track_id)
+            if shard is None:
+                return jsonify({'message': 'Трек не найден'}), 404
+        
+        conn = get_db_connection(shard)
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # First, check if the track belongs to the current user (unless admin) using stored procedure
@@ -691,10 +2134,11 @@ def delete_track(current_user, track_id):
 
 # Collection routes
 @app.route('/api/collections', methods=['GET'])
+@admission_control('read')
 @token_required
 def get_collections(current_user):
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         cursor.callproc('get_user_collections', (current_user['user_id'],))
@@ -710,6 +2154,7 @@ def get_collections(current_user):
             conn.close()
 
 @app.route('/api/collections', methods=['POST'])
+@admission_control('write')
 @token_required
 def add_collection(current_user):
     data = request.get_json()
@@ -720,13 +2165,26 @@ def add_collection(current_user):
     if not name:
         return jsonify({'message': 'Название коллекции обязательно'}), 400
     
+    rules_params = None
+    if data.get('rules') is not None:
+        rules_params, error = parse_collection_rules(data['rules'])
+        if error:
+            return error
+    
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         cursor.callproc('create_collection', (current_user['user_id'], name, is_favorite))
         result = cursor.fetchone()
         
+        # Rules are set in the same transaction; a trigger fills the collection from the library
+        if rules_params and result and result['collection_id']:
+            cursor.callproc('set_collection_rules', (result['collection_id'],) + rules_params)
+            if not cursor.fetchone()['success']:
+                conn.rollback()
+                return jsonify({'message': 'Жанр или исполнитель в правилах не найден'}), 400
+        
         # Commit the transaction
         conn.commit()
         
@@ -745,6 +2203,7 @@ def add_collection(current_user):
             conn.close()
 
 @app.route('/api/collections/<int:collection_id>', methods=['PUT'])
+@admission_control('write')
 @token_required
 def update_collection(current_user, collection_id):
     data = request.get_json()
@@ -755,8 +2214,15 @@ def update_collection(current_user, collection_id):
     if not name:
         return jsonify({'message': 'Название коллекции обязательно'}), 400
     
+    # Omitted rules are left unchanged, null makes the collection a regular one
+    rules_params = None
+    if 'rules' in data:
+        rules_params, error = parse_collection_rules(data['rules'])
+        if error:
+            return error
+    
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # First, check if the collection belongs to the current user using stored procedure
@@ -768,6 +2234,12 @@ def update_collection(current_user, collection_id):
         cursor.callproc('update_collection', (collection_id, name, is_favorite))
         result = cursor.fetchone()
         
+        if rules_params and result and result['success']:
+            cursor.callproc('set_collection_rules', (collection_id,) + rules_params)
+            if not cursor.fetchone()['success']:
+                conn.rollback()
+                return jsonify({'message': 'Жанр или исполнитель в правилах не найден'}), 400
+        
         # Commit the transaction
         conn.commit()
         
@@ -786,10 +2258,11 @@ def update_collection(current_user, collection_id):
             conn.close()
 
 @app.route('/api/collections/<int:collection_id>', methods=['DELETE'])
+@admission_control('write')
 @token_required
 def delete_collection(current_user, collection_id):
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # First, check if the collection belongs to the current user using stored procedure
@@ -820,6 +2293,7 @@ def delete_collection(current_user, collection_id):
 
 # Add track to collection
 @app.route('/api/collections/<int:collection_id>/tracks', methods=['POST'])
+@admission_control('write')
 @token_required
 def add_track_to_collection(current_user, collection_id):
     data = request.get_json()
@@ -829,7 +2303,7 @@ def add_track_to_collection(current_user, collection_id):
         return jsonify({'message': 'ID трека обязателен'}), 400
     
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # Check if collection belongs to user using stored procedure
@@ -867,10 +2341,11 @@ def add_track_to_collection(current_user, collection_id):
 
 # Remove track from collection
 @app.route('/api/collections/<int:collection_id>/tracks/<int:track_id>', methods=['DELETE'])
+@admission_control('write')
 @token_required
 def remove_track_from_collection(current_user, collection_id, track_id):
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # Check if collection belongs to user using stored procedure
@@ -900,10 +2375,11 @@ def remove_track_from_collection(current_user, collection_id, track_id):
             conn.close()
 
 @app.route('/api/collections/<int:collection_id>/tracks', methods=['GET'])
+@admission_control('read')
 @token_required
 def get_collection_tracks(current_user, collection_id):
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(current_user['shard'])
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # Check if collection belongs to user using stored procedure
@@ -925,95 +2401,565 @@ def get_collection_tracks(current_user, collection_id):
         if 'conn' in locals():
             conn.close()
 
+# Change feed route
+# EventSource cannot send an Authorization header, so the token comes in the query string
+@app.route('/api/events', methods=['GET'])
+@admission_control('read')
+@token_required(allow_query_token=True)
+def change_events(current_user):
+    """Поток событий изменений библиотеки пользователя (server-sent events)"""
+    current_user_id = current_user['user_id']
+    shard = current_user['shard']
+    
+    def generate():
+        subscriber = change_feed.subscribe(current_user_id, shard)
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event = subscriber.get(timeout=CHANGE_FEED_KEEPALIVE_SEC)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                
+                if event['type'] == 'resync':
+                    yield 'event: resync\ndata: {}\n\n'
+                else:
+                    change = {
+                        'entity': event['entity'],
+                        'id': event['id'],
+                        'collection_id': event['collection_id'],
+                        'operation': event['operation'],
+                        'version': event['version']
+                    }
+                    yield f"event: change\nid: {event['version']}\ndata: {json.dumps(change)}\n\n"
+        finally:
+            change_feed.unsubscribe(current_user_id, subscriber)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# Delta sync route
+@app.route('/api/sync', methods=['GET'])
+@admission_control('read')
+@token_required
+def sync_library(current_user):
+    """Изменения библиотеки с момента курсора (без курсора - полный снимок)"""
+    since = request.args.get('since')
+    
+    if since is not None:
+        if not since.isdigit():
+            return jsonify({'message': 'Неверный курсор синхронизации'}), 400
+        since = int(since)
+    
+    try:
+        conn = get_db_connection(current_user['shard'])
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        # The cursor must be taken before reading changes so that transactions
+        # still in progress are picked up by the next sync
+        cursor.callproc('get_sync_cursor')
+        next_cursor = cursor.fetchone()['get_sync_cursor']
+        
+        # Changes before the horizon were pruned: such a cursor gets a full snapshot
+        # (the horizon stays locked until this transaction ends)
+        cursor.callproc('get_library_changes_horizon')
+        if since is not None and since < cursor.fetchone()['get_library_changes_horizon']:
+            since = None
+        
+        cursor.callproc('get_library_changes', (current_user['user_id'], since))
+        changes = cursor.fetchall()
+        
+        result = {
+            'cursor': str(next_cursor),
+            'full': since is None
+        }
+        for entity in ('tracks', 'artists', 'collections', 'collection_tracks'):
+            result[entity] = {'upserted': [], 'deleted': []}
+        
+        for change in changes:
+            section = result[change['entity']]
+            if change['operation'] == 'upsert':
+                section['upserted'].append(change['data'])
+            elif change['entity'] == 'collection_tracks':
+                section['deleted'].append({
+                    'collection_id': change['collection_id'],
+                    'track_id': change['entity_id']
+                })
+            else:
+                section['deleted'].append(change['entity_id'])
+        
+        return jsonify(result), 200
+        
+    except Exception as e:
+        print(f"Sync library error: {str(e)}")
+        return jsonify({'message': 'Ошибка синхронизации'}), 500
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+# Export routes
+@app.route('/api/export/tracks', methods=['GET'])
+@admission_control('export')
+@token_required
+def export_tracks(current_user):
+    """Потоковый экспорт всей библиотеки пользователя (CSV или NDJSON)"""
+    export_format, compress, error = parse_export_args()
+    if error:
+        return error
+    
+    try:
+        conn = get_db_connection(current_user['shard'])
+        # The connection is closed by the stream once the export is finished
+        return export_response(
+            conn, 'get_user_tracks(%s)', (current_user['user_id'],),
+            export_format, compress, 'library'
+        )
+        
+    except Exception as e:
+        print(f"Export tracks error: {str(e)}")
+        if 'conn' in locals():
+            conn.close()
+        return jsonify({'message': 'Ошибка при экспорте треков'}), 500
+
+@app.route('/api/export/collections/<int:collection_id>', methods=['GET'])
+@admission_control('export')
+@token_required
+def export_collection(current_user, collection_id):
+    """Потоковый экспорт треков коллекции (CSV или NDJSON)"""
+    export_format, compress, error = parse_export_args()
+    if error:
+        return error
+    
+    try:
+        conn = get_db_connection(current_user['shard'])
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        # Check if collection belongs to user using stored procedure
+        cursor.callproc('get_collection_owner', (collection_id,))
+        collection_owner = cursor.fetchone()
+        cursor.close()
+        if not collection_owner or collection_owner['user_id'] != current_user['user_id']:
+            conn.close()
+            return jsonify({'message': 'Нет прав для экспорта этой коллекции'}), 403
+        
+        # The connection is closed by the stream once the export is finished
+        return export_response(
+            conn, 'get_collection_tracks(%s)', (collection_id,),
+            export_format, compress, f'collection_{collection_id}'
+        )
+        
+    except Exception as e:
+        print(f"Export collection error: {str(e)}")
+        if 'conn' in locals():
+            conn.close()
+        return jsonify({'message': 'Ошибка при экспорте коллекции'}), 500
+
 # Search routes
 @app.route('/api/search/tracks', methods=['GET'])
+@admission_control('heavy')
 @token_required
 def search_tracks(current_user):
-    title = request.args.get('title')
-    artist = request.args.get('artist')
-    genre_id = request.args.get('genre_id')
-    bpm = request.args.get('bpm')
-    duration = request.args.get('duration')
+    # Normalize parameters so that equivalent searches share a cache entry
+    # (ILIKE is case-insensitive, an empty pattern matches everything)
+    title = (request.args.get('title') or '').strip().lower() or None
+    artist = (request.args.get('artist') or '').strip().lower() or None
+    try:
+        genre_id, bpm, duration = (
+            int(request.args[name]) if request.args.get(name) else None
+            for name in ('genre_id', 'bpm', 'duration')
+        )
+    except ValueError:
+        return jsonify({'message': 'Неверные параметры поиска'}), 400
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        # The search is global, so it covers every shard. The generations are read
+        # before searching, so a cached result is never older than its key
+        generations = tuple(rows[0]['get_search_generation']
+                            for rows in query_all_shards('get_search_generation'))
+        cache_key = (generations, title, artist, genre_id, bpm, duration)
+        
+        body = search_cache.get(cache_key)
+        if body is None:
+            # Each shard returns its matches newest first
+            shard_results = query_all_shards('search_tracks', (title, artist, genre_id, bpm, duration))
+            results = merge_shard_rows(shard_results, 'created_at')
+            body = app.json.dumps(results).encode('utf-8')
+            search_cache.put(cache_key, body)
+        
+        return app.response_class(body, mimetype='application/json'), 200
         
-        # Call search procedure
-        cursor.callproc('search_tracks', (title, artist, genre_id, bpm, duration))
+    except Exception as e:
+        print(f"Search tracks error: {str(e)}")
+        return jsonify({'message': 'Ошибка при поиске'}), 500
+
+# Autocomplete is answered from the in-process index: only the JWT is checked (no
+# database round trip, no admission slot), since the index holds nothing but the
+# caller's own names; the database is read only when the caller's index is built
+@app.route('/api/autocomplete', methods=['GET'])
+@token_required(verify_user=False)
+def autocomplete(current_user):
+    """Автодополнение названий треков, исполнителей и коллекций по префиксу"""
+    prefix = request.args.get('q', '')
+    limit = request.args.get('limit', default=TYPEAHEAD_DEFAULT_LIMIT, type=int)
+    entities = request.args.get('entities')
+    entities = set(entities.split(',')) if entities else set(TYPEAHEAD_ENTITIES)
+    
+    if not entities <= set(TYPEAHEAD_ENTITIES):
+        return jsonify({'message': 'Поддерживаемые типы: tracks, artists, collections'}), 400
+    
+    if limit < 1 or limit > TYPEAHEAD_MAX_LIMIT:
+        return jsonify({'message': f'Количество подсказок должно быть от 1 до {TYPEAHEAD_MAX_LIMIT}'}), 400
+    
+    if not prefix.strip():
+        return jsonify([]), 200
+    
+    try:
+        completions = typeahead_cache.complete(current_user['user_id'], current_user['shard'],
+                                               prefix, entities, limit)
+        return jsonify(completions), 200
+    except Exception as e:
+        print(f"Autocomplete error: {str(e)}")
+        return jsonify({'message': 'Ошибка автодополнения'}), 500
+
+@app.route('/api/search/similar', methods=['GET'])
+@admission_control('heavy')
+@token_required
+def search_similar_tracks(current_user):
+    """Найти k ближайших треков по BPM и длительности (или к существующему треку)"""
+    track_id = request.args.get('track_id', type=int)
+    bpm = request.args.get('bpm', type=int)
+    duration = request.args.get('duration', type=int)
+    genre_id = request.args.get('genre_id', type=int)
+    limit = request.args.get('k', default=SIMILAR_TRACKS_DEFAULT_LIMIT, type=int)
+
+    if track_id is None and (bpm is None or duration is None):
+        return jsonify({'message': 'Укажите трек или BPM и длительность'}), 400
+
+    if limit < 1 or limit > SIMILAR_TRACKS_MAX_LIMIT:
+        return jsonify({'message': f'Количество результатов должно быть от 1 до {SIMILAR_TRACKS_MAX_LIMIT}'}), 400
+
+    try:
+        conn = get_db_connection(current_user['shard'])
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+        cursor.callproc('find_similar_tracks', (
+            current_user['user_id'], bpm, duration, genre_id, track_id, limit
+        ))
         results = cursor.fetchall()
-        
+
         return jsonify(results), 200
+
+    except Exception as e:
+        print(f"Search similar tracks error: {str(e)}")
+        return jsonify({'message': 'Ошибка при поиске похожих треков'}), 500
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+@app.route('/api/tracks/duplicates', methods=['POST'])
+@admission_control('write')
+@token_required
+def find_duplicate_tracks(current_user):
+    """Найти группы дубликатов среди треков пользователя с предложением, какой трек оставить"""
+    try:
+        conn = get_db_connection(current_user['shard'])
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        # Clusters depend only on track data, so they are cached under the search
+        # generation (collection counts behind the keep suggestion may lag until the
+        # next track change)
+        cursor.callproc('get_search_generation')
+        generation = cursor.fetchone()['get_search_generation']
+        cache_key = (current_user['shard'], generation, current_user['user_id'])
+        
+        body = duplicate_cache.get(cache_key)
+        if body is not None:
+            return app.response_class(body, mimetype='application/json'), 200
+        
+        # Clustering a large library takes seconds, so it runs as a background job;
+        # the client polls /api/jobs/<id> and takes the clusters from the job result
+        job = job_queue.enqueue(cursor, 'duplicate_scan', current_user['user_id'], {},
+                                f"duplicates:{current_user['user_id']}")
+        conn.commit()
+        job_queue.wake(current_user['shard'])
+        
+        return jsonify({
+            'message': 'Поиск дубликатов запущен',
+            'job_id': job['job_id'],
+            'status': job['status']
+        }), 202
         
     except Exception as e:
-        print(f"Search tracks error: {str(e)}")
-        return jsonify({'message': 'Ошибка при поиске'}), 500
+        print(f"Find duplicate tracks error: {str(e)}")
+        if 'conn' in locals():
+            conn.rollback()
+        return jsonify({'message': 'Ошибка при поиске дубликатов'}), 500
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+@app.route('/api/tracks/duplicates/merge', methods=['POST'])
+@admission_control('write')
+@token_required
+def merge_duplicate_tracks(current_user):
+    """Объединить группу дубликатов: перенести их коллекции на сохраняемый трек и удалить дубликаты"""
+    data = request.get_json() or {}
+    keep_track_id = data.get('keep_track_id')
+    duplicate_track_ids = data.get('duplicate_track_ids')
+    
+    if not isinstance(keep_track_id, int) or not isinstance(duplicate_track_ids, list) or \
+            not duplicate_track_ids or not all(isinstance(i, int) for i in duplicate_track_ids):
+        return jsonify({'message': 'Укажите keep_track_id и непустой список duplicate_track_ids'}), 400
+    
+    try:
+        conn = get_db_connection(current_user['shard'])
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cursor.callproc('merge_duplicate_tracks', (current_user['user_id'], keep_track_id, duplicate_track_ids))
+        result = cursor.fetchone()
+        
+        if not result or result['deleted_tracks'] is None:
+            conn.rollback()
+            return jsonify({'message': 'Трек не найден'}), 404
+        
+        # Commit the transaction
+        conn.commit()
+        
+        return jsonify(result), 200
+        
+    except Exception as e:
+        print(f"Merge duplicate tracks error: {str(e)}")
+        if 'conn' in locals():
+            conn.rollback()
+        return jsonify({'message': 'Ошибка при объединении дубликатов'}), 500
     finally:
         if 'conn' in locals():
             conn.close()
 
 # Admin routes
 @app.route('/api/admin/users', methods=['GET'])
+@admission_control('heavy')
 @admin_required
 def get_all_users():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.callproc('get_all_users_admin')
-        users = cursor.fetchall()
+        # Users are spread across shards; each shard returns them newest first
+        shard_users = query_all_shards('get_all_users_admin')
+        users = merge_shard_rows(shard_users, 'created_at')
         
         return jsonify(users), 200
         
     except Exception as e:
         print(f"Get all users error: {str(e)}")
         return jsonify({'message': 'Не удалось получить список пользователей'}), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/api/admin/tracks', methods=['GET'])
+@admission_control('heavy')
 @admin_required
 def get_all_tracks_admin():
+    limit, before_id, error = parse_page_args()
+    if error:
+        return error
+    
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.callproc('get_all_tracks_admin')
-        tracks = cursor.fetchall()
+        # Every shard returns its own page; the merged page is the top `limit` of them
+        shard_tracks = query_all_shards('get_all_tracks_admin', (limit, before_id))
+        tracks = merge_shard_rows(shard_tracks, 'track_id', limit)
         
         return jsonify(tracks), 200
         
     except Exception as e:
         print(f"Get all tracks admin error: {str(e)}")
         return jsonify({'message': 'Не удалось получить треки'}), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/api/admin/audit', methods=['GET'])
+@admission_control('heavy')
 @admin_required
 def get_audit_log():
+    limit, before_id, error = parse_page_args()
+    if error:
+        return error
+    
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.callproc('get_audit_log')
-        audit_entries = cursor.fetchall()
+        shard_entries = query_all_shards('get_audit_log', (limit, before_id))
+        audit_entries = merge_shard_rows(shard_entries, 'log_id', limit)
         
         return jsonify(audit_entries), 200
         
     except Exception as e:
         print(f"Get audit log error: {str(e)}")
         return jsonify({'message': 'Не удалось получить журнал операций'}), 500
+
+@app.route('/api/admin/audit/stats', methods=['GET'])
+@admission_control('read')
+@admin_required
+def get_audit_stats():
+    """Статистика операций по часам или дням из агрегатов журнала аудита"""
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in AUDIT_STATS_MAX_RANGE:
+        return jsonify({'message': 'Интервал агрегации должен быть hour или day'}), 400
+    
+    # Audit rows are stamped with CURRENT_TIMESTAMP in naive server-local time (the
+    # database and the application run in one time zone), so the range is local time
+    # too: a bound with an offset is converted to local time and made naive
+    def parse_bound(name):
+        value = datetime.fromisoformat(request.args[name])
+        return value.astimezone().replace(tzinfo=None) if value.tzinfo else value
+    
+    try:
+        date_to = parse_bound('to') if request.args.get('to') else datetime.now()
+        date_from = (parse_bound('from') if request.args.get('from')
+                     else date_to - AUDIT_STATS_DEFAULT_RANGE[granularity])
+    except ValueError:
+        return jsonify({'message': 'Неверный формат даты'}), 400
+    
+    # Align the range to whole buckets; the upper bound is exclusive
+    if granularity == 'hour':
+        date_from = date_from.replace(minute=0, second=0, microsecond=0)
+        date_to = date_to.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    else:
+        date_from = date_from.replace(hour=0, minute=0, second=0, microsecond=0)
+        date_to = date_to.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    
+    if date_from >= date_to or date_to - date_from > AUDIT_STATS_MAX_RANGE[granularity]:
+        return jsonify({'message': 'Неверный или слишком большой период'}), 400
+    
+    group_by = [d for d in request.args.get('group_by', '').split(',') if d]
+    if any(d not in AUDIT_STATS_DIMENSIONS for d in group_by):
+        return jsonify({'message': 'Группировка возможна по table, operation, user'}), 400
+    
+    user_id = request.args.get('user_id', type=int)
+    
+    try:
+        shard_stats = query_all_shards('get_audit_stats', (
+            granularity, date_from, date_to,
+            request.args.get('table'), request.args.get('operation'), user_id,
+            'table' in group_by, 'operation' in group_by, 'user' in group_by
+        ))
+        
+        # Users live on different shards, but tables and operations repeat: sum the shard rows
+        merged = {}
+        for rows in shard_stats:
+            for row in rows:
+                key = (row['bucket'], row['table_name'], row['operation_type'], row['user_id'])
+                if key in merged:
+                    merged[key]['operation_count'] += row['operation_count']
+                else:
+                    merged[key] = dict(row)
+        
+        series = sorted(merged.values(), key=lambda row: (
+            row['bucket'], row['table_name'] or '', row['operation_type'] or '', row['user_id'] or 0
+        ))
+        for row in series:
+            row['bucket'] = row['bucket'].isoformat()
+        
+        return jsonify({
+            'granularity': granularity,
+            'from': date_from.isoformat(),
+            'to': date_to.isoformat(),
+            'group_by': group_by,
+            'series': series
+        }), 200
+        
+    except Exception as e:
+        print(f"Get audit stats error: {str(e)}")
+        return jsonify({'message': 'Не удалось получить статистику операций'}), 500
+
+@app.route('/api/admin/audit/backfill', methods=['POST'])
+@admission_control('write')
+@admin_required
+def start_audit_backfill():
+    """Запуск заполнения агрегатов аудита записями, созданными до появления агрегатов"""
+    job_ids = []
+    try:
+        # One job per shard, each working through its own audit log
+        for shard in range(len(DB_SHARDS)):
+            conn = get_db_connection(shard)
+            try:
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                job = job_queue.enqueue(cursor, 'audit_backfill', None, {}, 'audit_backfill')
+                conn.commit()
+            finally:
+                conn.close()
+            job_queue.wake(shard)
+            job_ids.append(job['job_id'])
+        
+        return jsonify({'message': 'Заполнение статистики запущено', 'job_ids': job_ids}), 202
+        
+    except Exception as e:
+        print(f"Start audit backfill error: {str(e)}")
+        return jsonify({'message': 'Не удалось запустить заполнение статистики'}), 500
+
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+@admission_control('read')
+@token_required
+def get_job_status(current_user, job_id):
+    """Состояние фонового задания (для опроса клиентом)"""
+    try:
+        if current_user.get('is_admin'):
+            # Job ids are unique across shards; system jobs (e.g. audit backfill) run on every shard
+            jobs = [job for rows in query_all_shards('get_job', (job_id,)) for job in rows]
+        else:
+            conn = get_db_connection(current_user['shard'])
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            cursor.callproc('get_job', (job_id,))
+            jobs = cursor.fetchall()
+        
+        job = jobs[0] if jobs else None
+        if not job or (job['user_id'] != current_user['user_id'] and not current_user.get('is_admin')):
+            return jsonify({'message': 'Задание не найдено'}), 404
+        
+        return jsonify(job), 200
+        
+    except Exception as e:
+        print(f"Get job status error: {str(e)}")
+        return jsonify({'message': 'Не удалось получить состояние задания'}), 500
     finally:
         if 'conn' in locals():
             conn.close()
 
+# Admission metrics are served without admission control so they stay available under overload
+@app.route('/api/admin/metrics', methods=['GET'])
+@admin_required
+def get_metrics():
+    """Метрики допуска запросов, кеша поиска и автодополнения (для текущего рабочего процесса)"""
+    return jsonify({
+        'admission': admission.snapshot(),
+        'search_cache': search_cache.snapshot(),
+        'duplicate_cache': duplicate_cache.snapshot(),
+        'typeahead': typeahead_cache.snapshot()
+    }), 200
+
+# Клиентское приложение
+@app.route('/', defaults={'path': ''}, methods=['GET'])
+@app.route('/<path:path>', methods=['GET'])
+def serve_client(path):
+    """Отдача клиентского приложения со сжатыми и кешируемыми ресурсами"""
+    response = client_assets.response(path)
+    if response is None:
+        return jsonify({'message': 'Ресурс не найден'}), 404
+    return response
+
+@app.errorhandler(405)
+def method_not_allowed(e):
+    # The client catch-all accepts only GET, so any other method on an unknown path
+    # (e.g. POST /api/no-such-route) would be reported as 405 instead of 404
+    try:
+        endpoint, _ = app.url_map.bind('').match(request.path, method='GET')
+    except Exception:
+        endpoint = None
+    if endpoint == 'serve_client':
+        return jsonify({'message': 'Ресурс не найден'}), 404
+    return e
+
 # Health check endpoint
 @app.route('/api/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy', 'timestamp': datetime.utcnow()}), 200
 
+start_background_tasks()
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
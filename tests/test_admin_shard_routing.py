@@ -0,0 +1,122 @@
+"""Admin track edits are routed to the shard that owns the track"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DB_SHARDS', json.dumps([{}, {}]))
+os.environ.setdefault('BACKGROUND_TASKS', '0')
+
+pytest.importorskip('flask')
+jwt = pytest.importorskip('jwt')
+server = pytest.importorskip('server')
+
+
+class FakeShard:
+    """Procedures used by the track routes, over in-memory users and tracks"""
+
+    def __init__(self, users, tracks):
+        self.users = users    # user_id -> user row
+        self.tracks = tracks  # track_id -> track row
+
+    def call(self, name, params):
+        if name == 'get_user_by_id':
+            user = self.users.get(params[0])
+            return [dict(user)] if user else []
+        if name == 'get_track_owner':
+            track = self.tracks.get(params[0])
+            return [{'user_id': track['user_id']}] if track else []
+        if name == 'update_track':
+            track_id, user_id, title, artist_id, genre_id, bpm, duration_sec = params
+            track = self.tracks.get(track_id)
+            if not track or track['user_id'] != user_id:
+                return [{'success': False}]
+            track.update(title=title, artist_id=artist_id, genre_id=genre_id, bpm=bpm, duration_sec=duration_sec)
+            return [{'success': True}]
+        if name == 'delete_track':
+            return [{'success': self.tracks.pop(params[0], None) is not None}]
+        raise AssertionError(f'Unexpected procedure {name}')
+
+
+class FakeCursor:
+    def __init__(self, shard):
+        self._shard = shard
+        self._rows = []
+
+    def callproc(self, name, params=()):
+        self._rows = self._shard.call(name, params)
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, shard):
+        self._shard = shard
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self._shard)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def shards(monkeypatch):
+    admin = {'user_id': 1, 'login': 'admin', 'is_admin': True}
+    owner = {'user_id': 4, 'login': 'owner', 'is_admin': False}
+    shards = [
+        FakeShard({1: admin}, {}),
+        FakeShard({4: owner}, {7: {'track_id': 7, 'user_id': 4, 'title': 'Old title'}})
+    ]
+    monkeypatch.setattr(server, 'DB_SHARDS', [{}, {}])
+    monkeypatch.setattr(server, 'get_db_connection',
+                        lambda shard=0, request_class=None: FakeConnection(shards[shard]))
+    return shards
+
+
+@pytest.fixture
+def admin_headers():
+    token = jwt.encode({'user_id': 1, 'login': 'admin', 'shard': 0},
+                       server.app.config['SECRET_KEY'], algorithm='HS256')
+    return {'Authorization': f'Bearer {token}'}
+
+
+def test_admin_updates_track_on_owner_shard(shards, admin_headers):
+    client = server.app.test_client()
+    response = client.put('/api/tracks/7', headers=admin_headers, json={
+        'title': 'New title', 'artist_id': 2, 'genre_id': 3, 'bpm': 120, 'duration_sec': 200
+    })
+
+    assert response.status_code == 200
+    assert shards[1].tracks[7]['title'] == 'New title'
+
+
+def test_admin_deletes_track_on_owner_shard(shards, admin_headers):
+    client = server.app.test_client()
+    response = client.delete('/api/tracks/7', headers=admin_headers)
+
+    assert response.status_code == 200
+    assert 7 not in shards[1].tracks
+
+
+def test_admin_track_missing_on_all_shards(shards, admin_headers):
+    client = server.app.test_client()
+    response = client.delete('/api/tracks/99', headers=admin_headers)
+
+    assert response.status_code == 404
@@ -0,0 +1,59 @@
+"""Per-class caps of the admission controller hold for requests that had to queue"""
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DB_SHARDS', json.dumps([{}, {}]))
+os.environ.setdefault('BACKGROUND_TASKS', '0')
+
+pytest.importorskip('flask')
+server = pytest.importorskip('server')
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_queued_exports_respect_max_active():
+    controller = server.AdmissionController(max_concurrent=5, max_waiting=50)
+    max_active = server.REQUEST_CLASSES['export']['max_active']
+    for _ in range(5):
+        assert controller.acquire('read')
+
+    peak = []
+    results = []
+
+    def export():
+        admitted = controller.acquire('export')
+        results.append(admitted)
+        if admitted:
+            peak.append(controller.snapshot()['classes']['export']['active'])
+            time.sleep(0.2)
+            controller.release('export')
+
+    threads = [threading.Thread(target=export) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    assert wait_until(lambda: controller.snapshot()['waiting'] == 4)
+
+    # Global slots free up for all queued exports at once; only max_active may take them
+    for _ in range(5):
+        controller.release('read')
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) <= max_active
+    # Exports wait for a free export slot until their deadline, so all of them get through
+    assert results.count(True) == 4
+